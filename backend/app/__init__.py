@@ -6,6 +6,7 @@ from flask import Flask, jsonify
 from flask_cors import CORS
 from flask_socketio import SocketIO
 from flask_sqlalchemy import SQLAlchemy
+import atexit
 import os
 from dotenv import load_dotenv
 
@@ -28,14 +29,20 @@ def create_app():
     # Initialize extensions with app
     db.init_app(app)
     CORS(app, origins=os.getenv('CORS_ORIGINS', 'http://localhost:3000').split(','))
-    socketio.init_app(app, async_mode='threading', cors_allowed_origins='*')
+    # A message queue lets ingest worker processes emit to the web process's clients
+    socketio.init_app(
+        app,
+        async_mode='threading',
+        cors_allowed_origins='*',
+        message_queue=os.getenv('SOCKETIO_MESSAGE_QUEUE') or None
+    )
     
     # Disable strict slashes to avoid 308 redirects
     app.url_map.strict_slashes = False
     
     # Register blueprints
     from app.api import auth, devices, gateways, alerts, stats, mqtt_admin
-    from app.api import sites, iot_gateways, nodes, sensor_data
+    from app.api import sites, iot_gateways, nodes, rollouts, commands, outbox, sensor_data, ingest, metrics
     
     app.register_blueprint(auth.bp, url_prefix='/api/v1/auth')
     app.register_blueprint(devices.bp, url_prefix='/api/v1/devices')
@@ -48,7 +55,12 @@ def create_app():
     app.register_blueprint(sites.bp, url_prefix='/api/v1/sites')
     app.register_blueprint(iot_gateways.bp, url_prefix='/api/v1/iot/gateways')
     app.register_blueprint(nodes.bp, url_prefix='/api/v1/iot/nodes')
+    app.register_blueprint(rollouts.bp, url_prefix='/api/v1/iot/rollouts')
+    app.register_blueprint(commands.bp, url_prefix='/api/v1/iot/commands')
+    app.register_blueprint(outbox.bp, url_prefix='/api/v1/iot/outbox')
     app.register_blueprint(sensor_data.bp, url_prefix='/api/v1/sensor-data')
+    app.register_blueprint(ingest.bp, url_prefix='/api/v1/ingest')
+    app.register_blueprint(metrics.bp, url_prefix='/api/v1/metrics')
     
     # Health check endpoint
     @app.route('/api/v1/health')
@@ -58,19 +70,74 @@ def create_app():
     # Register WebSocket event handlers
     from app.services import websocket
     
-    # Initialize and connect MQTT service
+    # The ingest worker supervisor (worker.py) only creates the tables: it runs no services
     from app.services.mqtt_service import mqtt_service
-    mqtt_service.app = app
-    mqtt_service.connect()
+    if mqtt_service.role == 'supervisor':
+        with app.app_context():
+            db.create_all()
+        return app
+    
+    # Start the heartbeat buffer and sensor data writer before MQTT messages arrive
+    # (atexit runs in reverse order: the writer drains before heartbeats are flushed)
+    from app.services.heartbeat import heartbeat_buffer
+    heartbeat_buffer.app = app
+    heartbeat_buffer.start()
+    atexit.register(heartbeat_buffer.stop)
+    data_writer = mqtt_service.data_writer()
+    data_writer.app = app
+    if mqtt_service.ingest_engine != 'asyncio':
+        data_writer.start()
+    atexit.register(data_writer.stop)
+    
+    # Offline detection runs where heartbeats are recorded: ingest workers, or the web
+    # process when it ingests itself
+    if mqtt_service.role != 'web' or mqtt_service.ingest_mode != 'workers':
+        from app.services.liveness import liveness_tracker
+        liveness_tracker.app = app
+        liveness_tracker.start()
+        atexit.register(liveness_tracker.stop)
     
-    # Start background tasks
-    from app.services.background_tasks import start_background_tasks
-    start_background_tasks()
+    # Alerts are handled by the web process only (ingest workers do not subscribe to them);
+    # started before the lanes so the alert lane drains into it on exit
+    if mqtt_service.role == 'web':
+        from app.services.alert_pipeline import alert_pipeline
+        alert_pipeline.app = app
+        alert_pipeline.start()
+        atexit.register(alert_pipeline.stop)
+    
+    # Initialize MQTT service; ingest worker processes connect it themselves
+    mqtt_service.app = app
+    mqtt_service.start_lanes()
+    atexit.register(mqtt_service.stop_lanes)
+    if mqtt_service.role == 'web':
+        mqtt_service.connect()
+        # The asyncio engine has its own MQTT connection for the ingest topics
+        if mqtt_service.ingest_engine == 'asyncio' and mqtt_service.ingest_mode == 'embedded':
+            data_writer.start()
+        
+        # Start background tasks
+        from app.services.background_tasks import start_background_tasks
+        from app.services.retention import retention_engine
+        retention_engine.app = app
+        atexit.register(retention_engine.stop)
+        start_background_tasks()
     
     # Create database tables
     with app.app_context():
         db.create_all()
     
+    # Commands and node configs are published from the outbox and config rollouts receive
+    # acknowledgements through the web process's client; started once their tables exist
+    if mqtt_service.role == 'web':
+        from app.services.outbox import outbox
+        outbox.app = app
+        outbox.start()
+        atexit.register(outbox.stop)
+        from app.services.config_rollout import config_rollout
+        config_rollout.app = app
+        config_rollout.start()
+        atexit.register(config_rollout.stop)
+    
     return app
 
 app = create_app()
@@ -1,10 +1,13 @@
 """
 Alerts API endpoints
+Legacy device alerts (integer ids) and gateway/node alerts from MQTT (UUIDs)
 """
 from flask import Blueprint, request, jsonify
 from app import db
 from app.models import Alert, Device
+from app.models.iot import NodeAlert
 from app.api.auth import token_required
+from app.services.alert_pipeline import alert_pipeline
 from datetime import datetime
 import random
 
@@ -13,21 +16,35 @@ bp = Blueprint('alerts', __name__)
 @bp.route('/', methods=['GET'])
 @token_required
 def get_alerts(current_user):
-    """Get all alerts with optional filtering"""
+    """Get all alerts with optional filtering (gateway_id/node_id select gateway/node alerts only)"""
     status = request.args.get('status')
     severity = request.args.get('severity')
+    gateway_id = request.args.get('gateway_id')
+    node_id = request.args.get('node_id')
+    limit = request.args.get('limit', 500, type=int)
     
     query = Alert.query
+    node_query = NodeAlert.query
     
     if status:
         query = query.filter_by(status=status)
+        node_query = node_query.filter_by(status=status)
     if severity:
         query = query.filter_by(severity=severity)
+        node_query = node_query.filter_by(severity=severity)
+    if gateway_id:
+        node_query = node_query.filter_by(gateway_id=gateway_id)
+    if node_id:
+        node_query = node_query.filter_by(node_id=node_id)
+    
+    node_alerts = [alert.to_dict() for alert in node_query.order_by(NodeAlert.created_at.desc()).limit(limit).all()]
+    if gateway_id or node_id:
+        return jsonify({'alerts': node_alerts, 'total': len(node_alerts)}), 200
     
     alerts = query.order_by(Alert.created_at.desc()).all()
     
     # Create mock alerts if none exist
-    if not alerts:
+    if not alerts and not node_alerts:
         try:
             create_mock_alerts()
             alerts = query.order_by(Alert.created_at.desc()).all()
@@ -36,9 +53,11 @@ def get_alerts(current_user):
             print(f"Mock alerts creation skipped or failed: {e}")
             alerts = query.order_by(Alert.created_at.desc()).all()
     
+    merged = sorted(node_alerts + [alert.to_dict() for alert in alerts], key=lambda alert: alert['created_at'] or '',
+                    reverse=True)
     return jsonify({
-        'alerts': [alert.to_dict() for alert in alerts],
-        'total': len(alerts)
+        'alerts': merged,
+        'total': len(merged)
     }), 200
 
 @bp.route('/<int:alert_id>', methods=['GET'])
@@ -69,6 +88,36 @@ def resolve_alert(current_user, alert_id):
     
     return jsonify(alert.to_dict()), 200
 
+@bp.route('/<alert_id>', methods=['GET'])
+@token_required
+def get_node_alert(current_user, alert_id):
+    """Get single gateway/node alert details"""
+    alert = NodeAlert.query.get_or_404(alert_id)
+    return jsonify(alert.to_dict()), 200
+
+@bp.route('/<alert_id>/acknowledge', methods=['POST'])
+@token_required
+def acknowledge_node_alert(current_user, alert_id):
+    """Acknowledge a gateway/node alert (its next occurrence raises a new alert)"""
+    alert = NodeAlert.query.get_or_404(alert_id)
+    alert.status = 'acknowledged'
+    db.session.commit()
+    alert_pipeline.forget(alert.id)
+    
+    return jsonify(alert.to_dict()), 200
+
+@bp.route('/<alert_id>/resolve', methods=['POST'])
+@token_required
+def resolve_node_alert(current_user, alert_id):
+    """Resolve a gateway/node alert (its next occurrence raises a new alert)"""
+    alert = NodeAlert.query.get_or_404(alert_id)
+    alert.status = 'resolved'
+    alert.resolved_at = datetime.utcnow()
+    db.session.commit()
+    alert_pipeline.forget(alert.id)
+    
+    return jsonify(alert.to_dict()), 200
+
 def create_mock_alerts():
     """Create mock alerts for demo"""
     devices = Device.query.filter_by(type='node').limit(5).all()
@@ -0,0 +1,58 @@
+"""
+Gateway command RPC API endpoints
+"""
+from flask import Blueprint, request, jsonify
+from app.models.iot import Gateway
+from app.api.auth import token_required
+from app.services.command_rpc import command_rpc
+
+bp = Blueprint('commands', __name__)
+
+def batch_response(batch, wait=0, **extra):
+    """Wait up to `wait` seconds for a batch; 200 with its results once finished, 202 while running"""
+    if wait:
+        command_rpc.wait(batch, wait)
+    data = dict(extra, **batch.to_dict())
+    return jsonify(data), 200 if data['status'] == 'completed' else 202
+
+@bp.route('/', methods=['POST'])
+@token_required
+def send_command(current_user):
+    """Send a command to gateways (site_id, gateway_ids and/or status) and collect their replies"""
+    data = request.get_json()
+    
+    if not data or not data.get('command'):
+        return jsonify({'message': 'Command is required'}), 400
+    if not any(data.get(key) for key in ('site_id', 'gateway_ids', 'all')):
+        return jsonify({'message': 'One of site_id, gateway_ids or all is required'}), 400
+    
+    query = Gateway.query
+    if data.get('site_id'):
+        query = query.filter_by(site_id=data['site_id'])
+    if data.get('gateway_ids'):
+        query = query.filter(Gateway.id.in_(data['gateway_ids']))
+    if data.get('status'):
+        query = query.filter_by(status=data['status'])
+    
+    gateways = query.all()
+    if not gateways:
+        return jsonify({'message': 'No gateways match the selection'}), 404
+    
+    batch = command_rpc.send(gateways, data['command'], data.get('params', {}), data.get('timeout'))
+    return batch_response(batch, float(data.get('wait') or 0))
+
+@bp.route('/stats', methods=['GET'])
+@token_required
+def get_command_stats(current_user):
+    """Get command RPC counters"""
+    return jsonify(command_rpc.stats()), 200
+
+@bp.route('/<batch_id>', methods=['GET'])
+@token_required
+def get_command(current_user, batch_id):
+    """Get a command's replies so far (?wait=seconds to wait for the rest)"""
+    batch = command_rpc.get(batch_id)
+    if batch is None:
+        return jsonify({'message': 'Command not found (unknown, expired or sent by another process)'}), 404
+    
+    return batch_response(batch, request.args.get('wait', 0, type=float))
@@ -0,0 +1,73 @@
+"""
+Ingest pipeline API endpoints
+Queue, writer, cache and worker statistics for the MQTT ingest path
+"""
+from flask import Blueprint, jsonify
+from app.api.auth import token_required
+from app.services.alert_pipeline import alert_pipeline
+from app.services.catchup import catchup
+from app.services.clock_skew import clock_skew
+from app.services.dedup import duplicate_filter
+from app.services.heartbeat import heartbeat_buffer
+from app.services.liveness import liveness_tracker
+from app.services.mqtt_service import mqtt_service
+from app.services.partitions import partition_router
+from app.services.payload_decoder import payload_decoder
+from app.services.registry import device_registry
+from app.services.rollups import rollup_store
+from app.services.sensor_store import sensor_store
+
+bp = Blueprint('ingest', __name__)
+
+@bp.route('/stats', methods=['GET'])
+@token_required
+def get_ingest_stats(current_user):
+    """Get statistics of this process's ingest pipeline"""
+    return jsonify({
+        'role': mqtt_service.role,
+        'ingest_mode': mqtt_service.ingest_mode,
+        'ingest_engine': mqtt_service.ingest_engine,
+        'mqtt': mqtt_service.connection_stats(),
+        'catchup': catchup.stats(),
+        'decoder': payload_decoder.stats(),
+        'writer': mqtt_service.data_writer().stats(),
+        'dedup': duplicate_filter.stats(),
+        'event_time': clock_skew.stats(),
+        'heartbeat': heartbeat_buffer.stats(),
+        'liveness': liveness_tracker.stats(),
+        'registry': device_registry.stats(),
+        'series': sensor_store.stats(),
+        'partitions': partition_router.stats(),
+        'rollups': rollup_store.stats(),
+        'alerts': alert_pipeline.stats()
+    }), 200
+
+@bp.route('/queues', methods=['GET'])
+@token_required
+def get_queue_stats(current_user):
+    """Get depth, overflow policy and dropped/delayed counters of this process's ingest lanes"""
+    queues = mqtt_service.queue_stats()
+    
+    return jsonify({
+        'role': mqtt_service.role,
+        'queues': queues,
+        'dropped_total': sum(q['dropped'] + q['sampled_out'] for q in queues.values()),
+        'delayed_total': sum(q['delayed'] for q in queues.values()),
+        'blocked_total': sum(q['blocked'] for q in queues.values())
+    }), 200
+
+@bp.route('/workers', methods=['GET'])
+@token_required
+def get_worker_stats(current_user):
+    """Get the latest statistics published by each ingest worker process"""
+    workers = [
+        dict(stats, worker_id=worker_id)
+        for worker_id, stats in sorted(mqtt_service.live_worker_stats().items())
+    ]
+    
+    return jsonify({
+        'workers': workers,
+        'total_workers': len(workers),
+        'messages_received': sum(w.get('writer', {}).get('messages_received', 0) for w in workers),
+        'rows_written': sum(w.get('writer', {}).get('rows_written', 0) for w in workers)
+    }), 200
@@ -5,6 +5,10 @@ from flask import Blueprint, request, jsonify
 from app import db
 from app.models.iot import Gateway, Node, Site
 from app.api.auth import token_required
+from app.api.commands import batch_response
+from app.services.command_rpc import command_rpc
+from app.services.heartbeat import heartbeat_buffer
+from app.services.registry import device_registry
 from datetime import datetime
 
 bp = Blueprint('iot_gateways', __name__)
@@ -24,7 +28,7 @@ def get_gateways(current_user):
         query = query.filter_by(status=status)
     
     gateways = query.all()
-    return jsonify({'gateways': [gw.to_dict() for gw in gateways]}), 200
+    return jsonify({'gateways': [heartbeat_buffer.overlay_gateway(gw.to_dict()) for gw in gateways]}), 200
 
 @bp.route('/<gateway_id>', methods=['GET'])
 @token_required
@@ -32,7 +36,7 @@ def get_gateway(current_user, gateway_id):
     """Get gateway details"""
     include_nodes = request.args.get('include_nodes', 'false').lower() == 'true'
     gateway = Gateway.query.get_or_404(gateway_id)
-    return jsonify(gateway.to_dict(include_nodes=include_nodes)), 200
+    return jsonify(heartbeat_buffer.overlay_gateway(gateway.to_dict(include_nodes=include_nodes))), 200
 
 @bp.route('/', methods=['POST'])
 @token_required
@@ -68,6 +72,7 @@ def create_gateway(current_user):
     
     db.session.add(gateway)
     db.session.commit()
+    device_registry.invalidate_gateway(gateway.gateway_id, gateway.id)
     
     return jsonify({'message': 'Gateway created successfully', 'gateway': gateway.to_dict()}), 201
 
@@ -90,6 +95,7 @@ def update_gateway(current_user, gateway_id):
             setattr(gateway, field, data[field])
     
     db.session.commit()
+    device_registry.invalidate_gateway(gateway.gateway_id, gateway.id)
     
     return jsonify({'message': 'Gateway updated successfully', 'gateway': gateway.to_dict()}), 200
 
@@ -98,9 +104,11 @@ def update_gateway(current_user, gateway_id):
 def delete_gateway(current_user, gateway_id):
     """Delete gateway (and all associated nodes)"""
     gateway = Gateway.query.get_or_404(gateway_id)
+    gateway_identifier = gateway.gateway_id
     
     db.session.delete(gateway)
     db.session.commit()
+    device_registry.invalidate_gateway(gateway_identifier, gateway_id)
     
     return jsonify({'message': 'Gateway deleted successfully'}), 200
 
@@ -109,7 +117,7 @@ def delete_gateway(current_user, gateway_id):
 def get_gateway_nodes(current_user, gateway_id):
     """Get all nodes connected to this gateway"""
     gateway = Gateway.query.get_or_404(gateway_id)
-    nodes = [node.to_dict() for node in gateway.nodes.all()]
+    nodes = [heartbeat_buffer.overlay_node(node.to_dict()) for node in gateway.nodes.all()]
     
     return jsonify({'nodes': nodes}), 200
 
@@ -120,13 +128,16 @@ def get_gateway_stats(current_user, gateway_id):
     gateway = Gateway.query.get_or_404(gateway_id)
     
     nodes = gateway.nodes.all()
-    online_nodes = sum(1 for n in nodes if n.status == 'online')
+    node_statuses = [heartbeat_buffer.node_status(n) for n in nodes]
+    online_nodes = node_statuses.count('online')
+    heartbeat = heartbeat_buffer.pending_gateway(gateway.id)
+    last_seen = heartbeat['last_seen'] if heartbeat else gateway.last_seen
     
     stats = {
         'gateway_id': gateway.gateway_id,
         'name': gateway.name,
-        'status': gateway.status,
-        'last_seen': gateway.last_seen.isoformat() if gateway.last_seen else None,
+        'status': heartbeat['status'] if heartbeat else gateway.status,
+        'last_seen': last_seen.isoformat() if last_seen else None,
         'total_nodes': len(nodes),
         'online_nodes': online_nodes,
         'offline_nodes': len(nodes) - online_nodes,
@@ -134,8 +145,8 @@ def get_gateway_stats(current_user, gateway_id):
         'capacity_percentage': round((len(nodes) / gateway.max_nodes) * 100, 2) if gateway.max_nodes > 0 else 0,
         'nodes_by_status': {
             'online': online_nodes,
-            'offline': sum(1 for n in nodes if n.status == 'offline'),
-            'error': sum(1 for n in nodes if n.status == 'error')
+            'offline': node_statuses.count('offline'),
+            'error': node_statuses.count('error')
         },
         'bluetooth_enabled_nodes': sum(1 for n in nodes if n.bluetooth_enabled),
         'battery_powered_nodes': sum(1 for n in nodes if n.battery_powered)
@@ -156,18 +167,7 @@ def send_gateway_command(current_user, gateway_id):
     command = data['command']
     params = data.get('params', {})
     
-    # TODO: Publish command to MQTT
-    # topic = f"{gateway.mqtt_topic_prefix}/cmd"
-    # payload = {
-    #     'command': command,
-    #     'params': params,
-    #     'timestamp': datetime.utcnow().isoformat()
-    # }
-    # mqtt_service.publish(topic, payload)
-    
-    return jsonify({
-        'message': f'Command "{command}" sent to gateway',
-        'gateway_id': gateway.gateway_id,
-        'command': command,
-        'params': params
-    }), 200
+    # The reply arrives asynchronously: ?wait / "wait" seconds to include it
+    batch = command_rpc.send([gateway], command, params, data.get('timeout'))
+    return batch_response(batch, float(data.get('wait') or request.args.get('wait', 0, type=float)),
+                          message=f'Command "{command}" sent to gateway', gateway_id=gateway.gateway_id)
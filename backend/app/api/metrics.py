@@ -0,0 +1,144 @@
+"""
+Metrics API endpoint
+Prometheus text exposition of this process's ingest and HTTP metrics.
+Set METRICS_TOKEN to require 'Authorization: Bearer <METRICS_TOKEN>' (a static
+token, since scrapers cannot log in for a JWT).
+"""
+import hmac
+import os
+import time
+from flask import Blueprint, Response, g, jsonify, request
+from app.services.alert_pipeline import alert_pipeline
+from app.services.catchup import catchup
+from app.services.clock_skew import clock_skew
+from app.services.command_rpc import command_rpc
+from app.services.config_rollout import config_rollout
+from app.services.dedup import duplicate_filter
+from app.services.heartbeat import heartbeat_buffer
+from app.services.liveness import liveness_tracker
+from app.services.metrics import metrics
+from app.services.mqtt_service import mqtt_service
+from app.services.outbox import outbox
+from app.services.payload_decoder import payload_decoder
+from app.services.registry import device_registry
+from app.services.retention import retention_engine
+from app.services.rollups import rollup_store
+
+bp = Blueprint('metrics', __name__)
+
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    'apru40_http_request_seconds', 'HTTP request duration per blueprint',
+    ['blueprint', 'method', 'status']
+)
+
+@bp.before_app_request
+def _start_request_timer():
+    g.metrics_started = time.perf_counter()
+
+@bp.after_app_request
+def _observe_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            request.blueprint or 'app', request.method, str(response.status_code)
+        )
+    return response
+
+def _queue_counter(field):
+    """Callback reading one counter of every ingest queue, by lane"""
+    return lambda: {lane: stats[field] for lane, stats in mqtt_service.queue_stats().items()}
+
+# Counters that already exist on the ingest components, read at scrape time
+metrics.callback('apru40_ingest_queue_depth', 'Messages waiting per ingest lane', _queue_counter('depth'), ['lane'])
+metrics.callback('apru40_ingest_queue_capacity', 'Capacity per ingest lane', _queue_counter('capacity'), ['lane'])
+for _field in ('enqueued', 'dropped', 'sampled_out', 'blocked', 'delayed'):
+    metrics.callback(f'apru40_ingest_queue_{_field}_total', f'Messages {_field.replace("_", " ")} per ingest lane',
+                     _queue_counter(_field), ['lane'], type='counter')
+metrics.callback('apru40_payload_decoded_total', 'MQTT payloads decoded', lambda: payload_decoder.decoded,
+                 type='counter')
+metrics.callback('apru40_payload_rejected_total', 'Malformed MQTT payloads rejected per reason',
+                 lambda: dict(payload_decoder.rejected), ['reason'], type='counter')
+metrics.callback('apru40_ingest_messages_written_total', 'Gateway data messages written',
+                 lambda: mqtt_service.data_writer().messages_written, type='counter')
+metrics.callback('apru40_ingest_rows_written_total', 'Sensor data rows written',
+                 lambda: mqtt_service.data_writer().rows_written, type='counter')
+metrics.callback('apru40_ingest_duplicates_suppressed_total',
+                 'Duplicate readings suppressed: node reports by the cache, rows by the unique index',
+                 lambda: {'cache': duplicate_filter.suppressed, 'storage': duplicate_filter.storage_suppressed},
+                 ['layer'], type='counter')
+metrics.callback('apru40_ingest_event_time_total',
+                 'Data messages whose event time was skew corrected, late, rejected as too late or clamped',
+                 lambda: {'corrected': clock_skew.corrected, 'late_accepted': clock_skew.late,
+                          'late_rejected': clock_skew.rejected, 'future_clamped': clock_skew.future},
+                 ['result'], type='counter')
+metrics.callback('apru40_gateway_clock_skew_seconds', 'Estimated gateway clock error (receive - device time)',
+                 clock_skew.skews, ['gateway'])
+
+def _pending_heartbeats():
+    stats = heartbeat_buffer.stats()
+    return {'gateway': stats['pending_gateways'], 'node': stats['pending_nodes']}
+
+metrics.callback('apru40_heartbeat_pending', 'Heartbeats waiting to be flushed', _pending_heartbeats, ['kind'])
+
+def _tracked_devices():
+    stats = liveness_tracker.stats()
+    return {'gateway': stats['tracked_gateways'], 'node': stats['tracked_nodes']}
+
+metrics.callback('apru40_liveness_tracked', 'Devices with a heartbeat deadline', _tracked_devices, ['kind'])
+metrics.callback('apru40_liveness_transitions_total', 'Devices marked offline or back online by the liveness tracker',
+                 lambda: dict(liveness_tracker.transitions), ['kind', 'status'], type='counter')
+metrics.callback('apru40_alerts_total', 'Alerts received: created, folded into an open alert or dropped',
+                 lambda: {'created': alert_pipeline.alerts_created, 'suppressed': alert_pipeline.alerts_suppressed,
+                          'dropped': alert_pipeline.alerts_dropped}, ['result'], type='counter')
+metrics.callback('apru40_alert_events_total', 'New alerts emitted as alert:new or throttled',
+                 lambda: {'emitted': alert_pipeline.events_emitted, 'throttled': alert_pipeline.events_throttled},
+                 ['result'], type='counter')
+metrics.callback('apru40_config_rollout_messages_total',
+                 'Node config messages sent, acknowledged, rejected, timed out, skipped as unchanged or unmatched acks',
+                 lambda: dict(config_rollout.messages), ['result'], type='counter')
+metrics.callback('apru40_command_requests_total', 'Gateway command requests by outcome',
+                 lambda: {'replied': command_rpc.replies, 'timeout': command_rpc.timeouts,
+                          'unsent': command_rpc.unsent}, ['result'], type='counter')
+metrics.callback('apru40_command_requests_pending', 'Gateway command requests awaiting a reply',
+                 lambda: command_rpc.stats()['pending_requests'])
+metrics.callback('apru40_mqtt_connected', 'Whether the MQTT client is connected',
+                 lambda: int(mqtt_service.connected))
+metrics.callback('apru40_mqtt_connections_total', 'MQTT connections, resumed sessions and lost connections',
+                 lambda: {'connected': mqtt_service.connects, 'resumed': mqtt_service.sessions_resumed,
+                          'disconnected': mqtt_service.disconnects}, ['event'], type='counter')
+metrics.callback('apru40_ingest_catchup_active', 'Whether ingest is draining a backlog',
+                 lambda: int(catchup.active))
+metrics.callback('apru40_ingest_catchup_messages', 'Messages drained by the current catch-up',
+                 lambda: catchup.messages if catchup.active else 0)
+metrics.callback('apru40_ingest_catchups_total', 'Catch-ups started by trigger',
+                 lambda: dict(catchup.episodes), ['reason'], type='counter')
+metrics.callback('apru40_ingest_catchup_emits_throttled_total', 'sensor_data events skipped while catching up',
+                 lambda: catchup.events_throttled, type='counter')
+metrics.callback('apru40_outbox_messages_total', 'Outbound MQTT messages by outcome',
+                 lambda: dict(outbox.messages), ['result'], type='counter')
+metrics.callback('apru40_outbox_queued', 'Outbound MQTT messages waiting to be published',
+                 lambda: outbox.queued)
+metrics.callback('apru40_outbox_inflight', 'Outbound MQTT messages awaiting the broker\'s PUBACK',
+                 lambda: outbox.stats()['inflight'])
+metrics.callback('apru40_registry_lookups_total', 'Device registry lookups',
+                 lambda: {'hit': device_registry.hits, 'miss': device_registry.misses}, ['result'], type='counter')
+metrics.callback('apru40_rollup_rows_upserted_total', 'Sensor rollup rows merged by the writer per resolution',
+                 lambda: dict(rollup_store.rows_upserted), ['resolution'], type='counter')
+metrics.callback('apru40_rollup_hours_compacted_total', 'Series hours rebuilt from raw samples before their deletion',
+                 lambda: rollup_store.hours_compacted, type='counter')
+metrics.callback('apru40_retention_running', 'Whether the sensor data retention job is running',
+                 lambda: int(retention_engine.running))
+metrics.callback('apru40_retention_rows_deleted_total', 'Rows deleted by the sensor data retention job',
+                 lambda: dict(retention_engine.rows_deleted), ['table'], type='counter')
+metrics.callback('apru40_retention_partitions_dropped_total', 'Sensor sample partitions dropped by retention',
+                 lambda: retention_engine.partitions_dropped, type='counter')
+
+@bp.route('', methods=['GET'])
+def get_metrics():
+    """Get all metrics in the Prometheus text format"""
+    token = os.getenv('METRICS_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return jsonify({'error': 'Invalid metrics token'}), 401
+    
+    return Response(metrics.expose(), mimetype='text/plain; version=0.0.4')
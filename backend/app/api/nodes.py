@@ -3,8 +3,13 @@ IoT Nodes API endpoints
 """
 from flask import Blueprint, request, jsonify
 from app import db
-from app.models.iot import Node, Gateway, SensorData
+from app.models.iot import Node, Gateway
 from app.api.auth import token_required
+from app.services.config_rollout import config_rollout
+from app.services.heartbeat import heartbeat_buffer
+from app.services.liveness import liveness_tracker
+from app.services.registry import device_registry
+from app.services.sensor_store import sensor_store
 from datetime import datetime
 
 bp = Blueprint('nodes', __name__)
@@ -27,14 +32,14 @@ def get_nodes(current_user):
         query = query.filter_by(bluetooth_enabled=bluetooth_enabled.lower() == 'true')
     
     nodes = query.all()
-    return jsonify({'nodes': [node.to_dict() for node in nodes]}), 200
+    return jsonify({'nodes': [heartbeat_buffer.overlay_node(node.to_dict()) for node in nodes]}), 200
 
 @bp.route('/<node_id>', methods=['GET'])
 @token_required
 def get_node(current_user, node_id):
     """Get node details"""
     node = Node.query.get_or_404(node_id)
-    return jsonify(node.to_dict()), 200
+    return jsonify(heartbeat_buffer.overlay_node(node.to_dict())), 200
 
 @bp.route('/', methods=['POST'])
 @token_required
@@ -76,6 +81,7 @@ def create_node(current_user):
     
     db.session.add(node)
     db.session.commit()
+    device_registry.invalidate_nodes(node.gateway_id)
     
     return jsonify({'message': 'Node created successfully', 'node': node.to_dict()}), 201
 
@@ -99,6 +105,7 @@ def update_node(current_user, node_id):
             setattr(node, field, data[field])
     
     db.session.commit()
+    device_registry.invalidate_nodes(node.gateway_id)
     
     return jsonify({'message': 'Node updated successfully', 'node': node.to_dict()}), 200
 
@@ -107,9 +114,11 @@ def update_node(current_user, node_id):
 def delete_node(current_user, node_id):
     """Delete node"""
     node = Node.query.get_or_404(node_id)
+    gateway_id = node.gateway_id
     
     db.session.delete(node)
     db.session.commit()
+    device_registry.invalidate_nodes(gateway_id)
     
     return jsonify({'message': 'Node deleted successfully'}), 200
 
@@ -137,8 +146,10 @@ def reassign_gateway(current_user, node_id):
     if existing and existing.id != node.id:
         return jsonify({'message': 'Node ID already exists on target gateway'}), 409
     
+    previous_gateway_id = node.gateway_id
     node.gateway_id = data['gateway_id']
     db.session.commit()
+    device_registry.invalidate_nodes(previous_gateway_id, node.gateway_id)
     
     return jsonify({'message': 'Node reassigned successfully', 'node': node.to_dict()}), 200
 
@@ -159,11 +170,14 @@ def update_adc_config(current_user, node_id):
         node.sensor_conversions = data['sensor_conversions']
     
     db.session.commit()
+    liveness_tracker.set_node_config(node.id, node.adc_config)
     
-    # TODO: Publish config update to MQTT
-    # mqtt_service.publish_node_config(node)
+    # Push the config to the node (tracked until acknowledged)
+    rollout = config_rollout.create(f"ADC config: {node.name}", selector={'node_ids': [node.id]},
+                                    created_by=current_user.get('username'))
     
-    return jsonify({'message': 'ADC config updated successfully', 'node': node.to_dict()}), 200
+    return jsonify({'message': 'ADC config updated successfully', 'node': node.to_dict(),
+                    'rollout_id': rollout.id}), 200
 
 @bp.route('/<node_id>/bluetooth', methods=['PUT'])
 @token_required
@@ -181,10 +195,12 @@ def update_bluetooth_config(current_user, node_id):
     
     db.session.commit()
     
-    # TODO: Publish config update to MQTT
-    # mqtt_service.publish_node_config(node)
+    # Push the config to the node (tracked until acknowledged)
+    rollout = config_rollout.create(f"Bluetooth config: {node.name}", selector={'node_ids': [node.id]},
+                                    created_by=current_user.get('username'))
     
-    return jsonify({'message': 'Bluetooth config updated successfully', 'node': node.to_dict()}), 200
+    return jsonify({'message': 'Bluetooth config updated successfully', 'node': node.to_dict(),
+                    'rollout_id': rollout.id}), 200
 
 @bp.route('/<node_id>/sensor-data', methods=['GET'])
 @token_required
@@ -197,16 +213,9 @@ def get_node_sensor_data(current_user, node_id):
     adc_type = request.args.get('adc_type')
     channel = request.args.get('channel', type=int)
     
-    query = SensorData.query.filter_by(node_id=node_id).order_by(SensorData.timestamp.desc())
+    data = sensor_store.samples(node_id=node_id, adc_type=adc_type, channel=channel, limit=limit)
     
-    if adc_type:
-        query = query.filter_by(adc_type=adc_type)
-    if channel is not None:
-        query = query.filter_by(channel=channel)
-    
-    data = query.limit(limit).all()
-    
-    return jsonify({'data': [d.to_dict() for d in data]}), 200
+    return jsonify({'data': data}), 200
 
 @bp.route('/<node_id>/qr-codes', methods=['GET'])
 @token_required
@@ -217,19 +226,16 @@ def get_node_qr_codes(current_user, node_id):
     limit = request.args.get('limit', 100, type=int)
     
     # Get distinct QR codes with timestamps
-    data = SensorData.query.filter(
-        SensorData.node_id == node_id,
-        SensorData.qr_code.isnot(None)
-    ).order_by(SensorData.timestamp.desc()).limit(limit).all()
+    data = sensor_store.qr_codes(node_id, limit)
     
     qr_codes = []
     seen = set()
-    for d in data:
-        if d.qr_code not in seen:
+    for qr_code, timestamp in data:
+        if qr_code not in seen:
             qr_codes.append({
-                'qr_code': d.qr_code,
-                'timestamp': d.timestamp.isoformat()
+                'qr_code': qr_code,
+                'timestamp': timestamp.isoformat()
             })
-            seen.add(d.qr_code)
+            seen.add(qr_code)
     
     return jsonify({'qr_codes': qr_codes}), 200
@@ -0,0 +1,52 @@
+"""
+MQTT outbox API endpoints
+"""
+from flask import Blueprint, request, jsonify
+from app.models.iot import OutboxMessage
+from app.api.auth import token_required
+from app.services.outbox import outbox
+
+bp = Blueprint('outbox', __name__)
+
+@bp.route('/', methods=['GET'])
+@token_required
+def get_messages(current_user):
+    """Get outbound messages with their delivery status, newest first"""
+    limit = request.args.get('limit', 100, type=int)
+    
+    query = OutboxMessage.query
+    for key in ('status', 'kind', 'gateway_id', 'reference'):
+        if request.args.get(key):
+            query = query.filter(getattr(OutboxMessage, key) == request.args[key])
+    
+    messages = query.order_by(OutboxMessage.created_at.desc()).limit(limit).all()
+    return jsonify({'messages': [message.to_dict() for message in messages]}), 200
+
+@bp.route('/stats', methods=['GET'])
+@token_required
+def get_outbox_stats(current_user):
+    """Get outbox counters and stored messages per status"""
+    return jsonify(dict(outbox.stats(), statuses=outbox.status_counts())), 200
+
+@bp.route('/<message_id>', methods=['GET'])
+@token_required
+def get_message(current_user, message_id):
+    """Get a message, including its payload"""
+    message = OutboxMessage.query.get_or_404(message_id)
+    return jsonify(message.to_dict(include_payload=True)), 200
+
+@bp.route('/<message_id>/<action>', methods=['POST'])
+@token_required
+def update_message(current_user, message_id, action):
+    """Retry a failed/expired message or cancel a queued one"""
+    actions = {'retry': outbox.retry, 'cancel': outbox.cancel}
+    if action not in actions:
+        return jsonify({'message': 'Action must be retry or cancel'}), 404
+    
+    message = OutboxMessage.query.get_or_404(message_id)
+    try:
+        actions[action](message)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 409
+    
+    return jsonify({'message': f"Message {message.status}", 'outbox_message': message.to_dict()}), 200
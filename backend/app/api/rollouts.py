@@ -0,0 +1,99 @@
+"""
+Node configuration rollout API endpoints
+"""
+from flask import Blueprint, request, jsonify
+from app import db
+from app.models.iot import ConfigRollout, ConfigRolloutTarget
+from app.api.auth import token_required
+from app.services.config_rollout import SELECTOR_KEYS, config_rollout
+
+bp = Blueprint('rollouts', __name__)
+
+@bp.route('/', methods=['GET'])
+@token_required
+def get_rollouts(current_user):
+    """Get rollouts with their progress, newest first"""
+    status = request.args.get('status')
+    limit = request.args.get('limit', 50, type=int)
+    
+    query = ConfigRollout.query
+    if status:
+        query = query.filter_by(status=status)
+    
+    rollouts = query.order_by(ConfigRollout.created_at.desc()).limit(limit).all()
+    return jsonify({'rollouts': [rollout.to_dict() for rollout in rollouts]}), 200
+
+@bp.route('/', methods=['POST'])
+@token_required
+def create_rollout(current_user):
+    """Create a rollout: nodes by site_id/gateway_ids/node_ids/status/node_type, optional config overrides"""
+    data = request.get_json()
+    
+    if not data or not data.get('name'):
+        return jsonify({'message': 'Name is required'}), 400
+    if not any(data.get(key) for key in ('site_id', 'gateway_ids', 'node_ids')):
+        return jsonify({'message': 'One of site_id, gateway_ids or node_ids is required'}), 400
+    if data.get('config') is not None and not isinstance(data['config'], dict):
+        return jsonify({'message': 'config must be an object with acquisition, conversions and/or bluetooth'}), 400
+    
+    try:
+        rollout = config_rollout.create(
+            data['name'],
+            config=data.get('config'),
+            selector={key: data.get(key) for key in SELECTOR_KEYS},
+            created_by=current_user.get('username'),
+            rate=data.get('rate'),
+            window=data.get('window'),
+            max_retries=data.get('max_retries'),
+            ack_timeout=data.get('ack_timeout'),
+            start=data.get('start', True)
+        )
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'message': str(e)}), 400
+    
+    return jsonify({'message': 'Rollout created successfully', 'rollout': rollout.to_dict()}), 201
+
+@bp.route('/stats', methods=['GET'])
+@token_required
+def get_rollout_stats(current_user):
+    """Get rollout engine counters"""
+    return jsonify(config_rollout.stats()), 200
+
+@bp.route('/<rollout_id>', methods=['GET'])
+@token_required
+def get_rollout(current_user, rollout_id):
+    """Get rollout details and progress"""
+    rollout = ConfigRollout.query.get_or_404(rollout_id)
+    return jsonify(rollout.to_dict()), 200
+
+@bp.route('/<rollout_id>/targets', methods=['GET'])
+@token_required
+def get_rollout_targets(current_user, rollout_id):
+    """Get the per-node state of a rollout"""
+    rollout = ConfigRollout.query.get_or_404(rollout_id)
+    status = request.args.get('status')
+    limit = request.args.get('limit', 500, type=int)
+    
+    query = rollout.targets
+    if status:
+        query = query.filter_by(status=status)
+    
+    targets = query.order_by(ConfigRolloutTarget.sent_at.desc()).limit(limit).all()
+    return jsonify({'targets': [target.to_dict() for target in targets], 'progress': rollout.progress()}), 200
+
+@bp.route('/<rollout_id>/<action>', methods=['POST'])
+@token_required
+def update_rollout_status(current_user, rollout_id, action):
+    """Pause, resume or cancel a rollout"""
+    statuses = {'pause': 'paused', 'resume': 'running', 'cancel': 'cancelled'}
+    if action not in statuses:
+        return jsonify({'message': 'Action must be pause, resume or cancel'}), 404
+    
+    rollout = ConfigRollout.query.get_or_404(rollout_id)
+    try:
+        config_rollout.set_status(rollout, statuses[action])
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 409
+    
+    return jsonify({'message': f"Rollout {statuses[action]}", 'rollout': rollout.to_dict()}), 200
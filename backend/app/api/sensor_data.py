@@ -3,9 +3,13 @@ Sensor Data API endpoints with CSV export
 """
 from flask import Blueprint, request, jsonify, Response
 from app import db
-from app.models.iot import SensorData, Node
 from app.api.auth import token_required
-from datetime import datetime, timedelta
+from app.models.iot import Gateway, Node, RetentionPolicy, Site
+from app.services.partitions import partition_router
+from app.services.retention import retention_engine
+from app.services.rollups import RESOLUTIONS, rollup_store
+from app.services.sensor_store import sensor_store
+from datetime import datetime, timedelta, timezone
 import csv
 import io
 
@@ -17,14 +21,68 @@ def get_latest_data(current_user):
     """Get latest sensor data for all nodes"""
     limit = request.args.get('limit', 100, type=int)
     
-    data = SensorData.query.order_by(SensorData.timestamp.desc()).limit(limit).all()
+    data = sensor_store.samples(limit=limit)
     
-    return jsonify({'data': [d.to_dict() for d in data]}), 200
+    return jsonify({'data': data}), 200
+
+def parse_date(value):
+    """An ISO 8601 query date as naive UTC (stored times are naive UTC); raises ValueError"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+# History tiers, finest first: raw samples, then the rollups that outlive them
+TIERS = ['raw'] + list(RESOLUTIONS)
+
+def history_sites(node_id=None, gateway_id=None, site_id=None):
+    """Sites a history query is restricted to (None: every site)"""
+    if site_id:
+        return [site_id]
+    if gateway_id:
+        query = db.session.query(Gateway.site_id).filter(Gateway.id == gateway_id)
+    elif node_id:
+        query = db.session.query(Gateway.site_id).join(Node, Node.gateway_id == Gateway.id).filter(Node.id == node_id)
+    else:
+        return None
+    return [site for site, in query] or None
+
+def stitched_history(resolution, filters, start, end, limit):
+    """History newest first, each part of the range from the finest tier still holding it: raw samples
+    back to the sites' retention, then the rollups kept longer; returns (data, tiers served)"""
+    tiers = TIERS[TIERS.index(resolution):] if rollup_store.supported(db.engine.dialect.name) else [resolution]
+    now = datetime.utcnow()
+    data = []
+    served = []
+    until = end  # Inclusive end of the next segment
+    for i, tier in enumerate(tiers):
+        # The last tier serves whatever it holds
+        boundary = None
+        if i + 1 < len(tiers) and tier == 'raw':
+            sites = history_sites(filters['node_id'], filters['gateway_id'], filters['site_id'])
+            boundary = retention_engine.raw_boundary(sites, now)
+        elif i + 1 < len(tiers):
+            boundary = rollup_store.boundary(tier, now)
+        since = max(start, boundary) if start and boundary else start or boundary
+        if since and until and since > until:
+            continue  # Expired before the range ends
+        
+        if tier == 'raw':
+            rows = sensor_store.samples(start=since, end=until, limit=limit - len(data), **filters)
+        else:
+            rows = sensor_store.rollups(tier, start=since, end=until, limit=limit - len(data), **filters)
+        data.extend(rows)
+        served.append({'resolution': tier, 'start': since.isoformat() if since else None,
+                       'end': until.isoformat() if until else None})
+        if len(data) >= limit or not since or (start and since <= start):
+            break
+        until = since - timedelta(microseconds=1)
+    return data, served
 
 @bp.route('/history', methods=['GET'])
 @token_required
 def get_sensor_history(current_user):
-    """Get sensor data history with filters"""
+    """Get sensor data history with filters, raw or as rollups (resolution=1m|15m|1h|auto, points=budget)"""
     # Parse query parameters
     node_id = request.args.get('node_id')
     gateway_id = request.args.get('gateway_id')
@@ -34,51 +92,52 @@ def get_sensor_history(current_user):
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
     limit = request.args.get('limit', 1000, type=int)
-    
-    query = SensorData.query
-    
-    # Filter by node
-    if node_id:
-        query = query.filter_by(node_id=node_id)
-    
-    # Filter by gateway (join with Node)
-    if gateway_id:
-        query = query.join(Node).filter(Node.gateway_id == gateway_id)
-    
-    # Filter by site (join with Node and Gateway)
-    if site_id:
-        from app.models.iot import Gateway
-        query = query.join(Node).join(Gateway).filter(Gateway.site_id == site_id)
-    
-    # Filter by ADC type
-    if adc_type:
-        query = query.filter_by(adc_type=adc_type)
-    
-    # Filter by channel
-    if channel is not None:
-        query = query.filter_by(channel=channel)
+    points = request.args.get('points', type=int)
+    resolution = request.args.get('resolution', 'auto' if points else 'raw')
+    if resolution not in ('raw', 'auto') and resolution not in RESOLUTIONS:
+        return jsonify({'message': f"resolution must be raw, auto or one of {', '.join(RESOLUTIONS)}"}), 400
     
     # Filter by date range
+    start_dt = end_dt = None
     if start_date:
         try:
-            start_dt = datetime.fromisoformat(start_date)
-            query = query.filter(SensorData.timestamp >= start_dt)
+            start_dt = parse_date(start_date)
         except ValueError:
             return jsonify({'message': 'Invalid start_date format'}), 400
     
     if end_date:
         try:
-            end_dt = datetime.fromisoformat(end_date)
-            query = query.filter(SensorData.timestamp <= end_dt)
+            end_dt = parse_date(end_date)
         except ValueError:
             return jsonify({'message': 'Invalid end_date format'}), 400
     
-    # Order and limit
-    data = query.order_by(SensorData.timestamp.desc()).limit(limit).all()
+    filters = {'node_id': node_id, 'gateway_id': gateway_id, 'site_id': site_id, 'adc_type': adc_type,
+               'channel': channel}
+    if resolution == 'raw':
+        # Samples joined back to node, ADC type, channel and unit (filters by site/gateway join Node/Gateway),
+        # continued by rollups before the raw retention
+        data, tiers = stitched_history('raw', filters, start_dt, end_dt, limit)
+    else:
+        # Rollups cover a bounded range: the last day unless given
+        end_dt = end_dt or datetime.utcnow()
+        start_dt = start_dt or end_dt - timedelta(days=1)
+        points = points or limit
+        if resolution == 'auto':
+            # Raw samples when they fit the budget, else the finest rollups that do
+            data, tiers = stitched_history('raw', filters, start_dt, end_dt, points + 1)
+            if len(data) <= points or not rollup_store.supported(db.engine.dialect.name):
+                data = data[:points]
+                resolution = 'raw'
+            else:
+                resolution = rollup_store.choose(start_dt, end_dt, sensor_store.series_count(**filters), points)
+        if resolution != 'raw':
+            data, tiers = stitched_history(resolution, filters, start_dt, end_dt, points)
     
     return jsonify({
-        'data': [d.to_dict() for d in data],
-        'count': len(data)
+        'data': data,
+        'count': len(data),
+        'resolution': resolution,
+        'tiers': tiers
     }), 200
 
 @bp.route('/export', methods=['GET'])
@@ -93,36 +152,22 @@ def export_sensor_data(current_user):
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
     
-    query = SensorData.query
-    
-    if node_id:
-        query = query.filter_by(node_id=node_id)
-    
-    if gateway_id:
-        query = query.join(Node).filter(Node.gateway_id == gateway_id)
-    
-    if adc_type:
-        query = query.filter_by(adc_type=adc_type)
-    
-    if channel is not None:
-        query = query.filter_by(channel=channel)
-    
+    start_dt = end_dt = None
     if start_date:
         try:
-            start_dt = datetime.fromisoformat(start_date)
-            query = query.filter(SensorData.timestamp >= start_dt)
+            start_dt = parse_date(start_date)
         except ValueError:
             return jsonify({'message': 'Invalid start_date format'}), 400
     
     if end_date:
         try:
-            end_dt = datetime.fromisoformat(end_date)
-            query = query.filter(SensorData.timestamp <= end_dt)
+            end_dt = parse_date(end_date)
         except ValueError:
             return jsonify({'message': 'Invalid end_date format'}), 400
     
     # Get data
-    data = query.order_by(SensorData.timestamp.desc()).all()
+    data = sensor_store.samples(node_id=node_id, gateway_id=gateway_id, adc_type=adc_type, channel=channel,
+                                start=start_dt, end=end_dt)
     
     # Create CSV
     output = io.StringIO()
@@ -137,14 +182,14 @@ def export_sensor_data(current_user):
     # Write data rows
     for d in data:
         writer.writerow([
-            d.timestamp.isoformat() if d.timestamp else '',
-            d.node_id,
-            d.adc_type,
-            d.channel,
-            d.raw_value,
-            d.converted_value,
-            d.unit,
-            d.qr_code or ''
+            d['timestamp'],
+            d['node_id'],
+            d['adc_type'],
+            d['channel'],
+            d['raw_value'],
+            d['converted_value'],
+            d['unit'],
+            d['qr_code'] or ''
         ])
     
     # Create response
@@ -160,13 +205,70 @@ def export_sensor_data(current_user):
 @bp.route('/cleanup', methods=['POST'])
 @token_required
 def cleanup_old_data(current_user):
-    """Cleanup sensor data older than 7 days"""
-    days = request.json.get('days', 7) if request.json else 7
+    """Start deleting sensor data older than each site's retention (or `days` for every site)"""
+    data = request.get_json(silent=True) or {}
+    days = data.get('days')
+    if days is not None and (not isinstance(days, int) or days < 0):
+        return jsonify({'message': 'days must be a non-negative integer'}), 400
+    
+    if not retention_engine.start(days=days, reason='manual'):
+        return jsonify({'message': 'Retention already running', 'retention': retention_engine.stats()}), 409
+    
+    return jsonify({
+        'message': 'Retention started',
+        'days': days,
+        'retention': retention_engine.stats()
+    }), 202
+
+@bp.route('/retention', methods=['GET'])
+@token_required
+def get_retention(current_user):
+    """Get the retention policies and the progress of the retention job"""
+    return jsonify({
+        'default_days': retention_engine.default_days,
+        'policies': [policy.to_dict() for policy in RetentionPolicy.query.all()],
+        'retention': retention_engine.stats()
+    }), 200
+
+@bp.route('/retention/<site_id>', methods=['PUT'])
+@token_required
+def set_site_retention(current_user, site_id):
+    """Set how many days a site's sensor data is kept"""
+    site = Site.query.get_or_404(site_id)
+    days = (request.get_json(silent=True) or {}).get('days')
+    if not isinstance(days, int) or days < 1:
+        return jsonify({'message': 'days must be a positive integer'}), 400
+    
+    policy = site.retention_policy or RetentionPolicy(site_id=site.id)
+    policy.days = days
+    db.session.add(policy)
+    db.session.commit()
     
-    deleted_count = SensorData.cleanup_old_data(days=days)
+    return jsonify({'message': 'Retention policy saved', 'policy': policy.to_dict()}), 200
+
+@bp.route('/retention/<site_id>', methods=['DELETE'])
+@token_required
+def delete_site_retention(current_user, site_id):
+    """Return a site to the default retention"""
+    policy = RetentionPolicy.query.get_or_404(site_id)
+    
+    db.session.delete(policy)
+    db.session.commit()
+    
+    return jsonify({'message': 'Retention policy removed', 'default_days': retention_engine.default_days}), 200
+
+@bp.route('/partitions', methods=['GET'])
+@token_required
+def get_partitions(current_user):
+    """List the time partitions of the sensor samples"""
+    connection = db.session.connection()
+    partitions = [
+        {'name': name, 'start': start.isoformat(), 'end': end.isoformat()}
+        for start, end, name in partition_router.partitions(connection)
+    ] if partition_router.mode(connection) else []
     
     return jsonify({
-        'message': f'Deleted {deleted_count} old sensor data records',
-        'deleted_count': deleted_count,
-        'days': days
+        'mode': partition_router.mode(connection),
+        'interval': partition_router.interval,
+        'partitions': partitions
     }), 200
@@ -5,6 +5,7 @@ from flask import Blueprint, request, jsonify
 from app import db
 from app.models.iot import Site
 from app.api.auth import token_required
+from app.services.registry import device_registry
 
 bp = Blueprint('sites', __name__)
 
@@ -68,6 +69,7 @@ def delete_site(current_user, site_id):
     
     db.session.delete(site)
     db.session.commit()
+    device_registry.clear()
     
     return jsonify({'message': 'Site deleted successfully'}), 200
 
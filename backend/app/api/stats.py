@@ -4,6 +4,7 @@ Statistics API endpoints
 from flask import Blueprint, jsonify
 from app import db
 from app.models import Device, Alert, Sensor
+from app.models.iot import NodeAlert
 from app.api.auth import token_required
 from datetime import datetime, timedelta
 
@@ -21,8 +22,9 @@ def get_dashboard_stats(current_user):
     nodes = Device.query.filter_by(type='node').count()
     
     # Alert counts
-    active_alerts = Alert.query.filter_by(status='active').count()
-    critical_alerts = Alert.query.filter(Alert.status == 'active', Alert.severity == 'critical').count()
+    active_alerts = Alert.query.filter_by(status='active').count() + NodeAlert.query.filter_by(status='active').count()
+    critical_alerts = Alert.query.filter(Alert.status == 'active', Alert.severity == 'critical').count() + \
+        NodeAlert.query.filter(NodeAlert.status == 'active', NodeAlert.severity == 'critical').count()
     
     # Recent activity
     recent_devices = Device.query.filter(
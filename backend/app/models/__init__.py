@@ -5,7 +5,7 @@ from datetime import datetime
 from app import db
 
 # Import new IoT models
-from app.models.iot import Site, Gateway, Node, SensorData
+from app.models.iot import Site, Gateway, Node, SensorSeries, SensorSample
 
 # Legacy models (keep for backward compatibility)
 class Device(db.Model):
@@ -3,15 +3,41 @@ Data models for APRU40 IoT system
 Multi-site architecture with Gateways and Nodes
 """
 from app import db
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import os
 import uuid
 from sqlalchemy.dialects.postgresql import UUID, JSON
 from sqlalchemy import Index
+from sqlalchemy.orm import declared_attr
+from sqlalchemy.types import TypeDecorator
+
+EPOCH = datetime(1970, 1, 1)
+
+# Sensor samples are partitioned by event time in periods of this many seconds (0: one table),
+# see app/services/partitions.py
+SAMPLE_PARTITION_INTERVAL = int(os.getenv('SENSOR_PARTITION_INTERVAL', 86400))
 
 # Helper function to generate UUIDs
 def generate_uuid():
     return str(uuid.uuid4())
 
+class EpochTime(TypeDecorator):
+    """Naive UTC datetime stored as integer microseconds since the epoch (8 bytes per
+    time-series key instead of a 26-character string on SQLite); aware datetimes are
+    converted to UTC"""
+    impl = db.BigInteger
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc).replace(tzinfo=None)
+            return (value - EPOCH) // timedelta(microseconds=1)
+        return value
+    
+    def process_result_value(self, value, dialect):
+        return None if value is None else EPOCH + timedelta(microseconds=value)
+
 class Site(db.Model):
     """Site/Location that contains gateways"""
     __tablename__ = 'sites'
@@ -25,6 +51,8 @@ class Site(db.Model):
     
     # Relations
     gateways = db.relationship('Gateway', backref='site', lazy='dynamic', cascade='all, delete-orphan')
+    retention_policy = db.relationship('RetentionPolicy', backref='site', uselist=False,
+                                       cascade='all, delete-orphan')
     
     def to_dict(self):
         return {
@@ -121,6 +149,10 @@ class Node(db.Model):
     battery_level = db.Column(db.Float)
     battery_powered = db.Column(db.Boolean, default=False)
     
+    # Configuration last acknowledged by the node (config rollouts diff against it)
+    config_hash = db.Column(db.String(64))
+    config_acked_at = db.Column(db.DateTime)
+    
     # Metadata
     description = db.Column(db.Text)
     manufacturer = db.Column(db.String(100))
@@ -160,6 +192,8 @@ class Node(db.Model):
             'firmware_version': self.firmware_version,
             'battery_level': self.battery_level,
             'battery_powered': self.battery_powered,
+            'config_hash': self.config_hash,
+            'config_acked_at': self.config_acked_at.isoformat() if self.config_acked_at else None,
             'description': self.description,
             'manufacturer': self.manufacturer,
             'model': self.model,
@@ -170,42 +204,303 @@ class Node(db.Model):
             'updated_at': self.updated_at.isoformat() if self.updated_at else None
         }
 
-class SensorData(db.Model):
-    """Time-series sensor data from nodes"""
-    __tablename__ = 'sensor_data'
+class SensorSeries(db.Model):
+    """Series dictionary: one node ADC channel in one unit, referenced by sensor_samples"""
+    __tablename__ = 'sensor_series'
     
-    id = db.Column(db.String(36), primary_key=True, default=generate_uuid)
+    id = db.Column(db.Integer, primary_key=True)
     node_id = db.Column(db.String(36), db.ForeignKey('nodes.id'), nullable=False)
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
     adc_type = db.Column(db.String(20), nullable=False)  # ADS7128, ADS1119_1, ADS1119_2
     channel = db.Column(db.Integer, nullable=False)
-    raw_value = db.Column(db.Integer)
-    converted_value = db.Column(db.Float)
-    unit = db.Column(db.String(10))
-    qr_code = db.Column(db.String(64))  # Associated QR code if scanned
+    unit = db.Column(db.String(10), nullable=False, default='')  # '' for readings without a unit
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     __table_args__ = (
-        Index('idx_sensor_data_node_timestamp', 'node_id', 'timestamp'),
-        Index('idx_sensor_data_timestamp', 'timestamp'),
+        Index('uq_sensor_series', 'node_id', 'adc_type', 'channel', 'unit', unique=True),
     )
     
     def to_dict(self):
         return {
             'id': self.id,
             'node_id': self.node_id,
-            'timestamp': self.timestamp.isoformat() if self.timestamp else None,
             'adc_type': self.adc_type,
             'channel': self.channel,
-            'raw_value': self.raw_value,
-            'converted_value': self.converted_value,
-            'unit': self.unit,
-            'qr_code': self.qr_code
+            'unit': self.unit or None,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class SensorSample(db.Model):
+    """Time-series sensor sample: one reading of a series (node, adc_type, channel and unit
+    live in sensor_series, see app/services/sensor_store.py)"""
+    __tablename__ = 'sensor_samples'
+    
+    series_id = db.Column(db.Integer, db.ForeignKey('sensor_series.id'), primary_key=True)
+    timestamp = db.Column(EpochTime, primary_key=True)  # Event time
+    # Gateway payload timestamp (duplicate detection), the event time for messages without one
+    device_timestamp = db.Column(EpochTime, primary_key=True)
+    raw_value = db.Column(db.Integer)
+    converted_value = db.Column(db.Float)
+    
+    __table_args__ = (
+        Index('idx_sensor_samples_timestamp', 'timestamp'),
+        # One row per reading: only this index decides what is a duplicate (readings of a series
+        # sharing an event time keep their own primary key). A partitioned PostgreSQL table cannot
+        # hold a unique index without the partition key: each partition has its own
+        Index('uq_sensor_samples_reading', 'series_id', 'device_timestamp', unique=True).ddl_if(
+            callable_=lambda ddl, target, bind, dialect=None, **kw:
+                not (SAMPLE_PARTITION_INTERVAL and dialect.name == 'postgresql')),
+        # SQLite: rows are stored in primary key order, without a rowid and its separate index.
+        # PostgreSQL: native range partitions on the event time (SQLite: one table per partition)
+        {'sqlite_with_rowid': False,
+         'postgresql_partition_by': 'RANGE (timestamp)' if SAMPLE_PARTITION_INTERVAL else None},
+    )
+
+class NodeQrCode(db.Model):
+    """QR code reported by a node's scanner along with a data message"""
+    __tablename__ = 'node_qr_codes'
+    
+    node_id = db.Column(db.String(36), db.ForeignKey('nodes.id'), primary_key=True)
+    timestamp = db.Column(EpochTime, primary_key=True)  # Event time of the message
+    device_timestamp = db.Column(EpochTime, primary_key=True)  # As in sensor_samples
+    qr_code = db.Column(db.String(64), nullable=False)
+    
+    __table_args__ = (
+        Index('uq_node_qr_codes_reading', 'node_id', 'device_timestamp', unique=True),
+        {'sqlite_with_rowid': False},
+    )
+
+class SensorRollup:
+    """Aggregate of a series' converted values over one bucket (count, min, max, sum and the
+    first and last value with their times), maintained by the ingest writer, see
+    app/services/rollups.py"""
+    series_id = db.Column(db.Integer, db.ForeignKey('sensor_series.id'), primary_key=True)
+    bucket = db.Column(EpochTime, primary_key=True)  # Start of the bucket
+    count = db.Column(db.Integer, nullable=False)
+    min = db.Column(db.Float)
+    max = db.Column(db.Float)
+    sum = db.Column(db.Float)
+    first = db.Column(db.Float)
+    first_at = db.Column(EpochTime)
+    last = db.Column(db.Float)
+    last_at = db.Column(EpochTime)
+    
+    @declared_attr.directive
+    def __table_args__(cls):
+        return (
+            Index(f'idx_{cls.__tablename__}_bucket', 'bucket'),
+            {'sqlite_with_rowid': False},
+        )
+
+class SensorRollup1m(SensorRollup, db.Model):
+    """1-minute rollups"""
+    __tablename__ = 'sensor_rollups_1m'
+
+class SensorRollup15m(SensorRollup, db.Model):
+    """15-minute rollups"""
+    __tablename__ = 'sensor_rollups_15m'
+
+class SensorRollup1h(SensorRollup, db.Model):
+    """1-hour rollups"""
+    __tablename__ = 'sensor_rollups_1h'
+
+class RetentionPolicy(db.Model):
+    """Sensor data retention of a site (sites without a policy keep SENSOR_RETENTION_DAYS)"""
+    __tablename__ = 'retention_policies'
+    
+    site_id = db.Column(db.String(36), db.ForeignKey('sites.id'), primary_key=True)
+    days = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'site_id': self.site_id,
+            'site_name': self.site.name if self.site else None,
+            'days': self.days,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+class NodeAlert(db.Model):
+    """Alert raised by a gateway or one of its nodes (apru40/{gateway}/alert/#)"""
+    __tablename__ = 'node_alerts'
+    
+    id = db.Column(db.String(36), primary_key=True, default=generate_uuid)
+    gateway_id = db.Column(db.String(36), db.ForeignKey('gateways.id'), nullable=False)
+    node_id = db.Column(db.String(36), db.ForeignKey('nodes.id'))  # None for gateway alerts
+    alert_type = db.Column(db.String(50), nullable=False)  # tamper, bt_unauthorized, battery_low...
+    severity = db.Column(db.String(20), nullable=False, default='medium')  # critical, high, medium, low
+    message = db.Column(db.Text)
+    details = db.Column(JSON)  # Alert payload as received
+    status = db.Column(db.String(20), default='active')  # active, acknowledged, resolved
+    occurrences = db.Column(db.Integer, default=1)  # Repeats folded in during the suppression window
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_seen_at = db.Column(db.DateTime)
+    resolved_at = db.Column(db.DateTime)
+    
+    # Relations
+    gateway = db.relationship('Gateway', backref=db.backref('alerts', lazy='dynamic', cascade='all, delete-orphan'))
+    node = db.relationship('Node', backref=db.backref('alerts', lazy='dynamic', cascade='all, delete-orphan'))
+    
+    __table_args__ = (
+        Index('idx_node_alert_status_created', 'status', 'created_at'),
+        Index('idx_node_alert_gateway_created', 'gateway_id', 'created_at'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'gateway_id': self.gateway_id,
+            'gateway_name': self.gateway.name if self.gateway else None,
+            'node_id': self.node_id,
+            'node_name': self.node.name if self.node else None,
+            'alert_type': self.alert_type,
+            'severity': self.severity,
+            'message': self.message,
+            'details': self.details,
+            'status': self.status,
+            'occurrences': self.occurrences,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'last_seen_at': self.last_seen_at.isoformat() if self.last_seen_at else None,
+            'resolved_at': self.resolved_at.isoformat() if self.resolved_at else None
         }
+
+class ConfigRollout(db.Model):
+    """Configuration pushed to a set of nodes at a limited rate, with per-node acknowledgements"""
+    __tablename__ = 'config_rollouts'
+    
+    id = db.Column(db.String(36), primary_key=True, default=generate_uuid)
+    name = db.Column(db.String(100), nullable=False)
+    config = db.Column(JSON)  # Overrides merged into each node's config: {acquisition, conversions, bluetooth}
+    selector = db.Column(JSON)  # {site_id, gateway_ids, node_ids, status, node_type} as requested
+    status = db.Column(db.String(20), default='running')  # running, paused, completed, cancelled
+    rate = db.Column(db.Float, nullable=False)  # Config messages per second
+    window = db.Column(db.Integer, nullable=False)  # Config messages awaiting acknowledgement at most
+    max_retries = db.Column(db.Integer, nullable=False)
+    ack_timeout = db.Column(db.Float, nullable=False)  # Seconds before an unacknowledged message is retried
+    created_by = db.Column(db.String(50))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+    
+    # Relations
+    targets = db.relationship('ConfigRolloutTarget', backref='rollout', lazy='dynamic', cascade='all, delete-orphan')
+    
+    __table_args__ = (
+        Index('idx_config_rollout_status', 'status'),
+    )
+    
+    def progress(self):
+        """Count targets per status"""
+        counts = dict.fromkeys(ConfigRolloutTarget.STATUSES, 0)
+        counts.update(db.session.query(ConfigRolloutTarget.status, db.func.count(ConfigRolloutTarget.id)).filter(
+            ConfigRolloutTarget.rollout_id == self.id).group_by(ConfigRolloutTarget.status).all())
+        counts['total'] = sum(counts.values())
+        done = counts['total'] - counts['pending'] - counts['sent']
+        counts['percent'] = round(100.0 * done / counts['total'], 1) if counts['total'] else 100.0
+        return counts
     
-    @staticmethod
-    def cleanup_old_data(days=7):
-        """Delete sensor data older than specified days"""
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        deleted = SensorData.query.filter(SensorData.timestamp < cutoff_date).delete()
-        db.session.commit()
-        return deleted
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'config': self.config,
+            'selector': self.selector,
+            'status': self.status,
+            'rate': self.rate,
+            'window': self.window,
+            'max_retries': self.max_retries,
+            'ack_timeout': self.ack_timeout,
+            'created_by': self.created_by,
+            'progress': self.progress(),
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+class ConfigRolloutTarget(db.Model):
+    """One node of a config rollout"""
+    __tablename__ = 'config_rollout_targets'
+    
+    STATUSES = ('pending', 'sent', 'acked', 'skipped', 'failed', 'cancelled')
+    
+    id = db.Column(db.String(36), primary_key=True, default=generate_uuid)  # config_id in the config message
+    rollout_id = db.Column(db.String(36), db.ForeignKey('config_rollouts.id'), nullable=False)
+    node_id = db.Column(db.String(36), db.ForeignKey('nodes.id'), nullable=False)
+    status = db.Column(db.String(20), default='pending')  # skipped: node already acknowledged this config
+    config_hash = db.Column(db.String(64))  # Hash of the config sent
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.String(200))
+    sent_at = db.Column(db.DateTime)
+    acked_at = db.Column(db.DateTime)
+    
+    # Relations
+    node = db.relationship('Node', backref=db.backref('rollout_targets', lazy='dynamic', cascade='all, delete-orphan'))
+    
+    __table_args__ = (
+        Index('idx_rollout_target_rollout_status', 'rollout_id', 'status'),
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'rollout_id': self.rollout_id,
+            'node_id': self.node_id,
+            'node_name': self.node.name if self.node else None,
+            'status': self.status,
+            'config_hash': self.config_hash,
+            'attempts': self.attempts,
+            'error': self.error,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None,
+            'acked_at': self.acked_at.isoformat() if self.acked_at else None
+        }
+
+class OutboxMessage(db.Model):
+    """Outbound MQTT message (command, node config) awaiting or tracking broker delivery"""
+    __tablename__ = 'mqtt_outbox'
+    
+    STATUSES = ('queued', 'inflight', 'delivered', 'failed', 'expired', 'superseded', 'cancelled')
+    
+    id = db.Column(db.String(36), primary_key=True, default=generate_uuid)
+    kind = db.Column(db.String(20), nullable=False)  # command, config
+    topic = db.Column(db.String(200), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    qos = db.Column(db.Integer, default=1)
+    properties = db.Column(JSON)  # MQTT v5 properties (ResponseTopic, CorrelationData)
+    gateway_id = db.Column(db.String(50))  # Gateway identifier (GW001)
+    reference = db.Column(db.String(64))  # correlation_id of a command, config_id of a config
+    key = db.Column(db.String(100))  # A newer message with the same key supersedes a queued one
+    status = db.Column(db.String(20), default='queued')
+    attempts = db.Column(db.Integer, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    error = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+    delivered_at = db.Column(db.DateTime)  # Broker acknowledgement (PUBACK)
+    expires_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        Index('idx_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+        Index('idx_outbox_key', 'key'),
+        Index('idx_outbox_reference', 'reference'),
+        Index('idx_outbox_created', 'created_at'),
+    )
+    
+    def to_dict(self, include_payload=False):
+        data = {
+            'id': self.id,
+            'kind': self.kind,
+            'topic': self.topic,
+            'qos': self.qos,
+            'gateway_id': self.gateway_id,
+            'reference': self.reference,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'sent_at': self.sent_at.isoformat() if self.sent_at else None,
+            'delivered_at': self.delivered_at.isoformat() if self.delivered_at else None,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None
+        }
+        if include_payload:
+            data['payload'] = self.payload
+        return data
@@ -0,0 +1,244 @@
+"""
+Alert pipeline for apru40/+/alert/#
+MQTTService.handle_alert (on the alert lane thread) hands decoded alerts to the
+pipeline. Repeats of an alert - same gateway, node and type - within
+ALERT_SUPPRESS_WINDOW seconds of its first occurrence are folded into that
+alert's occurrence count, so a storm from a misbehaving site costs a dict lookup
+per message. A writer thread batch-inserts new alerts into node_alerts and
+batch-updates occurrence counts every ALERT_FLUSH_INTERVAL_MS, then emits
+alert:new for at most ALERT_EMIT_RATE new alerts per second; the rest of a
+flush is announced by one alert:throttled event. At most ALERT_MAX_PENDING new
+alerts wait for a flush, further ones are dropped and counted.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import bindparam
+from app import db
+from app.models.iot import NodeAlert, generate_uuid
+from app.services.metrics import metrics
+from app.services.registry import device_registry
+from app.services.websocket import emit_event
+
+SEVERITIES = ('critical', 'high', 'medium', 'low')
+
+DB_WRITE_SECONDS = metrics.histogram('apru40_db_write_seconds', 'Bulk INSERT/UPDATE statement duration', ['table'])
+DB_COMMIT_SECONDS = metrics.histogram('apru40_db_commit_seconds', 'Commit duration', ['source'])
+
+class AlertPipeline:
+    def __init__(self, app=None):
+        self.app = app
+        self.suppress_window = float(os.getenv('ALERT_SUPPRESS_WINDOW', 300))
+        self.flush_interval = int(os.getenv('ALERT_FLUSH_INTERVAL_MS', 250)) / 1000.0
+        self.max_pending = int(os.getenv('ALERT_MAX_PENDING', 5000))
+        self.emit_rate = float(os.getenv('ALERT_EMIT_RATE', 10))
+        self.emit_enabled = True
+        self._lock = threading.Lock()
+        self._open = {}       # (gateway PK, node PK, alert type) -> (alert id, first seen)
+        self._new = []        # (row, gateway_id, node number) waiting for insert
+        self._repeats = {}    # alert id -> {'alert_id', 'repeats', 'seen_at'} waiting for update
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._tokens = self.emit_rate
+        self._tokens_at = time.monotonic()
+        
+        # Counters
+        self.alerts_received = 0
+        self.alerts_created = 0
+        self.alerts_suppressed = 0
+        self.alerts_dropped = 0
+        self.events_emitted = 0
+        self.events_throttled = 0
+        self.flushes = 0
+        self.errors = 0
+    
+    def submit(self, gateway_identifier, alert_path, payload, received_at=None):
+        """Record one decoded alert; returns its alert id (the open one for a repeat), None if dropped"""
+        if not isinstance(payload, dict):
+            raise ValueError('Alert payload must be a JSON object')
+        
+        gateway_pk = device_registry.resolve_gateway(gateway_identifier)
+        if gateway_pk is None:
+            device_registry.report_unknown(f"Alert from unknown gateway: {gateway_identifier}")
+            return None
+        
+        node_number = payload.get('device_id') if payload.get('device_type', 'node') == 'node' else None
+        node_pk = device_registry.resolve_node(gateway_pk, node_number) if node_number is not None else None
+        alert_type = str(payload.get('type') or alert_path.rsplit('/', 1)[-1] or 'unknown')[:50]
+        severity = payload.get('priority') or payload.get('severity')
+        if severity not in SEVERITIES:
+            severity = 'medium'
+        received_at = received_at or datetime.utcnow()
+        key = (gateway_pk, node_pk, alert_type)
+        
+        with self._lock:
+            self.alerts_received += 1
+            current = self._open.get(key)
+            if current and (received_at - current[1]).total_seconds() < self.suppress_window:
+                repeat = self._repeats.get(current[0])
+                if repeat is None:
+                    repeat = self._repeats[current[0]] = {'alert_id': current[0], 'repeats': 0}
+                repeat['repeats'] += 1
+                repeat['seen_at'] = received_at
+                self.alerts_suppressed += 1
+                return current[0]
+            
+            if len(self._new) >= self.max_pending:
+                self.alerts_dropped += 1
+                return None
+            
+            alert_id = generate_uuid()
+            self._open[key] = (alert_id, received_at)
+            self._new.append(({
+                'id': alert_id,
+                'gateway_id': gateway_pk,
+                'node_id': node_pk,
+                'alert_type': alert_type,
+                'severity': severity,
+                'message': payload.get('description') or payload.get('message'),
+                'details': payload,
+                'status': 'active',
+                'occurrences': 1,
+                'created_at': received_at,
+                'last_seen_at': received_at
+            }, gateway_identifier, node_number))
+            return alert_id
+    
+    def forget(self, alert_id):
+        """End suppression for an alert (acknowledged/resolved), so its next occurrence is a new alert"""
+        with self._lock:
+            for key, (open_id, _) in list(self._open.items()):
+                if open_id == alert_id:
+                    del self._open[key]
+    
+    def start(self):
+        """Start the writer thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='alert-writer', daemon=True)
+        self._thread.start()
+        print(f"✓ Alert pipeline started (suppress {self.suppress_window:g}s, "
+              f"flush={int(self.flush_interval * 1000)}ms, emit<={self.emit_rate:g}/s)")
+    
+    def stop(self, timeout=10):
+        """Stop the writer thread after writing pending alerts"""
+        if not self._thread:
+            return
+        
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+    
+    def stats(self):
+        """Get pipeline counters"""
+        return {
+            'pending_alerts': len(self._new),
+            'pending_repeats': len(self._repeats),
+            'open_alerts': len(self._open),
+            'suppress_window': self.suppress_window,
+            'emit_rate': self.emit_rate,
+            'alerts_received': self.alerts_received,
+            'alerts_created': self.alerts_created,
+            'alerts_suppressed': self.alerts_suppressed,
+            'alerts_dropped': self.alerts_dropped,
+            'events_emitted': self.events_emitted,
+            'events_throttled': self.events_throttled,
+            'flushes': self.flushes,
+            'errors': self.errors
+        }
+    
+    def _run(self):
+        """Writer loop: flush every flush_interval, then once more on stop"""
+        with self.app.app_context():
+            while not self._stop_event.wait(self.flush_interval):
+                self.flush()
+            self.flush()
+    
+    def flush(self):
+        """Insert new alerts and add repeats to open ones in one transaction, then emit"""
+        with self._lock:
+            new, self._new = self._new, []
+            repeats, self._repeats = self._repeats, {}
+            # Suppression entries whose window has passed
+            horizon = datetime.utcnow()
+            for key, (_, first_seen) in list(self._open.items()):
+                if (horizon - first_seen).total_seconds() >= self.suppress_window:
+                    del self._open[key]
+        
+        if not new and not repeats:
+            return 0
+        
+        try:
+            started = time.perf_counter()
+            alerts = NodeAlert.__table__
+            if new:
+                db.session.execute(alerts.insert(), [row for row, _, _ in new])
+            if repeats:
+                db.session.execute(
+                    alerts.update().where(alerts.c.id == bindparam('alert_id')).values(
+                        occurrences=alerts.c.occurrences + bindparam('repeats'),
+                        last_seen_at=bindparam('seen_at')
+                    ),
+                    list(repeats.values())
+                )
+            written = time.perf_counter()
+            db.session.commit()
+            DB_WRITE_SECONDS.observe(written - started, 'node_alerts')
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - written, 'alert_pipeline')
+        
+        except Exception as e:
+            self.errors += 1
+            print(f"Error writing alerts: {e}")
+            db.session.rollback()
+            # Retry with the next flush (repeats arriving meanwhile are merged)
+            with self._lock:
+                self._new = (new + self._new)[:self.max_pending]
+                for alert_id, repeat in repeats.items():
+                    pending = self._repeats.get(alert_id)
+                    if pending:
+                        pending['repeats'] += repeat['repeats']
+                    else:
+                        self._repeats[alert_id] = repeat
+            return 0
+        
+        self.alerts_created += len(new)
+        self.flushes += 1
+        if self.emit_enabled and new:
+            self._emit(new)
+        return len(new)
+    
+    def _emit(self, new):
+        """Emit alert:new within the ALERT_EMIT_RATE token bucket, then one alert:throttled for the rest"""
+        now = time.monotonic()
+        self._tokens = min(self.emit_rate, self._tokens + (now - self._tokens_at) * self.emit_rate)
+        self._tokens_at = now
+        
+        throttled = 0
+        for row, gateway_identifier, node_number in new:
+            if self._tokens < 1:
+                throttled += 1
+                continue
+            self._tokens -= 1
+            self.events_emitted += 1
+            emit_event('alert:new', {
+                'id': row['id'],
+                'gateway_id': gateway_identifier,
+                'node_id': node_number,
+                'alert_type': row['alert_type'],
+                'severity': row['severity'],
+                'message': row['message'],
+                'timestamp': row['created_at'].isoformat()
+            })
+        
+        if throttled:
+            self.events_throttled += throttled
+            emit_event('alert:throttled', {
+                'count': throttled,
+                'timestamp': datetime.utcnow().isoformat()
+            })
+
+# Global alert pipeline instance
+alert_pipeline = AlertPipeline()
@@ -0,0 +1,347 @@
+"""
+Asyncio ingest engine (INGEST_ENGINE=asyncio)
+Alternative to the paho thread + writer thread pipeline: one event loop, in its
+own thread, consumes the gateway data/status topics with an async MQTT client
+(aiomqtt) and writer tasks await batched INSERTs on an SQLAlchemy async engine
+(aiosqlite / asyncpg), so many gateways and several in-flight batches share a
+thread without blocking on the network or the database. Routing, decoding,
+the bounded data queue and its overflow policy, heartbeats and the alert/status
+lanes are those of MQTTService; only data messages stay on the loop. Preparing
+a batch (registry cache misses, series id lookups and new series, all
+synchronous) runs on a prepare thread, which commits the new series before the
+samples referencing them are inserted on the async connection.
+    
+    pip install -r requirements-asyncio.txt
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from sqlalchemy.ext.asyncio import create_async_engine
+from app import db
+from app.services.catchup import catchup
+from app.services.dedup import duplicate_filter
+from app.services.ingest import (BATCH_MESSAGES, BATCH_ROWS, DB_COMMIT_SECONDS, DB_WRITE_SECONDS,
+                                 emit_sensor_data, observe_committed, prepare_batch)
+from app.services.ingest_queue import queue_from_env
+from app.services.inproc_broker import InProcessClient, inproc_broker
+from app.services.mqtt_service import mqtt_service
+from app.services.sensor_store import SampleBatch, sensor_store
+
+try:
+    import aiomqtt
+except ImportError:  # pragma: no cover - optional dependency
+    aiomqtt = None
+
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg', 'postgres': 'postgresql+asyncpg'}
+RECONNECT_DELAY = 5
+
+def async_database_url(url):
+    """Map a database URL to its asyncio driver (sqlite:///x.db -> sqlite+aiosqlite:///x.db)"""
+    scheme, separator, rest = url.partition('://')
+    driver = ASYNC_DRIVERS.get(scheme.split('+')[0])
+    return driver + separator + rest if driver else url
+
+class AsyncIngestEngine:
+    def __init__(self, app=None):
+        self.app = app
+        self.batch_size = int(os.getenv('INGEST_BATCH_SIZE', 200))
+        self.flush_interval = int(os.getenv('INGEST_FLUSH_INTERVAL_MS', 250)) / 1000.0
+        # Concurrent batches in flight (SQLite serialises writers, so it always gets one)
+        self.writers = int(os.getenv('INGEST_ASYNC_WRITERS', 4))
+        # Same data lane settings as the threaded writer; 'block' awaits room instead of blocking
+        self.queue = queue_from_env('data', 'INGEST', 10000, 'drop-oldest')
+        self.emit_enabled = True
+        self._thread = None
+        self._loop = None
+        self._executor = None  # Prepare thread
+        self._started = threading.Event()
+        self._stop_event = None
+        self._available = None
+        self._room = None
+        self._stopping = False
+        self._writer_count = 0
+        
+        # Counters
+        self.messages_received = 0
+        self.messages_written = 0
+        self.rows_written = 0
+        self.batches_written = 0
+        self.errors = 0
+    
+    def start(self):
+        """Start the event loop thread, connect and subscribe"""
+        if self._thread and self._thread.is_alive():
+            return
+        if aiomqtt is None and mqtt_service.transport != 'inproc':
+            print("✗ INGEST_ENGINE=asyncio needs aiomqtt (pip install -r requirements-asyncio.txt), ingest not started")
+            return
+        
+        self._started.clear()
+        self._thread = threading.Thread(target=self._run_loop, name='async-ingest', daemon=True)
+        self._thread.start()
+        self._started.wait(10)
+        if self._thread.is_alive():
+            print(f"✓ Asyncio ingest engine started (batch={self.batch_size}, "
+                  f"flush={int(self.flush_interval * 1000)}ms, writers={self._writer_count})")
+    
+    def stop(self, timeout=10):
+        """Stop consuming, then drain the queue and stop the loop thread"""
+        if not self._thread:
+            return
+        
+        if self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+        self._thread.join(timeout)
+        self._thread = None
+    
+    def stats(self):
+        """Get engine counters (same fields as SensorDataWriter.stats)"""
+        return {
+            'engine': 'asyncio',
+            'queue_depth': self.queue.qsize(),
+            'queue_capacity': self.queue.maxsize,
+            'overflow_policy': self.queue.policy,
+            'batch_size': self.batch_size,
+            'flush_interval_ms': int(self.flush_interval * 1000),
+            'writers': self._writer_count,
+            'messages_received': self.messages_received,
+            'messages_dropped': self.queue.dropped + self.queue.sampled_out,
+            'messages_written': self.messages_written,
+            'rows_written': self.rows_written,
+            'batches_written': self.batches_written,
+            'errors': self.errors
+        }
+    
+    def _run_loop(self):
+        try:
+            with self.app.app_context():
+                asyncio.run(self.run())
+        except Exception as e:
+            print(f"✗ Asyncio ingest engine failed: {e}")
+        finally:
+            self._started.set()
+    
+    async def run(self):
+        """Consume until stopped, then let the writer tasks drain the queue"""
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._available = asyncio.Event()
+        self._room = asyncio.Event()
+        self._stopping = False
+        
+        url = async_database_url(self.app.config['SQLALCHEMY_DATABASE_URI'])
+        engine = create_async_engine(url)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='async-ingest-prepare')
+        self._writer_count = 1 if url.startswith('sqlite') else max(1, self.writers)
+        writers = [asyncio.create_task(self._write_loop(engine)) for _ in range(self._writer_count)]
+        try:
+            await self._consume()
+        finally:
+            self._stopping = True
+            self._available.set()
+            await asyncio.gather(*writers)
+            await engine.dispose()
+            self._executor.shutdown()
+    
+    async def _consume(self):
+        """Receive the ingest topics until the stop event is set"""
+        topics = mqtt_service.ingest_subscriptions()
+        client_id = mqtt_service.session_client_id()
+        identifier = f"{client_id}-async" if client_id else None
+        persistent = mqtt_service.persistent_session
+        
+        if mqtt_service.transport == 'inproc':
+            # The in-process broker delivers on the publisher's thread: hand messages to the loop
+            client = InProcessClient(inproc_broker, client_id=identifier or '', clean_session=not persistent)
+            client.on_message = lambda client, userdata, message: self._loop.call_soon_threadsafe(
+                self._receive_nowait, message.topic, message.payload, datetime.utcnow()
+            )
+            client.connect()
+            for topic in topics:
+                client.subscribe(topic, qos=mqtt_service.subscribe_qos)
+            self._started.set()
+            await self._stop_event.wait()
+            client.disconnect()
+            return
+        
+        # Same protocol as MQTTService.connect (v5 unless MQTT_PROTOCOL=3.1.1, always for ingest workers)
+        protocol = aiomqtt.ProtocolVersion.V5 if mqtt_service.mqtt_v5 else aiomqtt.ProtocolVersion.V311
+        # Persistent session as MQTTService.connect: clean_session on v3.1.1, clean_start + expiry on v5
+        session = ({'clean_start': not persistent, 'properties': mqtt_service.connect_properties()}
+                   if protocol == aiomqtt.ProtocolVersion.V5 else {'clean_session': not persistent})
+        while not self._stop_event.is_set():
+            try:
+                async with aiomqtt.Client(
+                    mqtt_service.broker, mqtt_service.port,
+                    username=mqtt_service.username or None,
+                    password=mqtt_service.password or None,
+                    identifier=identifier,
+                    protocol=protocol,
+                    keepalive=mqtt_service.keepalive,
+                    **session
+                ) as client:
+                    for topic in topics:
+                        await client.subscribe(topic, qos=mqtt_service.subscribe_qos)
+                    print(f"✓ Asyncio ingest engine subscribed at {mqtt_service.endpoint()}")
+                    self._started.set()
+                    
+                    receiver = asyncio.create_task(self._receive_all(client))
+                    stopper = asyncio.create_task(self._stop_event.wait())
+                    done, _ = await asyncio.wait({receiver, stopper}, return_when=asyncio.FIRST_COMPLETED)
+                    receiver.cancel()
+                    stopper.cancel()
+                    if receiver in done:
+                        receiver.result()
+            except aiomqtt.MqttError as e:
+                self._started.set()
+                print(f"✗ Asyncio ingest MQTT error: {e}, reconnecting in {RECONNECT_DELAY}s")
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), RECONNECT_DELAY)
+                except asyncio.TimeoutError:
+                    pass
+    
+    async def _receive_all(self, client):
+        async for message in client.messages:
+            item = self._dispatch(message.topic.value, message.payload, datetime.utcnow())
+            if item is not None:
+                await self._enqueue(item)
+    
+    def _receive_nowait(self, topic, raw, received_at):
+        """Handle one message on the loop without awaiting (in-process transport)"""
+        item = self._dispatch(topic, raw, received_at)
+        if item is None:
+            return
+        if self.queue.policy == 'block' and self.queue.qsize() >= self.queue.maxsize:
+            asyncio.ensure_future(self._enqueue(item))
+        else:
+            self._put(item)
+    
+    def _dispatch(self, topic, raw, received_at):
+        """Route and decode a message; data messages are returned for the queue, others handled"""
+        try:
+            message = mqtt_service.decode_message(topic, raw)
+            if message is None:
+                return None
+            
+            kind, handler, lane, payload, params = message
+            if handler == mqtt_service.handle_sensor_data:
+                self.messages_received += 1
+                return params['gateway_id'], payload, received_at
+            if lane is not None:
+                lane.submit(handler, topic, payload, params)
+            else:
+                handler(topic, payload, **params)
+        
+        except Exception as e:
+            print(f"Error processing MQTT message: {e}")
+        return None
+    
+    async def _enqueue(self, item):
+        """Queue a data message; with the 'block' policy await room (the broker buffers meanwhile)"""
+        if self.queue.policy == 'block' and self.queue.qsize() >= self.queue.maxsize:
+            self.queue.blocked += 1
+            while self.queue.qsize() >= self.queue.maxsize:
+                self._room.clear()
+                await self._room.wait()
+        self._put(item)
+    
+    def _put(self, item):
+        # Only the loop thread touches this queue, so a non-full 'block' queue never blocks here
+        if self.queue.put(item, key=item[0]):
+            self._available.set()
+    
+    async def _write_loop(self, engine):
+        """Writer task: write batches until stopped and the queue is empty"""
+        while not self._stopping or not self.queue.empty():
+            # Larger batches while draining a backlog (see catchup.py)
+            limit = catchup.batch_limit(self.batch_size, self.queue)
+            batch = await self._collect_batch(limit)
+            if batch:
+                await self.write_batch(engine, batch)
+            catchup.batch_written(len(batch), limit)
+    
+    async def _collect_batch(self, limit):
+        """Collect up to limit messages or whatever arrives within flush_interval"""
+        batch = []
+        deadline = None
+        while len(batch) < limit:
+            try:
+                batch.append(self.queue.get(timeout=0))
+                if deadline is None:
+                    deadline = self._loop.time() + self.flush_interval
+                continue
+            except queue.Empty:
+                if self._stopping:
+                    break
+            
+            remaining = self.flush_interval if deadline is None else deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            self._available.clear()
+            try:
+                await asyncio.wait_for(self._available.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        
+        if batch:
+            self._room.set()
+        return batch
+    
+    def _prepare(self, batch):
+        """Prepare a batch on the prepare thread and commit the series it created: the samples are
+        inserted on another connection"""
+        with self.app.app_context():
+            rows, processed = prepare_batch(batch)
+            try:
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                duplicate_filter.forget(rows.keys)
+                raise
+        return rows, processed
+    
+    async def write_batch(self, engine, batch):
+        """Write a batch of gateway messages with one awaited bulk insert and commit"""
+        rows = SampleBatch()
+        
+        try:
+            # Synchronous lookups and commits stay off the loop
+            loop = asyncio.get_running_loop()
+            rows, processed = await loop.run_in_executor(self._executor, self._prepare, batch)
+            
+            started = time.perf_counter()
+            async with engine.connect() as connection:
+                inserted = await connection.run_sync(sensor_store.write, rows)
+                written = time.perf_counter()
+                await connection.commit()
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - written, 'async_writer')
+            if rows:
+                DB_WRITE_SECONDS.observe(written - started, 'sensor_samples')
+        
+        except Exception as e:
+            self.errors += 1
+            print(f"Error writing sensor data batch: {e}")
+            # Series created in the rolled back transaction may be cached
+            sensor_store.clear()
+            duplicate_filter.forget(rows.keys)
+            return 0
+        
+        self.messages_written += len(processed)
+        self.rows_written += inserted
+        self.batches_written += 1
+        BATCH_MESSAGES.observe(len(batch))
+        BATCH_ROWS.observe(len(rows))
+        observe_committed(processed, 'asyncio')
+        
+        # Broadcast to WebSocket clients once the batch is durable
+        if self.emit_enabled:
+            emit_sensor_data(processed)
+        
+        return inserted
+
+# Global asyncio ingest engine instance (used when INGEST_ENGINE=asyncio)
+async_ingest = AsyncIngestEngine()
@@ -2,16 +2,16 @@
 Background tasks for APRU40 system
 """
 from apscheduler.schedulers.background import BackgroundScheduler
-from app.models.iot import SensorData
+from app.services.retention import retention_engine
 from datetime import datetime
 
 scheduler = BackgroundScheduler()
 
 def cleanup_old_sensor_data():
-    """Clean up sensor data older than 7 days"""
+    """Clean up sensor data older than each site's retention"""
     try:
-        deleted = SensorData.cleanup_old_data(days=7)
-        print(f"[{datetime.utcnow()}] Cleaned up {deleted} old sensor data records")
+        if retention_engine.run(reason='scheduled') is None:
+            print(f"[{datetime.utcnow()}] Sensor data retention already running")
     except Exception as e:
         print(f"Error cleaning up sensor data: {e}")
 
@@ -0,0 +1,142 @@
+"""
+Catch-up mode for MQTT backlogs
+When the backend resumes a persistent session the broker delivers everything
+queued for it meanwhile at once, far more than live traffic. In catch-up mode
+the sensor data writer drains that backlog in INGEST_CATCHUP_BATCH_SIZE
+batches, the data queue switches to INGEST_CATCHUP_OVERFLOW_POLICY ('block':
+the broker holds the rest instead of the queue dropping it) and sensor_data
+WebSocket events are cut down to the newest message per gateway every
+INGEST_CATCHUP_EMIT_INTERVAL_MS, so browsers are not replayed the backlog.
+
+Catch-up starts when a session is resumed or the data queue reaches
+INGEST_CATCHUP_DEPTH messages, and ends once the writer, after at least
+INGEST_CATCHUP_MIN_MS, collects a batch that is not full: the queue ran dry and
+ingest is live again. Each episode's backlog (messages written) and drain time
+are recorded.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+from app.services.metrics import metrics, SIZE_BUCKETS
+from app.services.websocket import emit_event
+
+DRAIN_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+CATCHUP_MESSAGES = metrics.histogram('apru40_ingest_catchup_backlog_messages', 'Messages drained per catch-up',
+                                     buckets=SIZE_BUCKETS + (20000, 50000, 100000, 500000))
+CATCHUP_SECONDS = metrics.histogram('apru40_ingest_catchup_drain_seconds', 'Duration of a catch-up',
+                                    buckets=DRAIN_BUCKETS)
+
+class CatchUp:
+    def __init__(self):
+        self.batch_size = int(os.getenv('INGEST_CATCHUP_BATCH_SIZE', 2000))
+        self.depth = int(os.getenv('INGEST_CATCHUP_DEPTH', 2000))
+        self.min_duration = int(os.getenv('INGEST_CATCHUP_MIN_MS', 1000)) / 1000.0
+        self.emit_interval = int(os.getenv('INGEST_CATCHUP_EMIT_INTERVAL_MS', 1000)) / 1000.0
+        self.overflow_policy = os.getenv('INGEST_CATCHUP_OVERFLOW_POLICY', 'block')
+        self._lock = threading.Lock()
+        self._queue = None
+        self._policy = None
+        self._started = 0
+        self._emitted_at = 0
+        self.active = False
+        self.reason = None
+        self.messages = 0  # Written during the current catch-up
+        
+        # Counters
+        self.episodes = {}  # reason -> count
+        self.events_throttled = 0
+        self.last = None
+    
+    def begin(self, reason, data_queue):
+        """Enter catch-up mode ('session' resumed or queue 'depth') for a writer's data queue"""
+        with self._lock:
+            if self.active:
+                return
+            self.active = True
+            self.reason = reason
+            self.messages = 0
+            self._started = time.monotonic()
+            self._emitted_at = 0
+            self._queue = data_queue
+            self._policy = data_queue.policy
+            data_queue.policy = self.overflow_policy
+            self.episodes[reason] = self.episodes.get(reason, 0) + 1
+        
+        print(f"✓ Ingest catch-up started ({reason}, {data_queue.qsize()} messages queued)")
+        emit_event('ingest:catchup', {
+            'status': 'started',
+            'reason': reason,
+            'queue_depth': data_queue.qsize(),
+            'timestamp': datetime.utcnow().isoformat()
+        })
+    
+    def batch_limit(self, batch_size, data_queue):
+        """Batch size for the writer's next batch; enters catch-up if the queue is deep"""
+        if not self.active and data_queue.qsize() >= self.depth:
+            self.begin('depth', data_queue)
+        return max(batch_size, self.batch_size) if self.active else batch_size
+    
+    def batch_written(self, size, limit):
+        """Count a written batch; a batch short of the limit ends catch-up"""
+        if not self.active:
+            return
+        
+        self.messages += size
+        elapsed = time.monotonic() - self._started
+        if size >= limit or elapsed < self.min_duration:
+            return
+        
+        with self._lock:
+            if not self.active:
+                return
+            self.active = False
+            self._queue.policy = self._policy
+            self.last = {
+                'reason': self.reason,
+                'messages': self.messages,
+                'seconds': round(elapsed, 3),
+                'finished_at': datetime.utcnow().isoformat()
+            }
+        
+        CATCHUP_MESSAGES.observe(self.messages)
+        CATCHUP_SECONDS.observe(elapsed)
+        print(f"✓ Ingest caught up: {self.messages} messages in {elapsed:.1f}s")
+        emit_event('ingest:catchup', dict(self.last, status='finished'))
+    
+    def select_emits(self, processed):
+        """Messages of a written batch to broadcast (while catching up: the newest per gateway, every emit_interval)"""
+        if not self.active:
+            return processed
+        
+        now = time.monotonic()
+        if now - self._emitted_at < self.emit_interval:
+            self.events_throttled += len(processed)
+            return []
+        
+        self._emitted_at = now
+        newest = {}
+        for message in processed:
+            # (gateway_identifier, payload, received_at, event_time)
+            if message[0] not in newest or message[3] >= newest[message[0]][3]:
+                newest[message[0]] = message
+        self.events_throttled += len(processed) - len(newest)
+        return list(newest.values())
+    
+    def stats(self):
+        """Get catch-up state and counters"""
+        return {
+            'active': self.active,
+            'reason': self.reason if self.active else None,
+            'messages': self.messages if self.active else 0,
+            'seconds': round(time.monotonic() - self._started, 3) if self.active else 0,
+            'batch_size': self.batch_size,
+            'depth': self.depth,
+            'episodes': dict(self.episodes),
+            'events_throttled': self.events_throttled,
+            'last': self.last
+        }
+
+# Global catch-up instance
+catchup = CatchUp()
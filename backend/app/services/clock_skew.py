@@ -0,0 +1,132 @@
+"""
+Gateway clock skew estimation and event time
+Sensor rows are stamped with the gateway's payload `timestamp` (event time)
+rather than the time the backend processed them, corrected for the gateway's
+clock error. offset = receive time - device time is that error plus the
+transport/queueing delay, which is never negative, so the smallest offset seen
+over the last CLOCK_SKEW_WINDOW seconds estimates the error: data a gateway
+buffered during an outage arrives with a large delay and does not move the
+minimum. An estimate is applied once it covers CLOCK_SKEW_MIN_SPAN seconds of
+traffic and exceeds CLOCK_SKEW_TOLERANCE (timestamps have one-second
+resolution); until then device time is used as is.
+Event times more than INGEST_FUTURE_TOLERANCE ahead of receive time fall back
+to it. Such samples stay out of the window so one bogus timestamp cannot drag
+the estimate; only when they persist for CLOCK_SKEW_MIN_SPAN (a clock that is
+ahead or was stepped forward) does the window start over. Readings arriving
+more than INGEST_LATE_THRESHOLD after their event time are counted as late,
+those older than INGEST_LATE_WINDOW rejected.
+"""
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+
+class GatewayClock:
+    """Sliding-window minimum of one gateway's receive - device offsets"""
+    __slots__ = ('samples', 'since', 'ahead_since')
+    
+    def __init__(self):
+        # (received seconds, offset) with increasing offsets: the front is the window minimum
+        self.samples = deque()
+        self.since = None
+        self.ahead_since = None
+
+class ClockSkewEstimator:
+    def __init__(self):
+        self.window = float(os.getenv('CLOCK_SKEW_WINDOW', 900))
+        self.min_span = float(os.getenv('CLOCK_SKEW_MIN_SPAN', 60))
+        self.tolerance = float(os.getenv('CLOCK_SKEW_TOLERANCE', 2))
+        self.late_threshold = float(os.getenv('INGEST_LATE_THRESHOLD', 60))
+        self.late_window = float(os.getenv('INGEST_LATE_WINDOW', 86400))
+        self.future_tolerance = float(os.getenv('INGEST_FUTURE_TOLERANCE', 300))
+        self._clocks = {}
+        self._lock = threading.Lock()
+        
+        # Counters
+        self.corrected = 0
+        self.late = 0
+        self.rejected = 0
+        self.future = 0
+    
+    def _skew(self, clock):
+        """Trusted skew of a gateway clock; 0 while the window is too short or within tolerance"""
+        if not clock.samples:
+            return 0
+        skew = clock.samples[0][1]
+        if clock.samples[-1][0] - clock.since < self.min_span or abs(skew) <= self.tolerance:
+            return 0
+        return skew
+    
+    def observe(self, gateway_identifier, device_seconds, received_seconds):
+        """Add one offset sample; returns the gateway's clock skew in seconds"""
+        offset = received_seconds - device_seconds
+        with self._lock:
+            clock = self._clocks.get(gateway_identifier)
+            if clock is None:
+                clock = self._clocks[gateway_identifier] = GatewayClock()
+            
+            samples = clock.samples
+            while samples and samples[0][0] < received_seconds - self.window:
+                samples.popleft()
+            if offset - self._skew(clock) < -self.future_tolerance:
+                # Ahead of receive time even after correction: an outlier unless it persists
+                if clock.ahead_since is None:
+                    clock.ahead_since = received_seconds
+                if received_seconds - clock.ahead_since < self.min_span:
+                    return self._skew(clock)
+                samples.clear()
+                clock.since = clock.ahead_since
+            elif not samples:
+                clock.since = received_seconds
+            clock.ahead_since = None
+            while samples and samples[-1][1] >= offset:
+                samples.pop()
+            samples.append((received_seconds, offset))
+            return self._skew(clock)
+    
+    def event_time(self, gateway_identifier, timestamp, received_at):
+        """Corrected event time of a data message, received_at without a timestamp, None if too late"""
+        if not timestamp:
+            return received_at
+        
+        received_seconds = (received_at - EPOCH).total_seconds()
+        skew = self.observe(gateway_identifier, timestamp, received_seconds)
+        if skew:
+            self.corrected += 1
+        
+        event_seconds = timestamp + skew
+        if event_seconds > received_seconds + self.future_tolerance:
+            self.future += 1
+            return received_at
+        
+        delay = received_seconds - event_seconds
+        if delay > self.late_window:
+            self.rejected += 1
+            return None
+        if delay > self.late_threshold:
+            self.late += 1
+        return EPOCH + timedelta(seconds=event_seconds)
+    
+    def skews(self):
+        """Trusted skew estimate per gateway, in seconds (gateways within tolerance omitted)"""
+        with self._lock:
+            skews = {gateway_identifier: self._skew(clock) for gateway_identifier, clock in self._clocks.items()}
+        return {gateway_identifier: round(skew, 3) for gateway_identifier, skew in skews.items() if skew}
+    
+    def stats(self):
+        """Get clock skew and late data counters"""
+        return {
+            'gateways_tracked': len(self._clocks),
+            'skewed_gateways': self.skews(),
+            'window': self.window,
+            'late_window': self.late_window,
+            'corrected': self.corrected,
+            'late_accepted': self.late,
+            'late_rejected': self.rejected,
+            'future_clamped': self.future
+        }
+
+# Global clock skew estimator instance
+clock_skew = ClockSkewEstimator()
@@ -0,0 +1,209 @@
+"""
+Request/response commands to gateways over MQTT
+A command batch publishes one request per gateway on {prefix}/cmd (prefix:
+the gateway's mqtt_topic_prefix, apru40/{gateway_id} by default) carrying a
+correlation_id and reply_to; gateways answer on
+apru40/{gateway_id}/cmd/reply with {"correlation_id", "success", "result",
+"error"}. The client connects with MQTT v5 (unless MQTT_PROTOCOL=3.1.1), so the
+requests also carry the ResponseTopic and CorrelationData properties, and
+replies may carry the correlation id as CorrelationData only. Every request of a batch is published before any reply
+is awaited, so fanning out to a whole site takes one round trip; replies are
+matched on the MQTT thread and gateways that have not answered when the
+batch's timeout fires are reported as timed out. Requests go through the MQTT
+outbox and are dropped there if still undelivered at the timeout. Callers poll
+the batch or wait on it - API request threads never wait per gateway. Finished
+batches are kept RPC_RESULT_TTL seconds for polling, in the process that
+issued them.
+"""
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from app import db
+from app.services.websocket import emit_event
+
+REPLY_TOPIC = 'apru40/{gateway_id}/cmd/reply'
+
+class CommandBatch:
+    """One command sent to a set of gateways and its replies"""
+    
+    def __init__(self, command, params, timeout):
+        self.id = str(uuid.uuid4())
+        self.command = command
+        self.params = params
+        self.timeout = timeout
+        self.results = {}     # gateway_id -> {'status', 'result', 'error', 'latency_ms'}
+        self.waiting = 0
+        self.started_at = datetime.utcnow()
+        self.started = time.monotonic()
+        self.finished_at = None
+        self.done = threading.Event()
+        self.timer = None
+    
+    def to_dict(self, include_results=True):
+        counts = dict.fromkeys(('ok', 'error', 'timeout', 'unsent', 'pending'), 0)
+        for result in self.results.values():
+            counts[result['status']] += 1
+        data = {
+            'id': self.id,
+            'command': self.command,
+            'params': self.params,
+            'status': 'completed' if self.finished_at else 'running',
+            'timeout': self.timeout,
+            'total': len(self.results),
+            'counts': counts,
+            'started_at': self.started_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration_ms': round(((self.finished_at - self.started_at).total_seconds() if self.finished_at else
+                                  time.monotonic() - self.started) * 1000, 1)
+        }
+        if include_results:
+            data['results'] = dict(self.results)
+        return data
+
+class CommandRPC:
+    def __init__(self):
+        self.default_timeout = float(os.getenv('RPC_TIMEOUT', 10))
+        self.max_timeout = float(os.getenv('RPC_MAX_TIMEOUT', 120))
+        self.result_ttl = float(os.getenv('RPC_RESULT_TTL', 600))
+        self._lock = threading.Lock()
+        self._pending = {}  # correlation_id -> (batch, gateway_id, sent monotonic)
+        self._batches = {}  # batch id -> CommandBatch
+        
+        # Counters
+        self.requests = 0
+        self.replies = 0
+        self.timeouts = 0
+        self.unmatched = 0
+        self.unsent = 0
+    
+    def send(self, gateways, command, params=None, timeout=None):
+        """Publish a command to every gateway (Gateway rows) and return its CommandBatch"""
+        from app.services.mqtt_service import mqtt_service
+        timeout = min(float(timeout or self.default_timeout), self.max_timeout)
+        batch = CommandBatch(command, params or {}, timeout)
+        self._purge()
+        
+        # Registered before publishing: a reply can arrive before publish() returns
+        requests = []
+        with self._lock:
+            self._batches[batch.id] = batch
+            for gateway in gateways:
+                if gateway.gateway_id in batch.results:
+                    continue
+                correlation_id = uuid.uuid4().hex
+                batch.results[gateway.gateway_id] = {'status': 'pending'}
+                self._pending[correlation_id] = (batch, gateway.gateway_id, time.monotonic())
+                requests.append((correlation_id, gateway))
+            batch.waiting = len(requests)
+            self.requests += len(requests)
+        
+        batch.timer = threading.Timer(timeout, self._expire, args=(batch,))
+        batch.timer.daemon = True
+        batch.timer.start()
+        # Queued in the outbox in one transaction; requests still undelivered when the batch
+        # times out are dropped rather than executed late
+        unsent = []
+        for correlation_id, gateway in requests:
+            if not mqtt_service.publish_gateway_command(gateway, command, params, correlation_id,
+                                                        REPLY_TOPIC.format(gateway_id=gateway.gateway_id),
+                                                        expires_in=timeout):
+                unsent.append(correlation_id)
+        try:
+            db.session.commit()
+        except Exception as e:
+            print(f"Error queuing gateway commands: {e}")
+            db.session.rollback()
+            unsent = [correlation_id for correlation_id, _ in requests]
+        for correlation_id in unsent:
+            self._complete(correlation_id, {'status': 'unsent', 'error': 'Command could not be queued'})
+        if not requests:
+            self._finish(batch)
+        return batch
+    
+    def handle_reply(self, gateway_identifier, payload):
+        """Match a gateway's reply to its request (called on the MQTT thread)"""
+        correlation_id = payload.get('correlation_id') if isinstance(payload, dict) else None
+        if not correlation_id or not self._complete(correlation_id, {
+            'status': 'ok' if payload.get('success', True) else 'error',
+            'result': payload.get('result'),
+            'error': payload.get('error')
+        }, gateway_identifier):
+            self.unmatched += 1
+    
+    def get(self, batch_id):
+        """Get a batch issued by this process, None if unknown or expired"""
+        return self._batches.get(batch_id)
+    
+    def wait(self, batch, seconds):
+        """Wait up to seconds for a batch to finish; True if it did"""
+        return batch.done.wait(max(0, min(seconds, self.max_timeout)))
+    
+    def stats(self):
+        """Get RPC counters"""
+        return {
+            'pending_requests': len(self._pending),
+            'batches': len(self._batches),
+            'default_timeout': self.default_timeout,
+            'requests': self.requests,
+            'replies': self.replies,
+            'timeouts': self.timeouts,
+            'unsent': self.unsent,
+            'unmatched_replies': self.unmatched
+        }
+    
+    def _complete(self, correlation_id, result, gateway_identifier=None):
+        """Record one gateway's outcome; False if the correlation id is unknown (or from another gateway)"""
+        with self._lock:
+            pending = self._pending.get(correlation_id)
+            if pending is None or (gateway_identifier is not None and pending[1] != gateway_identifier):
+                return False
+            del self._pending[correlation_id]
+            batch, gateway_identifier, sent = pending
+            result['latency_ms'] = round((time.monotonic() - sent) * 1000, 1)
+            batch.results[gateway_identifier] = result
+            batch.waiting -= 1
+            if result['status'] == 'unsent':
+                self.unsent += 1
+            else:
+                self.replies += 1
+            finished = batch.waiting == 0
+        if finished:
+            self._finish(batch)
+        return True
+    
+    def _expire(self, batch):
+        """Batch timeout: gateways that have not replied timed out"""
+        with self._lock:
+            expired = [correlation_id for correlation_id, (pending_batch, _, _) in self._pending.items()
+                       if pending_batch is batch]
+            for correlation_id in expired:
+                _, gateway_identifier, _ = self._pending.pop(correlation_id)
+                batch.results[gateway_identifier] = {'status': 'timeout', 'error': 'No reply',
+                                                     'latency_ms': batch.timeout * 1000}
+            batch.waiting = 0
+            self.timeouts += len(expired)
+        self._finish(batch)
+    
+    def _finish(self, batch):
+        """Complete a batch once (last reply, timeout or nothing to send) and announce it"""
+        with self._lock:
+            if batch.finished_at:
+                return
+            batch.finished_at = datetime.utcnow()
+        batch.done.set()
+        if batch.timer:
+            batch.timer.cancel()
+        emit_event('command:completed', batch.to_dict(include_results=len(batch.results) <= 100))
+    
+    def _purge(self):
+        """Forget finished batches older than result_ttl"""
+        horizon = time.monotonic() - self.result_ttl
+        with self._lock:
+            for batch_id, batch in list(self._batches.items()):
+                if batch.done.is_set() and batch.started < horizon:
+                    del self._batches[batch_id]
+
+# Global command RPC instance
+command_rpc = CommandRPC()
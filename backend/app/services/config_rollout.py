@@ -0,0 +1,310 @@
+"""
+Node configuration rollout engine
+A rollout selects nodes (site, gateways, node ids, status/type filters), merges
+optional config overrides into each node's stored configuration and diffs the
+result against the hash of the configuration the node last acknowledged: nodes
+already running it are skipped. A thread in the web process then hands the
+changed configurations to the MQTT outbox, at most `rate` messages per second
+and `window` messages awaiting acknowledgement per rollout. Nodes acknowledge on
+apru40/{gateway_id}/config/node/{node}/ack with the config_id of the
+message; a message unacknowledged after `ack_timeout` seconds, or rejected, is
+retried up to `max_retries` times. Rollout state lives in config_rollouts and
+config_rollout_targets, so a restarted backend resumes where it left off.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy.orm import joinedload
+from app import db
+from app.models.iot import ConfigRollout, ConfigRolloutTarget, Gateway, Node, generate_uuid
+from app.services.websocket import emit_event
+
+SELECTOR_KEYS = ('site_id', 'gateway_ids', 'node_ids', 'status', 'node_type')
+
+def node_config(node):
+    """Full configuration message body of a node (the `config` of update_config)"""
+    return {
+        'acquisition': node.adc_config if node.adc_config else {},
+        'conversions': node.sensor_conversions if node.sensor_conversions else {},
+        'bluetooth': {
+            'enabled': node.bluetooth_enabled,
+            'scanner_model': node.scanner_model
+        }
+    }
+
+def config_hash(config):
+    """Stable hash of a configuration"""
+    return hashlib.sha256(json.dumps(config, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+def apply_overrides(node, overrides):
+    """Merge {acquisition, conversions, bluetooth} overrides into a node's stored configuration"""
+    if overrides.get('acquisition'):
+        node.adc_config = dict(node.adc_config or {}, **overrides['acquisition'])
+    if overrides.get('conversions'):
+        node.sensor_conversions = dict(node.sensor_conversions or {}, **overrides['conversions'])
+    bluetooth = overrides.get('bluetooth') or {}
+    if 'enabled' in bluetooth:
+        node.bluetooth_enabled = bool(bluetooth['enabled'])
+    if 'scanner_model' in bluetooth:
+        node.scanner_model = bluetooth['scanner_model']
+
+class RolloutEngine:
+    def __init__(self, app=None):
+        self.app = app
+        self.rate = float(os.getenv('ROLLOUT_RATE', 20))
+        self.window = int(os.getenv('ROLLOUT_WINDOW', 50))
+        self.max_retries = int(os.getenv('ROLLOUT_MAX_RETRIES', 3))
+        self.ack_timeout = float(os.getenv('ROLLOUT_ACK_TIMEOUT', 30))
+        self.tick = int(os.getenv('ROLLOUT_TICK_MS', 200)) / 1000.0
+        self._lock = threading.Lock()
+        self._acks = []     # (gateway_id, node number, payload, received_at) waiting for the next tick
+        self._tokens = {}   # rollout id -> (tokens, monotonic time)
+        self._thread = None
+        self._stop_event = threading.Event()
+        
+        # Counters
+        self.messages = dict.fromkeys(('sent', 'acked', 'rejected', 'timed_out', 'skipped', 'unmatched'), 0)
+        self.errors = 0
+    
+    def create(self, name, config=None, selector=None, created_by=None, rate=None, window=None,
+               max_retries=None, ack_timeout=None, start=True):
+        """Create a rollout over the selected nodes; raises ValueError for an empty selection"""
+        selector = {key: value for key, value in (selector or {}).items() if key in SELECTOR_KEYS and value}
+        query = Node.query.join(Gateway, Node.gateway_id == Gateway.id)
+        if selector.get('site_id'):
+            query = query.filter(Gateway.site_id == selector['site_id'])
+        if selector.get('gateway_ids'):
+            query = query.filter(Node.gateway_id.in_(selector['gateway_ids']))
+        if selector.get('node_ids'):
+            query = query.filter(Node.id.in_(selector['node_ids']))
+        if selector.get('status'):
+            query = query.filter(Node.status == selector['status'])
+        if selector.get('node_type'):
+            query = query.filter(Node.node_type == selector['node_type'])
+        nodes = query.all()
+        if not nodes:
+            raise ValueError('No nodes match the selection')
+        
+        rollout = ConfigRollout(
+            id=generate_uuid(),
+            name=name,
+            config=config or None,
+            selector=selector,
+            status='running' if start else 'paused',
+            rate=float(rate or self.rate),
+            window=int(window or self.window),
+            max_retries=int(self.max_retries if max_retries is None else max_retries),
+            ack_timeout=float(ack_timeout or self.ack_timeout),
+            created_by=created_by
+        )
+        db.session.add(rollout)
+        
+        # Only nodes whose resulting config differs from the acknowledged one are sent anything
+        targets = []
+        for node in nodes:
+            if config:
+                apply_overrides(node, config)
+            desired = config_hash(node_config(node))
+            targets.append({
+                'id': generate_uuid(),
+                'rollout_id': rollout.id,
+                'node_id': node.id,
+                'status': 'skipped' if desired == node.config_hash else 'pending',
+                'config_hash': desired,
+                'attempts': 0
+            })
+        db.session.flush()
+        db.session.execute(ConfigRolloutTarget.__table__.insert(), targets)
+        if all(target['status'] == 'skipped' for target in targets):
+            rollout.status = 'completed'
+            rollout.finished_at = datetime.utcnow()
+        db.session.commit()
+        self.messages['skipped'] += sum(1 for target in targets if target['status'] == 'skipped')
+        return rollout
+    
+    def set_status(self, rollout, status):
+        """Pause, resume or cancel a rollout"""
+        if rollout.status in ('completed', 'cancelled'):
+            raise ValueError(f"Rollout is {rollout.status}")
+        
+        rollout.status = status
+        if status == 'cancelled':
+            rollout.finished_at = datetime.utcnow()
+            ConfigRolloutTarget.query.filter(
+                ConfigRolloutTarget.rollout_id == rollout.id,
+                ConfigRolloutTarget.status.in_(('pending', 'sent'))
+            ).update({'status': 'cancelled'}, synchronize_session=False)
+        db.session.commit()
+        self._emit_progress(rollout)
+    
+    def acknowledge(self, gateway_identifier, node_number, payload):
+        """Queue a node's config acknowledgement for the next tick"""
+        with self._lock:
+            self._acks.append((gateway_identifier, node_number, payload, datetime.utcnow()))
+    
+    def start(self):
+        """Start the rollout thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='config-rollout', daemon=True)
+        self._thread.start()
+        print(f"✓ Config rollout engine started (default {self.rate:g} msgs/s, window={self.window})")
+    
+    def stop(self, timeout=10):
+        """Stop the rollout thread (unfinished rollouts resume on the next start)"""
+        if not self._thread:
+            return
+        
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+    
+    def stats(self):
+        """Get engine counters"""
+        return {
+            'pending_acks': len(self._acks),
+            'rate': self.rate,
+            'window': self.window,
+            'max_retries': self.max_retries,
+            'ack_timeout': self.ack_timeout,
+            'messages': dict(self.messages),
+            'errors': self.errors
+        }
+    
+    def _run(self):
+        """Rollout loop: apply acknowledgements and publish every tick"""
+        with self.app.app_context():
+            while not self._stop_event.wait(self.tick):
+                try:
+                    self.step()
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Error running config rollouts: {e}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+    
+    def step(self):
+        """Apply queued acknowledgements, then advance every running rollout"""
+        with self._lock:
+            acks, self._acks = self._acks, []
+        
+        now = datetime.utcnow()
+        changed = self._apply_acks(acks, now) if acks else set()
+        for rollout in ConfigRollout.query.filter_by(status='running').all():
+            if self._advance(rollout, now):
+                changed.add(rollout.id)
+        db.session.commit()
+        
+        for rollout_id in changed:
+            rollout = db.session.get(ConfigRollout, rollout_id)
+            if rollout:
+                self._emit_progress(rollout)
+    
+    def _apply_acks(self, acks, now):
+        """Mark acknowledged targets (and their nodes' config), retry rejected ones; returns rollout ids"""
+        changed = set()
+        for gateway_identifier, node_number, payload, received_at in acks:
+            target = db.session.get(ConfigRolloutTarget, str(payload.get('config_id') or ''))
+            if (target is None or target.status != 'sent' or target.node.node_id != node_number
+                    or target.node.gateway.gateway_id != gateway_identifier):
+                self.messages['unmatched'] += 1
+                continue
+            
+            rollout = target.rollout
+            success = bool(payload.get('success', True))
+            if success:
+                target.status = 'acked'
+                target.acked_at = received_at
+                target.node.config_hash = target.config_hash
+                target.node.config_acked_at = received_at
+                self.messages['acked'] += 1
+            else:
+                target.error = str(payload.get('error') or 'rejected')[:200]
+                target.status = 'pending' if target.attempts <= rollout.max_retries else 'failed'
+                self.messages['rejected'] += 1
+            changed.add(rollout.id)
+            emit_event('device:config_applied', {
+                'node_id': target.node_id,
+                'node': node_number,
+                'gateway_id': gateway_identifier,
+                'rollout_id': rollout.id,
+                'config_hash': target.config_hash,
+                'success': success,
+                'error': None if success else target.error
+            })
+        return changed
+    
+    def _advance(self, rollout, now):
+        """Retry timed out messages and publish pending ones within rate and window; True if anything changed"""
+        from app.services.mqtt_service import mqtt_service
+        changed = False
+        base = ConfigRolloutTarget.query.filter(ConfigRolloutTarget.rollout_id == rollout.id)
+        
+        # Unacknowledged messages: retried while attempts remain
+        for target in base.filter(ConfigRolloutTarget.status == 'sent',
+                                  ConfigRolloutTarget.sent_at < now - timedelta(seconds=rollout.ack_timeout)).all():
+            target.error = 'acknowledgement timeout'
+            target.status = 'pending' if target.attempts <= rollout.max_retries else 'failed'
+            self.messages['timed_out'] += 1
+            changed = True
+        
+        in_flight = base.filter(ConfigRolloutTarget.status == 'sent').count()
+        budget = min(rollout.window - in_flight, int(self._take_tokens(rollout)))
+        if budget > 0:
+            pending = base.filter(ConfigRolloutTarget.status == 'pending').options(
+                joinedload(ConfigRolloutTarget.node).joinedload(Node.gateway)
+            ).order_by(ConfigRolloutTarget.attempts, ConfigRolloutTarget.id).limit(budget).all()
+            for target in pending:
+                config = node_config(target.node)
+                target.config_hash = config_hash(config)
+                if target.config_hash == target.node.config_hash:
+                    # Acknowledged through another rollout meanwhile
+                    target.status = 'skipped'
+                    self.messages['skipped'] += 1
+                elif mqtt_service.publish_node_config(target.node, target.id, config):
+                    target.status = 'sent'
+                    target.attempts += 1
+                    target.sent_at = now
+                    self.messages['sent'] += 1
+                    in_flight += 1
+                else:
+                    break
+                self._spend_token(rollout)
+                changed = True
+        
+        if in_flight == 0 and not base.filter(ConfigRolloutTarget.status == 'pending').count():
+            rollout.status = 'completed'
+            rollout.finished_at = now
+            self._tokens.pop(rollout.id, None)
+            changed = True
+        return changed
+    
+    def _take_tokens(self, rollout):
+        """Refill a rollout's token bucket (one token per message, one second of burst) and return it"""
+        now = time.monotonic()
+        capacity = max(rollout.rate, 1)
+        tokens, updated_at = self._tokens.get(rollout.id, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * rollout.rate)
+        self._tokens[rollout.id] = (tokens, now)
+        return tokens
+    
+    def _spend_token(self, rollout):
+        tokens, updated_at = self._tokens[rollout.id]
+        self._tokens[rollout.id] = (tokens - 1, updated_at)
+    
+    def _emit_progress(self, rollout):
+        emit_event('rollout:progress', {
+            'id': rollout.id,
+            'name': rollout.name,
+            'status': rollout.status,
+            'progress': rollout.progress()
+        })
+
+# Global config rollout engine instance
+config_rollout = RolloutEngine()
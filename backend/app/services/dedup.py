@@ -0,0 +1,79 @@
+"""
+Duplicate sensor data suppression
+QoS 1 redelivery, gateway retries and persistent-session replays resend data
+messages that were already stored. A reading is identified by (node, device
+timestamp from the payload, adc_type, channel); a node's readings travel in one
+message, so the fast path remembers (node PK, device timestamp) pairs in a
+bounded LRU and skips nodes it has already seen. The unique index on
+sensor_samples (series_id, device_timestamp), a series being a node's ADC
+channel, with INSERT ... ON CONFLICT DO NOTHING catches what the LRU cannot:
+evicted keys, duplicates consumed by another ingest worker process and
+restarts. With time partitions the index is per partition (see partitions.py),
+so it holds within each partition. Messages without a device timestamp skip
+the LRU and are stored with their receive time as device_timestamp, so they
+are not treated as duplicates.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+class DuplicateFilter:
+    def __init__(self, maxsize=None):
+        # INGEST_DEDUP_CACHE_SIZE=0 leaves deduplication to the storage layer
+        self.maxsize = int(os.getenv('INGEST_DEDUP_CACHE_SIZE', 100000)) if maxsize is None else maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        
+        # Counters
+        self.checked = 0
+        self.suppressed = 0
+        self.storage_suppressed = 0
+    
+    def seen(self, key):
+        """Remember a key; True if it was already remembered (a duplicate)"""
+        if not self.maxsize:
+            return False
+        
+        with self._lock:
+            self.checked += 1
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                self.suppressed += 1
+                return True
+            self._keys[key] = None
+            if len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+            return False
+    
+    def forget(self, keys):
+        """Drop keys whose rows were not committed so a redelivery is stored"""
+        with self._lock:
+            for key in keys:
+                self._keys.pop(key, None)
+    
+    def record_storage_duplicates(self, count):
+        """Count rows the unique index rejected"""
+        if count > 0:
+            with self._lock:
+                self.storage_suppressed += count
+    
+    def reset(self):
+        """Forget every key and zero the counters"""
+        with self._lock:
+            self._keys.clear()
+            self.checked = 0
+            self.suppressed = 0
+            self.storage_suppressed = 0
+    
+    def stats(self):
+        """Get filter counters"""
+        return {
+            'cache_size': len(self._keys),
+            'cache_capacity': self.maxsize,
+            'checked': self.checked,
+            'suppressed_cache': self.suppressed,
+            'suppressed_storage': self.storage_suppressed
+        }
+
+# Global duplicate filter instance
+duplicate_filter = DuplicateFilter()
@@ -0,0 +1,210 @@
+"""
+Write-behind buffer for gateway/node heartbeat fields
+Data and status messages only record the latest last_seen/status/rssi/battery/
+QR code per gateway and node in memory; a flusher thread writes them as one
+executemany UPDATE per table every HEARTBEAT_FLUSH_INTERVAL seconds and on
+shutdown. REST endpoints overlay pending values so last_seen stays current.
+Updates never move last_seen backwards, so several ingest processes can flush
+heartbeats of the same gateway in any order. Every heartbeat is also reported to
+the liveness tracker, which marks devices offline when they go silent.
+"""
+import os
+import threading
+import time
+from sqlalchemy import bindparam, func, or_
+from app import db
+from app.models.iot import Gateway, Node
+from app.services.liveness import GATEWAY, NODE, liveness_tracker
+from app.services.metrics import metrics
+
+# Shared with the sensor data writer (the registry returns the same histograms)
+DB_WRITE_SECONDS = metrics.histogram('apru40_db_write_seconds', 'Bulk INSERT/UPDATE statement duration', ['table'])
+DB_COMMIT_SECONDS = metrics.histogram('apru40_db_commit_seconds', 'Commit duration', ['source'])
+
+class HeartbeatBuffer:
+    def __init__(self, app=None):
+        self.app = app
+        self.flush_interval = float(os.getenv('HEARTBEAT_FLUSH_INTERVAL', 5))
+        self._lock = threading.Lock()
+        self._gateways = {}          # gateway PK -> latest heartbeat
+        self._nodes = {}             # node PK -> latest heartbeat
+        self._flushing_gateways = {}  # heartbeats being written, still visible to readers
+        self._flushing_nodes = {}
+        self._thread = None
+        self._stop_event = threading.Event()
+        
+        # Counters
+        self.updates_recorded = 0
+        self.rows_flushed = 0
+        self.flushes = 0
+    
+    def record_gateway(self, gateway_pk, last_seen, status='online'):
+        """Record the latest heartbeat of a gateway"""
+        heartbeat = {'_id': gateway_pk, 'last_seen': last_seen, 'status': status}
+        with self._lock:
+            self._gateways[gateway_pk] = heartbeat
+            self.updates_recorded += 1
+        liveness_tracker.heartbeat(GATEWAY, gateway_pk, status)
+    
+    def record_node(self, node_pk, last_seen, status='online', rssi=None, battery_level=None, last_qr_code=None):
+        """Record the latest heartbeat of a node (a missing QR code keeps the pending one)"""
+        with self._lock:
+            if last_qr_code is None:
+                previous = self._nodes.get(node_pk)
+                if previous:
+                    last_qr_code = previous['last_qr_code']
+            self._nodes[node_pk] = {
+                '_id': node_pk,
+                'status': status,
+                'last_seen': last_seen,
+                'rssi': rssi,
+                'battery_level': battery_level,
+                'last_qr_code': last_qr_code
+            }
+            self.updates_recorded += 1
+        liveness_tracker.heartbeat(NODE, node_pk, status)
+    
+    def pending_gateway(self, gateway_pk):
+        """Get the not yet persisted heartbeat of a gateway, if any"""
+        return self._gateways.get(gateway_pk) or self._flushing_gateways.get(gateway_pk)
+    
+    def pending_node(self, node_pk):
+        """Get the not yet persisted heartbeat of a node, if any"""
+        return self._nodes.get(node_pk) or self._flushing_nodes.get(node_pk)
+    
+    def node_status(self, node):
+        """Get a node's current status, including pending heartbeats"""
+        pending = self.pending_node(node.id)
+        return pending['status'] if pending else node.status
+    
+    def overlay_gateway(self, data):
+        """Apply pending heartbeats to a Gateway.to_dict() result (and its nodes)"""
+        pending = self.pending_gateway(data.get('id'))
+        if pending:
+            data['status'] = pending['status']
+            data['last_seen'] = pending['last_seen'].isoformat()
+        
+        for node_data in data.get('nodes', []):
+            self.overlay_node(node_data)
+        
+        return data
+    
+    def overlay_node(self, data):
+        """Apply a pending heartbeat to a Node.to_dict() result"""
+        pending = self.pending_node(data.get('id'))
+        if pending:
+            data['status'] = pending['status']
+            data['last_seen'] = pending['last_seen'].isoformat()
+            data['rssi'] = pending['rssi']
+            data['battery_level'] = pending['battery_level']
+            if pending['last_qr_code']:
+                data['last_qr_code'] = pending['last_qr_code']
+        
+        return data
+    
+    def start(self):
+        """Start the flusher thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='heartbeat-flusher', daemon=True)
+        self._thread.start()
+        print(f"✓ Heartbeat buffer started (flush every {self.flush_interval:g}s)")
+    
+    def stop(self, timeout=10):
+        """Stop the flusher thread and write any pending heartbeats"""
+        if not self._thread:
+            return
+        
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+    
+    def stats(self):
+        """Get buffer counters"""
+        return {
+            'pending_gateways': len(self._gateways),
+            'pending_nodes': len(self._nodes),
+            'flush_interval': self.flush_interval,
+            'updates_recorded': self.updates_recorded,
+            'rows_flushed': self.rows_flushed,
+            'flushes': self.flushes
+        }
+    
+    def _run(self):
+        """Flusher loop: write pending heartbeats every flush_interval, then once more on stop"""
+        with self.app.app_context():
+            while not self._stop_event.wait(self.flush_interval):
+                self.flush()
+            self.flush()
+    
+    def flush(self):
+        """Write all pending heartbeats as one bulk UPDATE per table"""
+        with self._lock:
+            self._flushing_gateways, self._gateways = self._gateways, {}
+            self._flushing_nodes, self._nodes = self._nodes, {}
+        
+        gateway_updates = list(self._flushing_gateways.values())
+        node_updates = list(self._flushing_nodes.values())
+        if not gateway_updates and not node_updates:
+            return 0
+        
+        try:
+            started = time.perf_counter()
+            if gateway_updates:
+                gateways = Gateway.__table__
+                db.session.execute(
+                    gateways.update().where(
+                        gateways.c.id == bindparam('_id'),
+                        or_(gateways.c.last_seen.is_(None), gateways.c.last_seen <= bindparam('last_seen'))
+                    ).values(
+                        last_seen=bindparam('last_seen'),
+                        status=bindparam('status')
+                    ),
+                    gateway_updates
+                )
+            
+            if node_updates:
+                nodes = Node.__table__
+                db.session.execute(
+                    nodes.update().where(
+                        nodes.c.id == bindparam('_id'),
+                        or_(nodes.c.last_seen.is_(None), nodes.c.last_seen <= bindparam('last_seen'))
+                    ).values(
+                        status=bindparam('status'),
+                        last_seen=bindparam('last_seen'),
+                        rssi=bindparam('rssi'),
+                        battery_level=bindparam('battery_level'),
+                        last_qr_code=func.coalesce(bindparam('last_qr_code'), nodes.c.last_qr_code)
+                    ),
+                    node_updates
+                )
+            
+            written = time.perf_counter()
+            db.session.commit()
+            DB_WRITE_SECONDS.observe(written - started, 'heartbeats')
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - written, 'heartbeat_buffer')
+        
+        except Exception as e:
+            print(f"Error flushing heartbeats: {e}")
+            db.session.rollback()
+            # Put heartbeats back unless a newer one arrived meanwhile
+            with self._lock:
+                for gateway_pk, heartbeat in self._flushing_gateways.items():
+                    self._gateways.setdefault(gateway_pk, heartbeat)
+                for node_pk, heartbeat in self._flushing_nodes.items():
+                    self._nodes.setdefault(node_pk, heartbeat)
+            return 0
+        
+        finally:
+            with self._lock:
+                self._flushing_gateways = {}
+                self._flushing_nodes = {}
+        
+        self.rows_flushed += len(gateway_updates) + len(node_updates)
+        self.flushes += 1
+        return len(gateway_updates) + len(node_updates)
+
+# Global heartbeat buffer instance
+heartbeat_buffer = HeartbeatBuffer()
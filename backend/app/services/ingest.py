@@ -0,0 +1,287 @@
+"""
+Batched sensor data writer for the MQTT ingest path
+Decouples the paho network thread from database writes: messages are queued
+by MQTTService.on_message (already decoded to payload_decoder.GatewayData)
+and a writer thread bulk-inserts them per batch. Rows carry the gateway's
+corrected event time (see clock_skew.py) and are stored as narrow samples of
+a series (see sensor_store.py); readings already stored are skipped (see
+dedup.py). A backlog is drained in larger batches (see catchup.py)
+"""
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+from app import db
+from app.services.catchup import catchup
+from app.services.clock_skew import clock_skew
+from app.services.dedup import duplicate_filter
+from app.services.heartbeat import heartbeat_buffer
+from app.services.ingest_queue import queue_from_env
+from app.services.metrics import metrics, SIZE_BUCKETS
+from app.services.payload_decoder import channel_number, to_builtins
+from app.services.registry import device_registry
+from app.services.sensor_store import SampleBatch, sensor_store
+from app.services.websocket import emit_event
+
+BATCH_MESSAGES = metrics.histogram('apru40_ingest_batch_messages', 'Gateway messages per writer batch', buckets=SIZE_BUCKETS)
+BATCH_ROWS = metrics.histogram('apru40_ingest_batch_rows', 'Sensor rows per writer batch', buckets=SIZE_BUCKETS + (20000, 50000))
+DB_WRITE_SECONDS = metrics.histogram('apru40_db_write_seconds', 'Bulk INSERT/UPDATE statement duration', ['table'])
+DB_COMMIT_SECONDS = metrics.histogram('apru40_db_commit_seconds', 'Commit duration', ['source'])
+INGEST_LATENCY_SECONDS = metrics.histogram('apru40_ingest_latency_seconds', 'Receive-to-commit latency per gateway data message', ['engine'])
+
+class SensorDataWriter:
+    def __init__(self, app=None):
+        self.app = app
+        self.batch_size = int(os.getenv('INGEST_BATCH_SIZE', 200))
+        self.flush_interval = int(os.getenv('INGEST_FLUSH_INTERVAL_MS', 250)) / 1000.0
+        # Data lane: bounded, INGEST_OVERFLOW_POLICY decides what a full queue does
+        self.queue = queue_from_env('data', 'INGEST', 10000, 'drop-oldest')
+        self.emit_enabled = True
+        self._thread = None
+        self._stop_event = threading.Event()
+        
+        # Counters
+        self.messages_received = 0
+        self.messages_written = 0
+        self.rows_written = 0
+        self.batches_written = 0
+    
+    def submit(self, gateway_identifier, payload, received_at=None):
+        """Queue a gateway data message for the writer thread (blocks only with the 'block' policy)"""
+        self.messages_received += 1
+        return self.queue.put(
+            (gateway_identifier, payload, received_at or datetime.utcnow()),
+            key=gateway_identifier
+        )
+    
+    def start(self):
+        """Start the writer thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='sensor-data-writer', daemon=True)
+        self._thread.start()
+        print(f"✓ Sensor data writer started (batch={self.batch_size}, flush={int(self.flush_interval * 1000)}ms)")
+    
+    def stop(self, timeout=10):
+        """Stop the writer thread after draining the queue"""
+        if not self._thread:
+            return
+        
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+    
+    def stats(self):
+        """Get writer counters"""
+        return {
+            'engine': 'threaded',
+            'queue_depth': self.queue.qsize(),
+            'queue_capacity': self.queue.maxsize,
+            'overflow_policy': self.queue.policy,
+            'batch_size': self.batch_size,
+            'flush_interval_ms': int(self.flush_interval * 1000),
+            'messages_received': self.messages_received,
+            'messages_dropped': self.queue.dropped + self.queue.sampled_out,
+            'messages_written': self.messages_written,
+            'rows_written': self.rows_written,
+            'batches_written': self.batches_written
+        }
+    
+    def _run(self):
+        """Writer loop: drain the queue in batches until stopped and empty"""
+        with self.app.app_context():
+            while not self._stop_event.is_set() or not self.queue.empty():
+                # Larger batches while draining a backlog (see catchup.py)
+                limit = catchup.batch_limit(self.batch_size, self.queue)
+                batch = self._collect_batch(limit)
+                if batch:
+                    self.write_batch(batch)
+                catchup.batch_written(len(batch), limit)
+    
+    def _collect_batch(self, limit):
+        """Collect up to limit messages or whatever arrives within flush_interval"""
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.flush_interval))
+        except queue.Empty:
+            return batch
+        
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < limit:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        
+        return batch
+    
+    def write_batch(self, batch):
+        """Write a batch of gateway messages with a single bulk insert and commit"""
+        rows = SampleBatch()
+        
+        try:
+            rows, processed = prepare_batch(batch)
+            
+            started = time.perf_counter()
+            inserted = sensor_store.write(db.session.connection(), rows)
+            written = time.perf_counter()
+            db.session.commit()
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - written, 'sensor_writer')
+            if rows:
+                DB_WRITE_SECONDS.observe(written - started, 'sensor_samples')
+            
+        except Exception as e:
+            print(f"Error writing sensor data batch: {e}")
+            db.session.rollback()
+            # Series created in the rolled back transaction may be cached
+            sensor_store.clear()
+            duplicate_filter.forget(rows.keys)
+            return 0
+        
+        self.messages_written += len(processed)
+        self.rows_written += inserted
+        self.batches_written += 1
+        BATCH_MESSAGES.observe(len(batch))
+        BATCH_ROWS.observe(len(rows))
+        observe_committed(processed, 'threaded')
+        
+        # Broadcast to WebSocket clients once the batch is durable
+        if self.emit_enabled:
+            emit_sensor_data(processed)
+        
+        return len(rows)
+
+def device_time(timestamp):
+    """Payload timestamp (epoch seconds) as naive UTC, None if missing or out of range"""
+    if not timestamp:
+        return None
+    try:
+        return datetime.utcfromtimestamp(timestamp)
+    except (OverflowError, OSError, ValueError):
+        return None
+
+def observe_committed(processed, engine):
+    """Record the receive-to-commit latency of committed messages"""
+    committed_at = datetime.utcnow()
+    for _, _, received_at, _ in processed:
+        INGEST_LATENCY_SECONDS.observe((committed_at - received_at).total_seconds(), engine)
+
+def emit_sensor_data(processed):
+    """Broadcast committed gateway messages to WebSocket clients (thinned out while catching up)"""
+    for gateway_identifier, payload, received_at, event_time in catchup.select_emits(processed):
+        emit_event('sensor_data', {
+            'gateway_id': gateway_identifier,
+            'timestamp': event_time.isoformat(),
+            'received_at': received_at.isoformat(),
+            'nodes': to_builtins(payload.nodes)
+        })
+
+def prepare_batch(batch):
+    """Turn queued (gateway, payload, received_at) messages into a SampleBatch; returns
+    (rows, processed) where processed holds (gateway, payload, received_at, event_time)"""
+    rows = SampleBatch()
+    processed = []
+    try:
+        for gateway_identifier, payload, received_at in batch:
+            try:
+                prepared = prepare_rows(gateway_identifier, payload, received_at)
+            except (AttributeError, TypeError, ValueError) as e:
+                print(f"Malformed sensor data from gateway {gateway_identifier}: {e}")
+                continue
+            if prepared is not None:
+                message_rows, event_time = prepared
+                rows.extend(message_rows)
+                processed.append((gateway_identifier, payload, received_at, event_time))
+    except Exception:
+        # The batch is not written: its readings must not be suppressed when redelivered
+        duplicate_filter.forget(rows.keys)
+        raise
+    return rows, processed
+
+def prepare_rows(gateway_identifier, payload, received_at):
+    """Record gateway/node heartbeats for one decoded message and return (SampleBatch, event
+    time); None if the gateway is unknown, the data is too late or every node was a duplicate"""
+    gateway_pk = device_registry.resolve_gateway(gateway_identifier)
+    if gateway_pk is None:
+        device_registry.report_unknown(f"Gateway not found: {gateway_identifier}")
+        return None
+    
+    heartbeat_buffer.record_gateway(gateway_pk, received_at, 'online')
+    
+    event_time = clock_skew.event_time(gateway_identifier, payload.timestamp, received_at)
+    if event_time is None:
+        return None
+    
+    device_timestamp = device_time(payload.timestamp)
+    # Part of the sample primary key: messages without a timestamp are stored under their event time
+    stored_timestamp = event_time if device_timestamp is None else device_timestamp
+    rows = SampleBatch()
+    duplicates = 0
+    
+    # Process nodes data
+    try:
+        for node_data in payload.nodes:
+            node_identifier = node_data.node_id
+            if node_identifier is None:
+                continue
+            
+            node_pk = device_registry.resolve_node(gateway_pk, node_identifier)
+            if node_pk is None:
+                device_registry.report_unknown(
+                    f"Node {node_identifier} not found for gateway {gateway_identifier}, skipping..."
+                )
+                continue
+            
+            if device_timestamp is not None:
+                if duplicate_filter.seen((node_pk, device_timestamp)):
+                    duplicates += 1
+                    continue
+                rows.keys.add((node_pk, device_timestamp))
+            
+            qr_code = node_data.qr_code
+            heartbeat_buffer.record_node(
+                node_pk, received_at, 'online',
+                rssi=node_data.rssi,
+                battery_level=node_data.battery,
+                last_qr_code=qr_code or None
+            )
+            if qr_code:
+                rows.qr_codes.append({
+                    'node_id': node_pk, 'timestamp': event_time, 'device_timestamp': stored_timestamp,
+                    'qr_code': qr_code
+                })
+            
+            # Collect sensor readings (channel keys were validated by the decoder)
+            readings = [
+                (adc_type, channel_number(channel_key), reading)
+                for adc_type, channels in node_data.sensors.items()
+                for channel_key, reading in channels.items()
+            ]
+            series_ids = sensor_store.series_ids(
+                node_pk, [(adc_type, channel, reading.unit) for adc_type, channel, reading in readings]
+            )
+            for series_id, (_, _, reading) in zip(series_ids, readings):
+                rows.samples.append({
+                    'series_id': series_id,
+                    'timestamp': event_time,
+                    'device_timestamp': stored_timestamp,
+                    'raw_value': reading.raw,
+                    'converted_value': reading.value
+                })
+    except Exception:
+        # Keys seen so far belong to readings that are not written
+        duplicate_filter.forget(rows.keys)
+        raise
+    
+    if duplicates and not rows:
+        return None
+    return rows, event_time
+
+# Global sensor data writer instance
+sensor_writer = SensorDataWriter()
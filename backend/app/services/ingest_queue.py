@@ -0,0 +1,200 @@
+"""
+Bounded ingest queues with overflow policies, and priority lanes
+Every MQTT message class gets its own bounded queue (lane) so a backlog of bulk
+/data messages - e.g. while the database is stalled - can neither grow memory
+without bound nor delay /alert and /status handling. When a queue is full its
+overflow policy decides what happens:
+    
+    block        the MQTT thread waits up to INGEST_BLOCK_TIMEOUT_MS for room
+                 (the broker then buffers), and drops the message after that
+    drop-oldest  the oldest queued message is discarded to make room
+    drop-newest  the incoming message is discarded
+    sample       above INGEST_SAMPLE_WATERMARK of capacity only every
+                 INGEST_SAMPLE_EVERY-th message per gateway is kept;
+                 a full queue then drops its oldest message
+
+Dropped, sampled out, blocked and delayed (queued longer than
+INGEST_DELAY_THRESHOLD_MS) messages are counted per queue.
+"""
+import collections
+import os
+import queue
+import threading
+import time
+
+OVERFLOW_POLICIES = ('block', 'drop-oldest', 'drop-newest', 'sample')
+
+class BoundedQueue:
+    def __init__(self, name, maxsize, policy='drop-oldest', block_timeout=None, sample_every=None,
+                 sample_watermark=None, delay_threshold=None):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy '{policy}' for {name} queue, expected one of {OVERFLOW_POLICIES}")
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        # Setting block_timeout to None afterwards waits forever (only sensible off the MQTT thread)
+        self.block_timeout = block_timeout if block_timeout is not None else \
+            int(os.getenv('INGEST_BLOCK_TIMEOUT_MS', 1000)) / 1000.0
+        self.sample_every = sample_every or int(os.getenv('INGEST_SAMPLE_EVERY', 10))
+        self.sample_watermark = sample_watermark or float(os.getenv('INGEST_SAMPLE_WATERMARK', 0.8))
+        self.delay_threshold = delay_threshold if delay_threshold is not None else \
+            int(os.getenv('INGEST_DELAY_THRESHOLD_MS', 1000)) / 1000.0
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._sample_counts = {}
+        
+        # Counters
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.blocked = 0
+        self.delayed = 0
+        self.max_depth = 0
+        self.max_wait = 0.0
+    
+    def put(self, item, key=None):
+        """Queue an item, applying the overflow policy; False if the item itself was discarded"""
+        with self._lock:
+            if self.policy == 'sample' and len(self._items) >= self.maxsize * self.sample_watermark:
+                # Keep every sample_every-th message of each key (gateway) while under pressure
+                count = self._sample_counts.get(key, 0)
+                self._sample_counts[key] = count + 1
+                if count % self.sample_every:
+                    self.sampled_out += 1
+                    return False
+            
+            if len(self._items) >= self.maxsize:
+                if self.policy == 'block':
+                    self.blocked += 1
+                    deadline = None if self.block_timeout is None else time.monotonic() + self.block_timeout
+                    while len(self._items) >= self.maxsize:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            self._drop(f"{self.name} queue still full after {self.block_timeout}s")
+                            return False
+                        self._not_full.wait(remaining)
+                elif self.policy == 'drop-newest':
+                    self._drop(f"{self.name} queue full, dropped newest message")
+                    return False
+                else:
+                    self._items.popleft()
+                    self._drop(f"{self.name} queue full, dropped oldest message")
+            
+            self._items.append((time.monotonic(), item))
+            self.enqueued += 1
+            if len(self._items) > self.max_depth:
+                self.max_depth = len(self._items)
+            if self.policy == 'sample' and len(self._items) < self.maxsize * self.sample_watermark / 2:
+                self._sample_counts.clear()
+            self._not_empty.notify()
+            return True
+    
+    def get(self, timeout=None):
+        """Get the oldest item, waiting up to timeout seconds (raises queue.Empty)"""
+        with self._lock:
+            if not self._items:
+                self._not_empty.wait(timeout)
+                if not self._items:
+                    raise queue.Empty
+            enqueued_at, item = self._items.popleft()
+            self.dequeued += 1
+            self._not_full.notify()
+        
+        wait = time.monotonic() - enqueued_at
+        if wait > self.delay_threshold:
+            self.delayed += 1
+        if wait > self.max_wait:
+            self.max_wait = wait
+        return item
+    
+    def qsize(self):
+        return len(self._items)
+    
+    def empty(self):
+        return not self._items
+    
+    def stats(self):
+        """Get queue counters"""
+        return {
+            'policy': self.policy,
+            'depth': len(self._items),
+            'capacity': self.maxsize,
+            'max_depth': self.max_depth,
+            'enqueued': self.enqueued,
+            'dequeued': self.dequeued,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+            'blocked': self.blocked,
+            'delayed': self.delayed,
+            'max_wait_ms': int(self.max_wait * 1000)
+        }
+    
+    def _drop(self, reason):
+        self.dropped += 1
+        # Log the first drop and then every 1000th, not every message of an overload
+        if self.dropped % 1000 == 1:
+            print(f"✗ {reason} ({self.dropped} dropped so far)")
+
+def queue_from_env(name, prefix, default_size, default_policy):
+    """Build a BoundedQueue from <prefix>_QUEUE_SIZE and <prefix>_OVERFLOW_POLICY"""
+    return BoundedQueue(
+        name,
+        int(os.getenv(f'{prefix}_QUEUE_SIZE', default_size)),
+        os.getenv(f'{prefix}_OVERFLOW_POLICY', default_policy)
+    )
+
+class MessageLane:
+    def __init__(self, name, message_queue, app=None):
+        self.name = name
+        self.app = app
+        self.queue = message_queue
+        self._thread = None
+        self._stop_event = threading.Event()
+        
+        # Counters
+        self.messages_handled = 0
+        self.errors = 0
+    
+    def submit(self, handler, topic, payload, params):
+        """Queue a routed message for this lane's thread (gateway_id is the sampling key)"""
+        return self.queue.put((handler, topic, payload, params), key=params.get('gateway_id'))
+    
+    def start(self):
+        """Start the lane thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name=f'{self.name}-lane', daemon=True)
+        self._thread.start()
+    
+    def stop(self, timeout=10):
+        """Stop the lane thread after draining its queue"""
+        if not self._thread:
+            return
+        
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+    
+    def stats(self):
+        """Get lane counters"""
+        return dict(self.queue.stats(), messages_handled=self.messages_handled, errors=self.errors)
+    
+    def _run(self):
+        """Lane loop: handle messages in arrival order until stopped and empty"""
+        with self.app.app_context():
+            while not self._stop_event.is_set() or not self.queue.empty():
+                try:
+                    handler, topic, payload, params = self.queue.get(timeout=0.25)
+                except queue.Empty:
+                    continue
+                try:
+                    handler(topic, payload, **params)
+                    self.messages_handled += 1
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Error handling {self.name} message on {topic}: {e}")
@@ -0,0 +1,100 @@
+"""
+Multi-process ingest worker
+Each worker process runs its own MQTT client subscribed to the gateway data/status
+topics through a $share/<group>/ subscription, so the broker load-balances
+messages across processes, and its own writer/heartbeat pipeline.
+Workers publish their stats to apru40/backend/ingest/{worker_id}/stats.
+"""
+import json
+import os
+import signal
+import socket
+import threading
+import time
+from app.services.catchup import catchup
+from app.services.clock_skew import clock_skew
+from app.services.dedup import duplicate_filter
+from app.services.heartbeat import heartbeat_buffer
+from app.services.liveness import liveness_tracker
+from app.services.mqtt_service import mqtt_service, WORKER_STATS_PATTERN
+from app.services.partitions import partition_router
+from app.services.payload_decoder import payload_decoder
+from app.services.registry import device_registry
+from app.services.rollups import rollup_store
+from app.services.sensor_store import sensor_store
+
+def collect_stats(worker_id, started_at, previous=None, interval=None):
+    """Build a stats snapshot for one worker"""
+    writer_stats = mqtt_service.data_writer().stats()
+    stats = {
+        'worker_id': worker_id,
+        'pid': os.getpid(),
+        'uptime': round(time.time() - started_at, 1),
+        'mqtt': mqtt_service.connection_stats(),
+        'catchup': catchup.stats(),
+        'decoder': payload_decoder.stats(),
+        'queues': mqtt_service.queue_stats(),
+        'writer': writer_stats,
+        'dedup': duplicate_filter.stats(),
+        'event_time': clock_skew.stats(),
+        'heartbeat': heartbeat_buffer.stats(),
+        'liveness': liveness_tracker.stats(),
+        'registry': device_registry.stats(),
+        'series': sensor_store.stats(),
+        'partitions': partition_router.stats(),
+        'rollups': rollup_store.stats()
+    }
+    
+    # Rates over the last stats interval
+    if previous and interval:
+        stats['messages_per_sec'] = round(
+            (writer_stats['messages_received'] - previous['writer']['messages_received']) / interval, 1
+        )
+        stats['rows_per_sec'] = round(
+            (writer_stats['rows_written'] - previous['writer']['rows_written']) / interval, 1
+        )
+    
+    return stats
+
+def run_worker(index):
+    """Run one ingest worker until SIGTERM/SIGINT"""
+    if mqtt_service.role != 'ingest-worker':
+        raise RuntimeError("APRU40_ROLE must be 'ingest-worker' before the app is imported")
+    
+    worker_id = f"{socket.gethostname()}-{index}"
+    stats_interval = float(os.getenv('INGEST_WORKER_STATS_INTERVAL', 10))
+    stop_event = threading.Event()
+    
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    
+    # Without a Socket.IO message queue nobody can receive this process's emits
+    writer = mqtt_service.data_writer()
+    writer.emit_enabled = bool(os.getenv('SOCKETIO_MESSAGE_QUEUE'))
+    liveness_tracker.emit_enabled = writer.emit_enabled
+    
+    # One session per worker: every worker process inherits MQTT_CLIENT_ID
+    if mqtt_service.client_id:
+        mqtt_service.client_id = f"{mqtt_service.client_id}-{index}"
+    else:
+        mqtt_service.client_id = f"apru40-ingest-{worker_id}"
+    mqtt_service.connect()
+    # No-op for the threaded writer (started with the app); the asyncio engine connects here
+    writer.start()
+    print(f"✓ Ingest worker {worker_id} started (pid {os.getpid()})")
+    
+    started_at = time.time()
+    previous = None
+    while not stop_event.wait(stats_interval):
+        stats = collect_stats(worker_id, started_at, previous, stats_interval)
+        previous = stats
+        if mqtt_service.client:
+            mqtt_service.client.publish(WORKER_STATS_PATTERN.format(worker_id=worker_id), json.dumps(stats))
+    
+    # Stop receiving, then drain the lanes and writer and flush heartbeats
+    mqtt_service.disconnect()
+    mqtt_service.stop_lanes()
+    writer.stop()
+    heartbeat_buffer.stop()
+    liveness_tracker.stop()
+    print(f"Ingest worker {worker_id} stopped")
@@ -0,0 +1,374 @@
+"""
+In-process MQTT broker stand-in
+A broker and a paho-compatible client that live in the same process, for
+hermetic tests and benchmarks of the MQTT pipeline without mosquitto or
+sockets. Set MQTT_TRANSPORT=inproc and MQTTService connects to the global
+inproc_broker instead of MQTT_BROKER:MQTT_PORT.
+
+Supported: + and # wildcards, $share/<group>/<filter> shared subscriptions
+(round-robin over connected members), QoS 0/1 (QoS 1 messages are queued for
+disconnected persistent sessions), retained messages and wills. Messages are
+delivered synchronously on the publisher's thread, so a publish returns once
+every subscriber's on_message has run. Not supported: QoS 2, ACLs, keepalive.
+    
+    client = InProcessClient(inproc_broker, client_id='gateway-sim')
+    client.connect()
+    client.publish('apru40/gateway/GW001/status', '{"status": "online"}', qos=1)
+"""
+import collections
+import itertools
+import threading
+import uuid
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.reasoncodes import ReasonCode
+
+SHARED_PREFIX = '$share/'
+MAX_QUEUED = 1000  # QoS 1 messages kept per disconnected persistent session
+MAX_CACHED_TOPICS = 100000
+
+def _to_bytes(payload):
+    """Convert a publish payload the way paho does"""
+    if payload is None:
+        return b''
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    if isinstance(payload, (int, float)):
+        return str(payload).encode('ascii')
+    raise TypeError('payload must be a string, bytearray, int, float or None.')
+
+def _split_shared(topic_filter):
+    """Split '$share/<group>/<filter>' into (group, filter); group is None for other filters"""
+    if topic_filter.startswith(SHARED_PREFIX):
+        group, _, shared_filter = topic_filter[len(SHARED_PREFIX):].partition('/')
+        if not group or not shared_filter:
+            raise ValueError(f"Invalid shared subscription '{topic_filter}'")
+        return group, shared_filter
+    return None, topic_filter
+
+class _Session:
+    def __init__(self, client_id, clean_session):
+        self.client_id = client_id
+        self.clean_session = clean_session
+        self.client = None
+        self.subscriptions = {}  # filter as subscribed (including $share/...) -> qos
+        self.queued = collections.deque(maxlen=MAX_QUEUED)
+
+class InProcessBroker:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._sessions = {}
+        self._retained = {}       # topic -> (payload, qos)
+        self._match_cache = {}    # topic -> [(session, qos)] of plain subscriptions
+        self._shared = {}         # (group, filter) -> {client_id: qos}
+        self._shared_turns = {}   # (group, filter) -> round-robin counter
+        
+        # Counters
+        self.published = 0
+        self.delivered = 0
+        self.queued = 0
+        self.unmatched = 0
+        self.errors = 0
+    
+    def reset(self):
+        """Forget every session, subscription and retained message"""
+        with self._lock:
+            for session in self._sessions.values():
+                if session.client:
+                    session.client._connected = False
+            self._sessions.clear()
+            self._retained.clear()
+            self._match_cache.clear()
+            self._shared.clear()
+            self._shared_turns.clear()
+            self.published = self.delivered = self.queued = self.unmatched = self.errors = 0
+    
+    def connect(self, client):
+        """Attach a client to its session; returns session_present"""
+        with self._lock:
+            session = self._sessions.get(client.client_id)
+            if session and session.client is not None and session.client is not client:
+                # Same client id connecting again: the broker drops the older connection
+                session.client._lost()
+            session_present = session is not None and not client.clean_session and not session.clean_session
+            if not session_present:
+                if session:
+                    self._remove_subscriptions(session)
+                session = self._sessions[client.client_id] = _Session(client.client_id, client.clean_session)
+            session.client = client
+        return session_present
+    
+    def deliver_queued(self, client):
+        """Deliver what a persistent session queued while its client was away (after CONNACK)"""
+        with self._lock:
+            session = self._sessions.get(client.client_id)
+            if session is None or session.client is not client:
+                return
+            queued = list(session.queued)
+            session.queued.clear()
+        
+        for topic, payload, qos in queued:
+            self._deliver(session, topic, payload, qos, False)
+    
+    def disconnect(self, client, unexpected=False):
+        """Detach a client, publishing its will if the connection was lost"""
+        with self._lock:
+            session = self._sessions.get(client.client_id)
+            if session is None or session.client is not client:
+                return
+            session.client = None
+            if session.clean_session:
+                self._remove_subscriptions(session)
+                del self._sessions[client.client_id]
+        
+        if unexpected and client._will:
+            self.publish(*client._will)
+    
+    def subscribe(self, client, topic_filter, qos):
+        """Add a subscription and deliver matching retained messages (not to shared subscriptions)"""
+        group, plain_filter = _split_shared(topic_filter)
+        with self._lock:
+            session = self._sessions[client.client_id]
+            session.subscriptions[topic_filter] = qos
+            if group is not None:
+                self._shared.setdefault((group, plain_filter), {})[client.client_id] = qos
+            self._match_cache.clear()
+            retained = [] if group is not None else [
+                (topic, payload, min(qos, retained_qos))
+                for topic, (payload, retained_qos) in self._retained.items()
+                if mqtt.topic_matches_sub(plain_filter, topic)
+            ]
+        
+        for topic, payload, delivered_qos in retained:
+            self._deliver(session, topic, payload, delivered_qos, True)
+    
+    def unsubscribe(self, client, topic_filter):
+        with self._lock:
+            session = self._sessions.get(client.client_id)
+            if session and session.subscriptions.pop(topic_filter, None) is not None:
+                self._forget_shared(session.client_id, topic_filter)
+                self._match_cache.clear()
+    
+    def publish(self, topic, payload, qos=0, retain=False):
+        """Route a message to every matching subscription; returns the number of deliveries"""
+        if not topic or '+' in topic or '#' in topic:
+            raise ValueError(f"Invalid publish topic '{topic}'")
+        
+        with self._lock:
+            self.published += 1
+            if retain:
+                # An empty retained message clears the topic's retained message
+                if payload:
+                    self._retained[topic] = (payload, qos)
+                else:
+                    self._retained.pop(topic, None)
+            targets = self._match_cache.get(topic)
+            if targets is None:
+                if len(self._match_cache) >= MAX_CACHED_TOPICS:
+                    self._match_cache.clear()
+                targets = self._match_cache[topic] = [
+                    (session, subscribed_qos)
+                    for session in self._sessions.values()
+                    for topic_filter, subscribed_qos in session.subscriptions.items()
+                    if not topic_filter.startswith(SHARED_PREFIX)
+                    and mqtt.topic_matches_sub(topic_filter, topic)
+                ]
+            targets = targets + self._shared_targets(topic)
+        
+        if not targets:
+            self.unmatched += 1
+        for session, subscribed_qos in targets:
+            self._deliver(session, topic, payload, min(qos, subscribed_qos), False)
+        return len(targets)
+    
+    def stats(self):
+        """Get broker counters"""
+        with self._lock:
+            return {
+                'sessions': len(self._sessions),
+                'connected': sum(1 for session in self._sessions.values() if session.client is not None),
+                'retained': len(self._retained),
+                'published': self.published,
+                'delivered': self.delivered,
+                'queued': self.queued,
+                'unmatched': self.unmatched,
+                'errors': self.errors
+            }
+    
+    def _shared_targets(self, topic):
+        """Pick one member of every matching shared subscription group, preferring connected ones"""
+        targets = []
+        for key, members in self._shared.items():
+            if not members or not mqtt.topic_matches_sub(key[1], topic):
+                continue
+            client_ids = sorted(members)
+            connected = [client_id for client_id in client_ids if self._sessions[client_id].client is not None]
+            candidates = connected or client_ids
+            turn = self._shared_turns.setdefault(key, itertools.count())
+            client_id = candidates[next(turn) % len(candidates)]
+            targets.append((self._sessions[client_id], members[client_id]))
+        return targets
+    
+    def _deliver(self, session, topic, payload, qos, retain):
+        client = session.client
+        if client is None:
+            # Only persistent sessions outlive their connection
+            if qos >= 1 and not session.clean_session:
+                session.queued.append((topic, payload, qos))
+                self.queued += 1
+            return
+        
+        self.delivered += 1
+        try:
+            client._receive(topic, payload, qos, retain)
+        except Exception as e:
+            self.errors += 1
+            print(f"Error in {session.client_id} on_message for {topic}: {e}")
+    
+    def _remove_subscriptions(self, session):
+        for topic_filter in session.subscriptions:
+            self._forget_shared(session.client_id, topic_filter)
+        session.subscriptions.clear()
+        self._match_cache.clear()
+    
+    def _forget_shared(self, client_id, topic_filter):
+        group, plain_filter = _split_shared(topic_filter)
+        if group is not None:
+            self._shared.get((group, plain_filter), {}).pop(client_id, None)
+
+class InProcessClient:
+    """Subset of paho.mqtt.client.Client (callback API version 2) backed by an InProcessBroker"""
+    
+    def __init__(self, broker, client_id='', clean_session=True, userdata=None, protocol=mqtt.MQTTv311):
+        self.broker = broker
+        self.client_id = client_id or f"inproc-{uuid.uuid4().hex[:12]}"
+        self.clean_session = clean_session
+        self.protocol = protocol
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_message = None
+        self.on_publish = None
+        self._userdata = userdata
+        self._will = None
+        self._connected = False
+        self._connect_pending = False
+        self._mids = itertools.count(1)
+    
+    def user_data_set(self, userdata):
+        self._userdata = userdata
+    
+    def username_pw_set(self, username, password=None):
+        pass
+    
+    def will_set(self, topic, payload=None, qos=0, retain=False, properties=None):
+        self._will = (topic, _to_bytes(payload), qos, retain)
+    
+    def max_inflight_messages_set(self, inflight):
+        pass
+    
+    def max_queued_messages_set(self, queue_size):
+        pass
+    
+    def reconnect_delay_set(self, min_delay=1, max_delay=120):
+        pass
+    
+    def is_connected(self):
+        return self._connected
+    
+    def connect(self, host=None, port=None, keepalive=60, *args, **kwargs):
+        """Connect to the broker; on_connect and delivery of queued messages run before this returns"""
+        self._connect_pending = False
+        session_present = self.broker.connect(self)
+        self._connected = True
+        if self.on_connect:
+            self.on_connect(self, self._userdata, mqtt.ConnectFlags(session_present),
+                            ReasonCode(PacketTypes.CONNACK, 'Success'), None)
+        self.broker.deliver_queued(self)
+        return mqtt.MQTT_ERR_SUCCESS
+    
+    def connect_async(self, host=None, port=None, keepalive=60, *args, **kwargs):
+        """Connect once the loop is started, as paho does"""
+        self._connect_pending = True
+    
+    def reconnect(self):
+        if self._connected:
+            self._disconnected(unexpected=False)
+        return self.connect()
+    
+    def loop_start(self):
+        if self._connect_pending:
+            self.connect()
+        return mqtt.MQTT_ERR_SUCCESS
+    
+    def loop_stop(self):
+        return mqtt.MQTT_ERR_SUCCESS
+    
+    def disconnect(self, reasoncode=None, properties=None):
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN
+        self._disconnected(unexpected=False)
+        return mqtt.MQTT_ERR_SUCCESS
+    
+    def subscribe(self, topic, qos=0, options=None, properties=None):
+        """Subscribe to one filter or a list of (filter, qos)"""
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+        filters = topic if isinstance(topic, list) else [(topic, qos)]
+        for topic_filter, filter_qos in filters:
+            self.broker.subscribe(self, topic_filter, min(filter_qos, 1))
+        return mqtt.MQTT_ERR_SUCCESS, next(self._mids)
+    
+    def unsubscribe(self, topic, properties=None):
+        if not self._connected:
+            return mqtt.MQTT_ERR_NO_CONN, None
+        for topic_filter in topic if isinstance(topic, list) else [topic]:
+            self.broker.unsubscribe(self, topic_filter)
+        return mqtt.MQTT_ERR_SUCCESS, next(self._mids)
+    
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None):
+        """Publish; the message is delivered to every subscriber before this returns"""
+        info = mqtt.MQTTMessageInfo(next(self._mids))
+        if not self._connected:
+            info.rc = mqtt.MQTT_ERR_NO_CONN
+            return info
+        self.broker.publish(topic, _to_bytes(payload), min(qos, 1), retain)
+        info.rc = mqtt.MQTT_ERR_SUCCESS
+        info._set_as_published()
+        # The broker has the message: acknowledged (PUBACK) right away
+        if self.on_publish:
+            self.on_publish(self, self._userdata, info.mid, ReasonCode(PacketTypes.PUBACK, 'Success'), None)
+        return info
+    
+    def drop(self):
+        """Simulate a lost connection: the broker publishes the will"""
+        if self._connected:
+            self._disconnected(unexpected=True)
+    
+    def _lost(self):
+        """Connection taken over by another client with the same id"""
+        self._connected = False
+        self._notify_disconnect('Session taken over')
+    
+    def _disconnected(self, unexpected):
+        self._connected = False
+        self.broker.disconnect(self, unexpected)
+        self._notify_disconnect('Unspecified error' if unexpected else 'Normal disconnection')
+    
+    def _notify_disconnect(self, reason):
+        if self.on_disconnect:
+            self.on_disconnect(self, self._userdata, mqtt.DisconnectFlags(False),
+                               ReasonCode(PacketTypes.DISCONNECT, reason), None)
+    
+    def _receive(self, topic, payload, qos, retain):
+        if self.on_message is None:
+            return
+        message = mqtt.MQTTMessage(next(self._mids), topic.encode('utf-8'))
+        message.payload = payload
+        message.qos = qos
+        message.retain = retain
+        self.on_message(self, self._userdata, message)
+
+# Global in-process broker (MQTT_TRANSPORT=inproc)
+inproc_broker = InProcessBroker()
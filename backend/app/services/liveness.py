@@ -0,0 +1,361 @@
+"""
+Liveness tracker: automatic offline detection for gateways and nodes
+Every heartbeat recorded by the heartbeat buffer (data messages for gateways
+and their nodes, status messages for gateways) pushes the device's deadline to
+now + LIVENESS_MISSED_HEARTBEATS x its expected report interval: the shortest
+enabled acquisition period in a node's adc_config (LIVENESS_NODE_INTERVAL
+without one), LIVENESS_GATEWAY_INTERVAL for gateways, never less than
+LIVENESS_MIN_INTERVAL. Deadlines live in a hashed timing wheel, so a heartbeat
+is a dict update and a tick every LIVENESS_TICK seconds only looks at the slot
+that expires, whatever the fleet size.
+Expired devices are marked offline with one bulk UPDATE per table, guarded on
+last_seen so a device another ingest process heard from meanwhile stays online,
+and announced as gateway_status/node_status events. A heartbeat from a device
+that is offline announces it online again. A status message reporting offline
+(e.g. the gateway's last will) stops tracking the gateway.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, or_
+from app import db
+from app.models.iot import Gateway, Node
+from app.services.websocket import emit_event
+
+GATEWAY = 'gateway'
+NODE = 'node'
+
+# Rows per SELECT ... WHERE id IN (...)
+CHUNK_SIZE = 500
+
+def report_period(adc_config):
+    """Shortest enabled acquisition period of an adc_config in seconds, None if it has none"""
+    periods = []
+    
+    def collect(config, in_periods=False):
+        for key, value in config.items():
+            if isinstance(value, dict):
+                collect(value, key == 'periods')
+            elif isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0:
+                if in_periods:
+                    periods.append(value / 1000.0)
+                elif key.endswith('period_ms') and config.get(key[:-len('period_ms')] + 'enabled') is not False:
+                    periods.append(value / 1000.0)
+    
+    if isinstance(adc_config, dict):
+        collect(adc_config)
+    return min(periods) if periods else None
+
+class TimerWheel:
+    """Hashed timing wheel of deadlines (monotonic seconds) keyed by device
+    
+    A key sits in the slot of its deadline's tick. Moving a deadline later only
+    updates the deadlines dict; the key is re-slotted when its old slot expires.
+    Deadlines beyond one revolution come around again until they are due.
+    """
+    
+    def __init__(self, tick, slots, now=None):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}  # key -> deadline
+        self._slot_of = {}   # key -> index of the slot holding it
+        self._cursor = int((time.monotonic() if now is None else now) // tick)  # next tick to expire
+    
+    def __len__(self):
+        return len(self.deadlines)
+    
+    def __contains__(self, key):
+        return key in self.deadlines
+    
+    def schedule(self, key, deadline):
+        """Set a key's deadline"""
+        previous = self.deadlines.get(key)
+        self.deadlines[key] = deadline
+        if previous is not None:
+            if deadline >= previous:
+                return
+            self.slots[self._slot_of[key]].discard(key)
+        self._insert(key, deadline)
+    
+    def cancel(self, key):
+        """Stop tracking a key"""
+        if self.deadlines.pop(key, None) is not None:
+            self.slots[self._slot_of.pop(key)].discard(key)
+    
+    def advance(self, now):
+        """Expire the slots up to now; returns the keys whose deadline has passed"""
+        expired = []
+        last = int(now // self.tick)
+        # After a stall every slot is visited once
+        self._cursor = max(self._cursor, last - len(self.slots) + 1)
+        while self._cursor <= last:
+            index = self._cursor % len(self.slots)
+            slot, self.slots[index] = self.slots[index], set()
+            self._cursor += 1
+            for key in slot:
+                deadline = self.deadlines[key]
+                if deadline <= now:
+                    del self.deadlines[key]
+                    del self._slot_of[key]
+                    expired.append(key)
+                else:
+                    self._insert(key, deadline)
+        return expired
+    
+    def _insert(self, key, deadline):
+        index = max(-int(-deadline // self.tick), self._cursor) % len(self.slots)
+        self.slots[index].add(key)
+        self._slot_of[key] = index
+
+class LivenessTracker:
+    def __init__(self, app=None):
+        self.app = app
+        self.tick = float(os.getenv('LIVENESS_TICK', 1))
+        self.missed_heartbeats = float(os.getenv('LIVENESS_MISSED_HEARTBEATS', 3))
+        self.gateway_interval = float(os.getenv('LIVENESS_GATEWAY_INTERVAL', 30))
+        self.node_interval = float(os.getenv('LIVENESS_NODE_INTERVAL', 30))
+        self.min_interval = float(os.getenv('LIVENESS_MIN_INTERVAL', 10))
+        self.refresh_interval = float(os.getenv('LIVENESS_REFRESH_INTERVAL', 300))
+        self.wheel = TimerWheel(self.tick, int(os.getenv('LIVENESS_WHEEL_SLOTS', 4096)))
+        self.emit_enabled = True
+        self._lock = threading.Lock()
+        self._periods = {}     # node PK -> report period from adc_config (seconds)
+        self._arrived = set()  # keys heard from while untracked: back online?
+        self._offline = set()  # keys this tracker marked offline
+        self._thread = None
+        self._stop_event = threading.Event()
+        
+        # Counters
+        self.heartbeats = 0
+        self.transitions = {(kind, status): 0 for kind in (GATEWAY, NODE) for status in ('offline', 'online')}
+        self.checks = 0
+        self.errors = 0
+    
+    def timeout(self, kind, pk):
+        """Seconds of silence after which a device is offline"""
+        if kind == GATEWAY:
+            interval = self.gateway_interval
+        else:
+            interval = self._periods.get(pk) or self.node_interval
+        return self.missed_heartbeats * max(interval, self.min_interval)
+    
+    def heartbeat(self, kind, pk, status='online'):
+        """Push a device's deadline back (O(1)); an offline status stops tracking it"""
+        key = (kind, pk)
+        with self._lock:
+            self.heartbeats += 1
+            if status == 'offline':
+                self.wheel.cancel(key)
+                self._arrived.discard(key)
+                self._offline.discard(key)
+                return
+            if key not in self.wheel:
+                self._arrived.add(key)
+            self.wheel.schedule(key, time.monotonic() + self.timeout(kind, pk))
+    
+    def set_node_config(self, node_pk, adc_config):
+        """Use a node's new adc_config from its next heartbeat on"""
+        period = report_period(adc_config)
+        with self._lock:
+            if period:
+                self._periods[node_pk] = period
+            else:
+                self._periods.pop(node_pk, None)
+    
+    def load_periods(self):
+        """Read every node's report period from its adc_config"""
+        periods = {}
+        for node_pk, adc_config in db.session.query(Node.id, Node.adc_config).filter(Node.adc_config.isnot(None)):
+            period = report_period(adc_config)
+            if period:
+                periods[node_pk] = period
+        db.session.rollback()
+        self._periods = periods
+    
+    def seed(self):
+        """Track devices the database shows online, so ones that never report again go offline"""
+        now = time.monotonic()
+        keys = [(GATEWAY, pk) for pk, in db.session.query(Gateway.id).filter(Gateway.status == 'online')]
+        keys += [(NODE, pk) for pk, in db.session.query(Node.id).filter(Node.status == 'online')]
+        db.session.rollback()
+        with self._lock:
+            for key in keys:
+                if key not in self.wheel:
+                    self.wheel.schedule(key, now + self.timeout(*key))
+        return len(keys)
+    
+    def start(self):
+        """Start the tick thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='liveness-tracker', daemon=True)
+        self._thread.start()
+        print(f"✓ Liveness tracker started (offline after {self.missed_heartbeats:g} missed heartbeats, "
+              f"tick={self.tick:g}s)")
+    
+    def stop(self, timeout=10):
+        """Stop the tick thread"""
+        if not self._thread:
+            return
+        
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+    
+    def stats(self):
+        """Get tracker counters"""
+        with self._lock:
+            tracked_gateways = sum(1 for kind, _ in self.wheel.deadlines if kind == GATEWAY)
+            tracked = len(self.wheel)
+            offline = len(self._offline)
+        return {
+            'tracked_gateways': tracked_gateways,
+            'tracked_nodes': tracked - tracked_gateways,
+            'offline_marked': offline,
+            'configured_nodes': len(self._periods),
+            'missed_heartbeats': self.missed_heartbeats,
+            'heartbeats': self.heartbeats,
+            'gateways_offline': self.transitions[(GATEWAY, 'offline')],
+            'gateways_online': self.transitions[(GATEWAY, 'online')],
+            'nodes_offline': self.transitions[(NODE, 'offline')],
+            'nodes_online': self.transitions[(NODE, 'online')],
+            'checks': self.checks,
+            'errors': self.errors
+        }
+    
+    def _run(self):
+        """Tick loop: expire deadlines every tick, reload node periods every refresh_interval"""
+        with self.app.app_context():
+            refreshed_at = 0
+            while not self._stop_event.wait(self.tick):
+                try:
+                    if time.monotonic() - refreshed_at >= self.refresh_interval:
+                        refreshed_at = time.monotonic()
+                        self.load_periods()
+                        if not self.checks:
+                            self.seed()
+                except Exception as e:
+                    print(f"Error loading liveness state: {e}")
+                    db.session.rollback()
+                self.check()
+    
+    def check(self):
+        """Mark devices whose deadline passed offline and devices heard from again online"""
+        with self._lock:
+            expired = self.wheel.advance(time.monotonic())
+            arrived, self._arrived = self._arrived, set()
+            returned = arrived & self._offline
+        self.checks += 1
+        if not expired and not arrived:
+            return 0
+        
+        try:
+            changes = self._mark_offline(expired) + self._mark_online(arrived, returned)
+            db.session.commit()
+        except Exception as e:
+            self.errors += 1
+            print(f"Error updating device liveness: {e}")
+            db.session.rollback()
+            # Retry with the next tick unless a heartbeat arrived meanwhile
+            with self._lock:
+                retry_at = time.monotonic() + self.tick
+                for key in expired:
+                    if key not in self.wheel:
+                        self.wheel.schedule(key, retry_at)
+                self._arrived |= arrived
+            return 0
+        
+        with self._lock:
+            for kind, pk, status, _ in changes:
+                if status == 'offline':
+                    # Not re-announced if it is back before the event goes out
+                    if (kind, pk) not in self.wheel:
+                        self._offline.add((kind, pk))
+                else:
+                    self._offline.discard((kind, pk))
+        for kind, pk, status, data in changes:
+            self.transitions[(kind, status)] += 1
+            if self.emit_enabled:
+                emit_event('gateway_status' if kind == GATEWAY else 'node_status', data)
+        return len(changes)
+    
+    def _select(self, kind, pks, *criteria):
+        """(pk, last_seen, event payload) of the given devices matching criteria, in chunks"""
+        rows = []
+        for start in range(0, len(pks), CHUNK_SIZE):
+            chunk = pks[start:start + CHUNK_SIZE]
+            if kind == GATEWAY:
+                query = db.session.query(Gateway.id, Gateway.last_seen, Gateway.gateway_id).filter(
+                    Gateway.id.in_(chunk), *criteria)
+                rows += [(pk, last_seen, {'gateway_id': gateway_identifier})
+                         for pk, last_seen, gateway_identifier in query]
+            else:
+                query = db.session.query(Node.id, Node.last_seen, Node.node_id, Gateway.gateway_id).join(
+                    Gateway, Node.gateway_id == Gateway.id).filter(Node.id.in_(chunk), *criteria)
+                rows += [(pk, last_seen, {'id': pk, 'node_id': node_number, 'gateway_id': gateway_identifier})
+                         for pk, last_seen, node_number, gateway_identifier in query]
+        return rows
+    
+    def _mark_offline(self, keys):
+        """Bulk UPDATE expired devices not seen within their timeout (by any process) to offline"""
+        changes = []
+        now = datetime.utcnow()
+        for kind, model in ((GATEWAY, Gateway), (NODE, Node)):
+            pks = [pk for key_kind, pk in keys if key_kind == kind]
+            if not pks:
+                continue
+            
+            updates = []
+            for pk, last_seen, data in self._select(kind, pks, model.status != 'offline'):
+                cutoff = now - timedelta(seconds=self.timeout(kind, pk))
+                if last_seen is not None and last_seen >= cutoff:
+                    continue
+                updates.append({'_id': pk, 'cutoff': cutoff})
+                data.update(status='offline', timestamp=now.isoformat(),
+                            last_seen=last_seen.isoformat() if last_seen else None)
+                changes.append((kind, pk, 'offline', data))
+            
+            if updates:
+                table = model.__table__
+                db.session.execute(
+                    table.update().where(
+                        table.c.id == bindparam('_id'),
+                        or_(table.c.last_seen.is_(None), table.c.last_seen < bindparam('cutoff'))
+                    ).values(status='offline'),
+                    updates
+                )
+        return changes
+    
+    def _mark_online(self, keys, returned):
+        """Bulk UPDATE devices heard from while offline (marked by this or another process) to online"""
+        changes = []
+        now = datetime.utcnow()
+        for kind, model in ((GATEWAY, Gateway), (NODE, Node)):
+            pks = [pk for key_kind, pk in keys if key_kind == kind]
+            if not pks:
+                continue
+            
+            # Marked here: announced even if the heartbeat buffer already wrote 'online'
+            ours = [pk for pk in pks if (kind, pk) in returned]
+            others = [pk for pk in pks if (kind, pk) not in returned]
+            updates = []
+            for pk, last_seen, data in self._select(kind, ours) + self._select(kind, others, model.status == 'offline'):
+                updates.append({'_id': pk})
+                data.update(status='online', timestamp=now.isoformat(),
+                            last_seen=last_seen.isoformat() if last_seen else None)
+                changes.append((kind, pk, 'online', data))
+            
+            if updates:
+                table = model.__table__
+                db.session.execute(
+                    table.update().where(table.c.id == bindparam('_id'), table.c.status == 'offline').values(
+                        status='online'),
+                    updates
+                )
+        return changes
+
+# Global liveness tracker instance
+liveness_tracker = LivenessTracker()
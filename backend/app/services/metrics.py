@@ -0,0 +1,211 @@
+"""
+Low-overhead metrics with Prometheus text exposition
+Counters and histograms keep one value dict per thread, so the MQTT, writer
+and lane threads update them without locks or lost increments; a scrape sums
+the per-thread values (and folds those of finished threads into a retired
+total). Gauges and callback metrics are evaluated at scrape time only.
+    
+    messages = metrics.counter('apru40_mqtt_messages_total', 'MQTT messages received', ['topic'])
+    messages.inc('data')
+    decode_seconds = metrics.histogram('apru40_decode_seconds', 'Payload decode time', ['topic'])
+    decode_seconds.observe(elapsed, 'data')
+"""
+import bisect
+import math
+import threading
+
+# Seconds, from 50us (a cached lookup) to 10s (a stalled commit)
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class _ThreadLocalMetric:
+    """Base for metrics whose values live in one dict per writing thread"""
+    type = None
+    
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._shards = {}   # thread -> that thread's value dict
+        self._retired = {}  # values of finished threads
+        self._shards_lock = threading.Lock()
+    
+    def _shard(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._shards_lock:
+                self._shards[threading.current_thread()] = values
+            return values
+    
+    def _snapshots(self):
+        """Copy every thread's values, folding finished threads into the retired total"""
+        with self._shards_lock:
+            for thread in [thread for thread in self._shards if not thread.is_alive()]:
+                self._merge(self._retired, self._shards.pop(thread))
+            # dict() copies atomically under the GIL while the owner keeps writing
+            return [dict(values) for values in self._shards.values()] + [dict(self._retired)]
+    
+    def _merge(self, target, values):
+        raise NotImplementedError
+
+class Counter(_ThreadLocalMetric):
+    type = 'counter'
+    
+    def inc(self, *label_values, amount=1):
+        """Increment the counter of these label values"""
+        try:
+            self._local.values[label_values] += amount
+        except (AttributeError, KeyError):
+            values = self._shard()
+            values[label_values] = values.get(label_values, 0) + amount
+    
+    def _merge(self, target, values):
+        for key, value in values.items():
+            target[key] = target.get(key, 0) + value
+    
+    def collect(self):
+        """Get {label values: total} across threads"""
+        totals = {}
+        for values in self._snapshots():
+            self._merge(totals, values)
+        return totals
+    
+    def expose(self):
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+                for key, value in sorted(self.collect().items())]
+
+class Histogram(_ThreadLocalMetric):
+    type = 'histogram'
+    
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+    
+    def observe(self, value, *label_values):
+        """Record one observation for these label values"""
+        try:
+            series = self._local.values[label_values]
+        except (AttributeError, KeyError):
+            # Per-bucket counts (+Inf last), then sum
+            series = self._shard()[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+    
+    def _merge(self, target, values):
+        for key, series in values.items():
+            merged = target.get(key)
+            if merged is None:
+                target[key] = list(series)
+            else:
+                for index, value in enumerate(series):
+                    merged[index] += value
+    
+    def collect(self):
+        """Get {label values: (cumulative bucket counts, sum, count)} across threads"""
+        totals = {}
+        for values in self._snapshots():
+            self._merge(totals, values)
+        
+        result = {}
+        for key, series in totals.items():
+            cumulative = []
+            running = 0
+            for count in series[:-1]:
+                running += count
+                cumulative.append(running)
+            result[key] = (cumulative, series[-1], running)
+        return result
+    
+    def expose(self):
+        lines = []
+        for key, (cumulative, total, count) in sorted(self.collect().items()):
+            for bound, bucket_count in zip(self.buckets + (math.inf,), cumulative):
+                labels = _format_labels(self.label_names, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class CallbackMetric:
+    """Gauge or counter read from existing state at scrape time"""
+    
+    def __init__(self, name, documentation, callback, label_names=(), type='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.label_names = tuple(label_names)
+        self.type = type
+    
+    def expose(self):
+        value = self.callback()
+        if not isinstance(value, dict):
+            value = {(): value}
+        return [f"{self.name}{_format_labels(self.label_names, key if isinstance(key, tuple) else (key,))} "
+                f"{_format_value(sample)}"
+                for key, sample in sorted(value.items()) if sample is not None]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+    
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+    
+    def counter(self, name, documentation, label_names=()):
+        """Get or create a counter"""
+        return self._register(Counter(name, documentation, label_names))
+    
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        """Get or create a histogram"""
+        return self._register(Histogram(name, documentation, label_names, buckets))
+    
+    def callback(self, name, documentation, callback, label_names=(), type='gauge'):
+        """Register a gauge/counter whose value(s) callback() returns at scrape time"""
+        return self._register(CallbackMetric(name, documentation, callback, label_names, type))
+    
+    def expose(self):
+        """Render every metric in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.expose()
+            except Exception as e:
+                print(f"Error collecting metric {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+# Global metrics registry
+metrics = MetricsRegistry()
@@ -4,11 +4,46 @@ Handles both node data reception and gateway management
 """
 import paho.mqtt.client as mqtt
 from paho.mqtt.client import CallbackAPIVersion
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import os
 import json
+import time
 from datetime import datetime
-from app import db, socketio
-from app.models.iot import Gateway, Node, SensorData
+from app.services.alert_pipeline import alert_pipeline
+from app.services.catchup import catchup
+from app.services.command_rpc import command_rpc
+from app.services.config_rollout import config_hash, config_rollout, node_config
+from app.services.heartbeat import heartbeat_buffer
+from app.services.ingest import sensor_writer
+from app.services.ingest_queue import MessageLane, queue_from_env
+from app.services.inproc_broker import InProcessClient, inproc_broker
+from app.services.metrics import metrics
+from app.services.outbox import outbox
+from app.services.payload_decoder import payload_decoder
+from app.services.registry import device_registry
+from app.services.topic_router import TopicRouter, to_filter
+from app.services.websocket import emit_event
+
+# Topic patterns routed by TopicRouter ({name} captures one level, {name#} the rest)
+DATA_TOPICS = ['apru40/gateway/{gateway_id}/data', 'apru40/{gateway_id}/data']
+DATA_BIN_TOPICS = ['apru40/gateway/{gateway_id}/data/bin', 'apru40/{gateway_id}/data/bin']
+STATUS_TOPICS = ['apru40/gateway/{gateway_id}/status', 'apru40/{gateway_id}/status']
+ALERT_PATTERNS = ['apru40/gateway/{gateway_id}/alert/{alert_path#}', 'apru40/{gateway_id}/alert/{alert_path#}']
+CONFIG_ACK_PATTERNS = ['apru40/gateway/{gateway_id}/config/node/{node}/ack', 'apru40/{gateway_id}/config/node/{node}/ack']
+COMMAND_REPLY_PATTERNS = ['apru40/gateway/{gateway_id}/cmd/reply', 'apru40/{gateway_id}/cmd/reply']
+WORKER_STATS_PATTERN = 'apru40/backend/ingest/{worker_id}/stats'
+# Device registry invalidations, from the API process to every ingest worker
+REGISTRY_TOPIC = 'apru40/backend/registry/invalidate'
+
+# Gateway data/status topics, load-balanced across ingest workers in worker mode
+INGEST_TOPICS = [to_filter(pattern) for pattern in DATA_TOPICS + DATA_BIN_TOPICS + STATUS_TOPICS]
+ALERT_TOPICS = [to_filter(pattern) for pattern in ALERT_PATTERNS]
+CONFIG_ACK_TOPICS = [to_filter(pattern) for pattern in CONFIG_ACK_PATTERNS]
+COMMAND_REPLY_TOPICS = [to_filter(pattern) for pattern in COMMAND_REPLY_PATTERNS]
+
+MQTT_MESSAGES = metrics.counter('apru40_mqtt_messages_total', 'MQTT messages received per topic kind', ['topic'])
+MQTT_DECODE_SECONDS = metrics.histogram('apru40_mqtt_decode_seconds', 'MQTT payload decode duration', ['topic'])
 
 class MQTTService:
     def __init__(self, app=None):
@@ -18,229 +53,384 @@ class MQTTService:
         self.port = int(os.getenv('MQTT_PORT', 1883))
         self.username = os.getenv('MQTT_USERNAME', '')
         self.password = os.getenv('MQTT_PASSWORD', '')
+        self.client_id = os.getenv('MQTT_CLIENT_ID', '')
+        # Persistent session: the broker keeps the subscriptions and queues QoS 1 messages for
+        # MQTT_SESSION_EXPIRY seconds while this client is away (0: clean session every connect).
+        # Only resumed under an explicit client id (see session_client_id)
+        self.session_expiry = int(os.getenv('MQTT_SESSION_EXPIRY', 3600))
+        self.persistent_session = self.session_expiry > 0 and bool(self.client_id)
+        self.subscribe_qos = int(os.getenv('MQTT_SUBSCRIBE_QOS', 1))
+        self.keepalive = int(os.getenv('MQTT_KEEPALIVE', 60))
+        self.reconnect_min_delay = int(os.getenv('MQTT_RECONNECT_MIN_DELAY', 1))
+        self.reconnect_max_delay = int(os.getenv('MQTT_RECONNECT_MAX_DELAY', 60))
+        self.connected = False
+        self.connects = 0
+        self.sessions_resumed = 0
+        self.disconnects = 0
+        # 'tcp' connects to MQTT_BROKER, 'inproc' to the in-process broker (tests, benchmarks)
+        self.transport = os.getenv('MQTT_TRANSPORT', 'tcp')
+        self.protocol = None
+        
+        # 'web' runs the API (and ingest unless INGEST_MODE=workers), 'ingest-worker' only ingests
+        self.role = os.getenv('APRU40_ROLE', 'web')
+        self.ingest_mode = os.getenv('INGEST_MODE', 'embedded')
+        self.shared_group = os.getenv('MQTT_SHARED_GROUP', 'apru40-backend')
+        # 'threaded' ingests data on the paho thread + writer thread, 'asyncio' in async_ingest
+        self.ingest_engine = os.getenv('INGEST_ENGINE', 'threaded')
+        # MQTT v5 (command ResponseTopic/CorrelationData, session expiry) unless MQTT_PROTOCOL=3.1.1
+        # for a broker without it; ingest workers need v5 for $share subscriptions
+        self.mqtt_v5 = self.role == 'ingest-worker' or os.getenv('MQTT_PROTOCOL', '5') != '3.1.1'
+        self.worker_stats = {}
+        self._worker_seen = {}  # worker_id -> monotonic time of its last stats
+        # Workers silent for this long (3 stats intervals) are dropped from worker_stats
+        self.worker_stats_expiry = 3 * float(os.getenv('INGEST_WORKER_STATS_INTERVAL', 10))
+        if self.role == 'web' and self.ingest_mode == 'workers':
+            device_registry.listener = self.publish_registry_invalidation
         
+        # Priority lanes: alerts and status get their own bounded queue and thread so a
+        # /data backlog (sensor_writer's queue) never delays them
+        self.alert_lane = MessageLane('alert', queue_from_env('alert', 'INGEST_ALERT', 1000, 'block'))
+        self.status_lane = MessageLane('status', queue_from_env('status', 'INGEST_STATUS', 1000, 'drop-oldest'))
+        
+        # Each route is (kind, handler, decoder, lane): kind labels the metrics, data payloads
+        # are decoded into typed structs, routes without a lane are handled on the MQTT thread
+        self.router = TopicRouter()
+        for pattern in DATA_TOPICS:
+            self.router.add(pattern, ('data', self.handle_sensor_data, payload_decoder.decode_gateway_data, None))
+        for pattern in DATA_BIN_TOPICS:
+            self.router.add(pattern, ('data_bin', self.handle_sensor_data, payload_decoder.decode_gateway_data_bin, None))
+        for pattern in STATUS_TOPICS:
+            self.router.add(pattern, ('status', self.handle_status, payload_decoder.decode_json, self.status_lane))
+        for pattern in ALERT_PATTERNS:
+            self.router.add(pattern, ('alert', self.handle_alert, payload_decoder.decode_json, self.alert_lane))
+        for pattern in CONFIG_ACK_PATTERNS:
+            self.router.add(pattern, ('config_ack', self.handle_config_ack, payload_decoder.decode_json, self.status_lane))
+        # Command replies only complete a pending request: handled on the MQTT thread
+        for pattern in COMMAND_REPLY_PATTERNS:
+            self.router.add(pattern, ('command_reply', self.handle_command_reply, payload_decoder.decode_json, None))
+        self.router.add(WORKER_STATS_PATTERN, ('worker_stats', self.handle_worker_stats, payload_decoder.decode_json, None))
+        self.router.add(REGISTRY_TOPIC, ('registry', self.handle_registry_invalidation, payload_decoder.decode_json, None))
+    
+    def lanes(self):
+        """Get the ingest lanes of this process by name (data is the batched writer's queue)"""
+        return {'alert': self.alert_lane, 'status': self.status_lane}
+    
+    def start_lanes(self):
+        """Start the alert/status lane threads"""
+        for lane in self.lanes().values():
+            lane.app = self.app
+            lane.start()
+    
+    def stop_lanes(self):
+        """Stop the alert/status lane threads after draining them"""
+        for lane in self.lanes().values():
+            lane.stop()
+    
+    def data_writer(self):
+        """Get the component writing this process's sensor data (sensor_writer or async_ingest)"""
+        if self.ingest_engine == 'asyncio':
+            from app.services.async_ingest import async_ingest
+            return async_ingest
+        return sensor_writer
+    
+    def queue_stats(self):
+        """Get counters of every ingest queue, highest priority first"""
+        return {
+            'alert': self.alert_lane.stats(),
+            'status': self.status_lane.stats(),
+            'data': self.data_writer().queue.stats()
+        }
+        
+    def connection_stats(self):
+        """Get broker connection and session counters"""
+        return {
+            'client_id': self.session_client_id() or None,
+            'protocol': '5' if self.mqtt_v5 else '3.1.1',
+            'connected': self.connected,
+            'persistent_session': self.persistent_session,
+            'session_expiry': self.session_expiry,
+            'connects': self.connects,
+            'sessions_resumed': self.sessions_resumed,
+            'disconnects': self.disconnects
+        }
+    
+    def endpoint(self):
+        """Describe the broker this service connects to"""
+        return 'in-process broker' if self.transport == 'inproc' else f"{self.broker}:{self.port}"
+    
+    def ingest_subscriptions(self):
+        """Get the gateway data/status topic filters this process ingests"""
+        if self.role == 'ingest-worker':
+            # Shared subscription: the broker delivers each message to one worker of the group
+            return [f"$share/{self.shared_group}/{topic}" for topic in INGEST_TOPICS]
+        if self.ingest_mode == 'workers':
+            return []
+        return INGEST_TOPICS
+    
+    def subscriptions(self):
+        """Get the topic filters this process's paho client subscribes to"""
+        # The asyncio engine subscribes to the ingest topics on its own connection
+        ingest = self.ingest_subscriptions() if self.ingest_engine != 'asyncio' else []
+        if self.role == 'ingest-worker':
+            # Not shared: every worker keeps its own device registry
+            return ingest + [REGISTRY_TOPIC]
+        if self.ingest_mode == 'workers':
+            return ALERT_TOPICS + CONFIG_ACK_TOPICS + COMMAND_REPLY_TOPICS + [to_filter(WORKER_STATS_PATTERN)]
+        return ingest + ALERT_TOPICS + CONFIG_ACK_TOPICS + COMMAND_REPLY_TOPICS
+    
+    def session_client_id(self):
+        """Client id: MQTT_CLIENT_ID (ingest workers: one per worker), else a random id with a
+        clean session. An id derived from the host would be shared by every process of the host
+        (the debug reloader, several web processes) and the broker would hand the session back
+        and forth between them"""
+        return self.client_id
+    
+    def connect_properties(self):
+        """MQTT v5 CONNECT properties: the session expiry of a persistent session"""
+        if not self.persistent_session:
+            return None
+        properties = Properties(PacketTypes.CONNECT)
+        properties.SessionExpiryInterval = self.session_expiry
+        return properties
+    
     def on_connect(self, client, userdata, flags, rc, properties=None):
-        """Callback when connected to MQTT broker"""
+        """Callback when connected to MQTT broker (also after every automatic reconnection)"""
         if rc == 0:
-            print(f"✓ Connected to MQTT Broker at {self.broker}:{self.port}")
-            # Subscribe to APRU40 topics
-            client.subscribe('apru40/+/data')
-            client.subscribe('apru40/+/alert/#')
-            client.subscribe('apru40/+/status')
-            # Subscribe to gateway topics
-            client.subscribe('apru40/gateway/+/data')
-            client.subscribe('apru40/gateway/+/status')
+            self.connected = True
+            self.connects += 1
+            resumed = self.persistent_session and flags.session_present
+            print(f"✓ Connected to MQTT Broker at {self.endpoint()}"
+                  f"{' (session resumed)' if resumed else ''}")
+            # Subscribe to APRU40 topics again: harmless on a resumed session, required on a new one
+            subscriptions = self.subscriptions()
+            if resumed:
+                # The session may still hold ingest subscriptions of another INGEST_ENGINE/INGEST_MODE
+                ingest_topics = INGEST_TOPICS + [f"$share/{self.shared_group}/{topic}" for topic in INGEST_TOPICS]
+                stale = [topic for topic in ingest_topics if topic not in subscriptions]
+                if stale:
+                    client.unsubscribe(stale)
+            if subscriptions:
+                client.subscribe([(topic, self.subscribe_qos) for topic in subscriptions])
             print(f"✓ Subscribed to APRU40 topics")
+            
+            # The broker now delivers what it queued meanwhile: drain it as a backlog
+            if resumed:
+                self.sessions_resumed += 1
+                if self.ingest_subscriptions() and self.ingest_engine != 'asyncio':
+                    catchup.begin('session', self.data_writer().queue)
         else:
             print(f"✗ Failed to connect to MQTT broker, return code {rc}")
     
+    def on_disconnect(self, client, userdata, flags, rc, properties=None):
+        """Callback when the connection is closed or lost (paho reconnects on its own)"""
+        self.connected = False
+        self.disconnects += 1
+        if rc != 0:
+            print(f"✗ Lost connection to MQTT broker ({rc}), reconnecting")
+    
+    def on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        """Callback when the broker acknowledged a published message"""
+        outbox.acknowledge(mid)
+    
+    def decode_message(self, topic, raw):
+        """Route and decode one message: (kind, handler, lane, payload, params), or None to drop it"""
+        # Route on the topic first so unroutable messages are never decoded
+        route = self.router.route(topic)
+        if route is None:
+            MQTT_MESSAGES.inc('unrouted')
+            return None
+        
+        (kind, handler, decode, lane), params = route
+        MQTT_MESSAGES.inc(kind)
+        # Malformed payloads are counted by the decoder and dropped
+        started = time.perf_counter()
+        payload = decode(raw)
+        MQTT_DECODE_SECONDS.observe(time.perf_counter() - started, kind)
+        if payload is None:
+            return None
+        return kind, handler, lane, payload, params
+    
     def on_message(self, client, userdata, msg):
         """Callback when message received"""
         try:
-            payload = json.loads(msg.payload.decode())
-            topic = msg.topic
-            
-            print(f"Received message on {topic}: {json.dumps(payload, indent=2)}")
+            message = self.decode_message(msg.topic, msg.payload)
+            if message is None:
+                return
             
-            # Handle different topic types
-            if '/data' in topic:
-                self.handle_sensor_data(topic, payload)
-            elif '/status' in topic:
-                self.handle_status(topic, payload)
-            elif '/alert' in topic:
-                self.handle_alert(topic, payload)
+            kind, handler, lane, payload, params = message
+            if kind == 'command_reply' and isinstance(payload, dict) and 'correlation_id' not in payload:
+                # MQTT v5 replies may carry the correlation id as a property only
+                correlation = getattr(getattr(msg, 'properties', None), 'CorrelationData', None)
+                if correlation:
+                    payload['correlation_id'] = correlation.decode(errors='replace')
+            if lane is not None:
+                lane.submit(handler, msg.topic, payload, params)
+            else:
+                handler(msg.topic, payload, **params)
                 
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON from MQTT message: {e}")
         except Exception as e:
             print(f"Error processing MQTT message: {e}")
     
-    def handle_sensor_data(self, topic, payload):
-        """Handle sensor data messages from gateways"""
-        try:
-            # Parse gateway_id from topic: apru40/gateway/{gateway_id}/data
-            parts = topic.split('/')
-            if len(parts) >= 3 and parts[1] == 'gateway':
-                gateway_identifier = parts[2]
-            else:
-                print(f"Unable to parse gateway_id from topic: {topic}")
-                return
-            
-            # Get gateway from database
-            gateway = Gateway.query.filter_by(gateway_id=gateway_identifier).first()
-            if not gateway:
-                print(f"Gateway not found: {gateway_identifier}")
-                return
-            
-            # Update gateway last_seen and status
-            gateway.last_seen = datetime.utcnow()
-            gateway.status = 'online'
-            
-            # Process nodes data
-            nodes_data = payload.get('nodes', [])
-            for node_data in nodes_data:
-                node_identifier = node_data.get('node_id')
-                if node_identifier is None:
-                    continue
-                
-                # Get or create node
-                node = Node.query.filter_by(
-                    gateway_id=gateway.id,
-                    node_id=node_identifier
-                ).first()
-                
-                if not node:
-                    print(f"Node {node_identifier} not found for gateway {gateway_identifier}, skipping...")
-                    continue
-                
-                # Update node status
-                node.status = 'online'
-                node.last_seen = datetime.utcnow()
-                node.rssi = node_data.get('rssi')
-                node.battery_level = node_data.get('battery')
-                
-                # Update QR code if present
-                qr_code = node_data.get('qr_code')
-                if qr_code:
-                    node.last_qr_code = qr_code
-                
-                # Process sensor data
-                sensors = node_data.get('sensors', {})
-                for adc_type, channels in sensors.items():
-                    for channel_key, channel_data in channels.items():
-                        # Extract channel number from key (e.g., "ch0" -> 0)
-                        channel_num = int(channel_key.replace('ch', ''))
-                        
-                        # Create sensor data record
-                        sensor_record = SensorData(
-                            node_id=node.id,
-                            timestamp=datetime.utcnow(),
-                            adc_type=adc_type,
-                            channel=channel_num,
-                            raw_value=channel_data.get('raw'),
-                            converted_value=channel_data.get('value'),
-                            unit=channel_data.get('unit'),
-                            qr_code=qr_code
-                        )
-                        db.session.add(sensor_record)
-            
-            # Commit all changes
-            db.session.commit()
-            
-            # Broadcast to WebSocket clients
-            socketio.emit('sensor_data', {
-                'gateway_id': gateway_identifier,
-                'timestamp': datetime.utcnow().isoformat(),
-                'nodes': nodes_data
-            }, namespace='/')
-            
-            print(f"✓ Processed sensor data from gateway {gateway_identifier}")
-            
-        except Exception as e:
-            print(f"Error handling sensor data: {e}")
-            db.session.rollback()
+    def handle_sensor_data(self, topic, payload, gateway_id):
+        """Queue decoded sensor data messages (GatewayData) for the batched writer"""
+        sensor_writer.submit(gateway_id, payload, datetime.utcnow())
     
-    def handle_status(self, topic, payload):
+    def handle_status(self, topic, payload, gateway_id):
         """Handle status/heartbeat messages"""
         try:
-            # Parse gateway_id from topic
-            parts = topic.split('/')
-            if len(parts) >= 3 and parts[1] == 'gateway':
-                gateway_identifier = parts[2]
-            else:
-                return
+            with self.app.app_context():
+                gateway_pk = device_registry.resolve_gateway(gateway_id)
             
-            # Update gateway status
-            gateway = Gateway.query.filter_by(gateway_id=gateway_identifier).first()
-            if gateway:
-                gateway.last_seen = datetime.utcnow()
-                gateway.status = payload.get('status', 'online')
-                db.session.commit()
+            if gateway_pk is not None:
+                # Update gateway status (written behind by the heartbeat buffer)
+                status = payload.get('status', 'online')
+                heartbeat_buffer.record_gateway(gateway_pk, datetime.utcnow(), status)
                 
                 # Broadcast status update
-                socketio.emit('gateway_status', {
-                    'gateway_id': gateway_identifier,
-                    'status': gateway.status,
+                emit_event('gateway_status', {
+                    'gateway_id': gateway_id,
+                    'status': status,
                     'timestamp': datetime.utcnow().isoformat()
-                }, namespace='/')
+                })
                 
         except Exception as e:
             print(f"Error handling status: {e}")
-            db.session.rollback()
     
-    def handle_alert(self, topic, payload):
-        """Handle alert messages"""
-        # TODO: Create alert in database and emit via WebSocket
-        print(f"Alert received: {payload}")
-        pass
+    def handle_worker_stats(self, topic, payload, worker_id):
+        """Keep the latest stats published by each ingest worker"""
+        payload['received_at'] = datetime.utcnow().isoformat()
+        self.worker_stats[worker_id] = payload
+        self._worker_seen[worker_id] = time.monotonic()
+        self.live_worker_stats()
     
-    def publish_node_config(self, node):
-        """Publish configuration update to a node via MQTT"""
-        if not self.client:
-            return False
-        
+    def live_worker_stats(self):
+        """Get the latest stats of each ingest worker, dropping workers silent for worker_stats_expiry"""
+        expired = time.monotonic() - self.worker_stats_expiry
+        for worker_id, seen in list(self._worker_seen.items()):
+            if seen < expired:
+                self._worker_seen.pop(worker_id, None)
+                self.worker_stats.pop(worker_id, None)
+        return dict(self.worker_stats)
+    
+    def handle_registry_invalidation(self, topic, payload):
+        """Apply a device registry invalidation published by the API process"""
+        if isinstance(payload, dict):
+            device_registry.apply(payload)
+    
+    def publish_registry_invalidation(self, invalidation):
+        """Forward a device registry invalidation to the ingest workers (device_registry listener)"""
+        if self.client:
+            self.client.publish(REGISTRY_TOPIC, json.dumps(invalidation), qos=1)
+    
+    def handle_alert(self, topic, payload, gateway_id=None, alert_path=''):
+        """Hand an alert to the alert pipeline (suppression, batched insert, throttled alert:new)"""
+        alert_pipeline.submit(gateway_id, alert_path, payload)
+    
+    def handle_config_ack(self, topic, payload, gateway_id=None, node=None):
+        """Hand a node's config acknowledgement to the rollout engine"""
+        try:
+            config_rollout.acknowledge(gateway_id, int(node), payload)
+        except ValueError:
+            print(f"Invalid config acknowledgement topic: {topic}")
+    
+    def handle_command_reply(self, topic, payload, gateway_id=None):
+        """Hand a gateway's command reply to the command RPC layer"""
+        command_rpc.handle_reply(gateway_id, payload)
+    
+    def publish_node_config(self, node, config_id=None, config=None):
+        """Queue a configuration update for a node via its gateway (acknowledged with config_id)"""
         try:
             # Build config payload
+            config = config or node_config(node)
             config_payload = {
                 'cmd': 'update_config',
                 'node_id': node.node_id,
-                'config': {
-                    'acquisition': node.adc_config if node.adc_config else {},
-                    'conversions': node.sensor_conversions if node.sensor_conversions else {},
-                    'bluetooth': {
-                        'enabled': node.bluetooth_enabled,
-                        'scanner_model': node.scanner_model
-                    }
-                },
+                'config_id': config_id,
+                'config_hash': config_hash(config),
+                'config': config,
                 'timestamp': datetime.utcnow().isoformat()
             }
             
-            # Publish to gateway's command topic
-            topic = f"apru40/node/{node.node_id}/config"
-            self.client.publish(topic, json.dumps(config_payload))
-            
-            print(f"✓ Published config update for node {node.node_id}")
+            # Sent to the node's topic under its gateway by the outbox (QoS 1); a newer config
+            # for the node replaces this one while it is still queued
+            topic = f"apru40/{node.gateway.gateway_id}/config/node/{node.node_id}"
+            outbox.enqueue('config', topic, config_payload, gateway_id=node.gateway.gateway_id,
+                           reference=config_id, key=f"config:{node.id}")
             return True
             
         except Exception as e:
-            print(f"Error publishing node config: {e}")
+            print(f"Error queuing node config: {e}")
             return False
     
-    def publish_gateway_command(self, gateway, command, params=None):
-        """Publish command to a gateway via MQTT"""
-        if not self.client:
-            return False
-        
+    def publish_gateway_command(self, gateway, command, params=None, correlation_id=None, reply_to=None,
+                                expires_in=None):
+        """Queue a command to a gateway (a request expecting a reply with correlation_id)"""
         try:
             command_payload = {
                 'command': command,
                 'params': params if params else {},
                 'timestamp': datetime.utcnow().isoformat()
             }
+            properties = None
+            if correlation_id:
+                command_payload['correlation_id'] = correlation_id
+                command_payload['reply_to'] = reply_to
+                # Set as ResponseTopic/CorrelationData when the client speaks MQTT v5
+                properties = {'response_topic': reply_to, 'correlation_data': correlation_id}
             
-            topic = f"{gateway.mqtt_topic_prefix}/cmd"
-            self.client.publish(topic, json.dumps(command_payload))
-            
-            print(f"✓ Published command '{command}' to gateway {gateway.gateway_id}")
+            # Sent by the outbox (QoS 1); dropped if still undelivered after expires_in seconds
+            topic = f"{gateway.mqtt_topic_prefix or 'apru40/' + gateway.gateway_id}/cmd"
+            outbox.enqueue('command', topic, command_payload, gateway_id=gateway.gateway_id,
+                           reference=correlation_id, expires_in=expires_in, properties=properties)
             return True
             
         except Exception as e:
-            print(f"Error publishing gateway command: {e}")
+            print(f"Error queuing gateway command: {e}")
             return False
     
     def connect(self):
         """Connect to MQTT broker"""
         try:
             # Use CallbackAPIVersion.VERSION2 for paho-mqtt 2.x
-            self.client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2)
+            protocol = mqtt.MQTTv5 if self.mqtt_v5 else mqtt.MQTTv311
+            self.protocol = protocol
+            # Ingest workers set their client id after the app is created
+            self.persistent_session = self.session_expiry > 0 and bool(self.client_id)
+            if self.session_expiry > 0 and not self.client_id:
+                print("MQTT_CLIENT_ID not set: clean session (set a unique MQTT_CLIENT_ID per process "
+                      "to resume sessions)")
+            # v3.1.1 keeps the session with clean_session=False, v5 with clean_start=False + expiry
+            clean_session = None if protocol == mqtt.MQTTv5 else not self.persistent_session
+            if self.transport == 'inproc':
+                self.client = InProcessClient(inproc_broker, client_id=self.session_client_id(),
+                                              clean_session=not self.persistent_session, protocol=protocol)
+            else:
+                self.client = mqtt.Client(
+                    callback_api_version=CallbackAPIVersion.VERSION2,
+                    client_id=self.session_client_id(),
+                    clean_session=clean_session,
+                    protocol=protocol
+                )
             self.client.on_connect = self.on_connect
+            self.client.on_disconnect = self.on_disconnect
             self.client.on_message = self.on_message
+            self.client.on_publish = self.on_publish
+            # The outbox bounds the messages awaiting PUBACK; paho must not queue behind a lower limit
+            self.client.max_inflight_messages_set(outbox.inflight_window)
+            self.client.reconnect_delay_set(self.reconnect_min_delay, self.reconnect_max_delay)
             
             if self.username and self.password:
                 self.client.username_pw_set(self.username, self.password)
             
-            print(f"Connecting to MQTT broker at {self.broker}:{self.port}...")
-            self.client.connect(self.broker, self.port, 60)
+            # Connected by the network loop, which keeps retrying (with backoff) while the
+            # broker is unreachable, at startup as after a lost connection
+            print(f"Connecting to MQTT broker at {self.endpoint()}...")
+            if protocol == mqtt.MQTTv5:
+                self.client.connect_async(self.broker, self.port, self.keepalive,
+                                          clean_start=not self.persistent_session,
+                                          properties=self.connect_properties())
+            else:
+                self.client.connect_async(self.broker, self.port, self.keepalive)
             self.client.loop_start()
             
         except Exception as e:
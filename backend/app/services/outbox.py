@@ -0,0 +1,297 @@
+"""
+Persistent outbox for outbound MQTT messages
+Gateway commands and node configurations are written to mqtt_outbox (in the
+application database, SQLite by default) with the caller's transaction instead
+of being handed to the MQTT client, so a message queued while the broker is
+unreachable, or just before a restart, is still delivered. A thread in the web
+process publishes queued messages with QoS 1, at most OUTBOX_INFLIGHT of them
+awaiting the broker's PUBACK; an acknowledged message is `delivered`. A
+message the client could not publish, or left unacknowledged for
+OUTBOX_ACK_TIMEOUT seconds, is retried with exponential backoff and `failed`
+after max_attempts; one past its expires_at (a command whose caller stopped
+waiting) is `expired` rather than sent late. A newer message with the same key
+supersedes a queued one, so configs for an unreachable node do not pile up.
+"""
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+from sqlalchemy import bindparam, event, func
+from sqlalchemy.orm import Session
+from app import db
+from app.models.iot import OutboxMessage, generate_uuid
+
+FINISHED = ('delivered', 'failed', 'expired', 'superseded', 'cancelled')
+
+class Outbox:
+    def __init__(self, app=None):
+        self.app = app
+        self.inflight_window = int(os.getenv('OUTBOX_INFLIGHT', 100))
+        self.max_attempts = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
+        self.ack_timeout = float(os.getenv('OUTBOX_ACK_TIMEOUT', 30))
+        self.backoff_base = float(os.getenv('OUTBOX_BACKOFF_BASE', 1))
+        self.backoff_max = float(os.getenv('OUTBOX_BACKOFF_MAX', 300))
+        self.retention = float(os.getenv('OUTBOX_RETENTION', 86400))
+        self.tick = int(os.getenv('OUTBOX_TICK_MS', 500)) / 1000.0
+        self._lock = threading.Lock()
+        self._acks = []      # mids acknowledged by the broker, applied on the next tick
+        self._inflight = {}  # mid -> (message id, monotonic publish time)
+        self._wake = threading.Event()
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._purged_at = 0
+        
+        # Counters
+        self.queued = 0
+        self.messages = dict.fromkeys(('queued', 'sent', 'delivered', 'retried', 'failed', 'expired',
+                                       'superseded'), 0)
+        self.errors = 0
+    
+    def enqueue(self, kind, topic, payload, gateway_id=None, reference=None, key=None, expires_in=None,
+                properties=None, max_attempts=None):
+        """Queue a message in the caller's transaction (published once it commits)"""
+        now = datetime.utcnow()
+        if key:
+            self.messages['superseded'] += OutboxMessage.query.filter(
+                OutboxMessage.key == key, OutboxMessage.status == 'queued'
+            ).update({'status': 'superseded'}, synchronize_session=False)
+        
+        message = OutboxMessage(
+            id=generate_uuid(),
+            kind=kind,
+            topic=topic,
+            payload=payload if isinstance(payload, str) else json.dumps(payload),
+            qos=1,
+            properties=properties,
+            gateway_id=gateway_id,
+            reference=reference,
+            key=key,
+            status='queued',
+            attempts=0,
+            max_attempts=max_attempts or self.max_attempts,
+            created_at=now,
+            next_attempt_at=now,
+            expires_at=now + timedelta(seconds=expires_in) if expires_in else None
+        )
+        db.session.add(message)
+        # Wakes the outbox thread when the caller commits
+        db.session.info['outbox_wake'] = True
+        self.messages['queued'] += 1
+        return message
+    
+    def acknowledge(self, mid):
+        """Record the broker's PUBACK for a message id (called on the MQTT thread)"""
+        with self._lock:
+            self._acks.append(mid)
+        if mid in self._inflight:
+            self._wake.set()
+    
+    def wake(self):
+        """Publish newly queued messages without waiting for the next tick"""
+        self._wake.set()
+    
+    def retry(self, message):
+        """Queue a failed, expired or cancelled message again with fresh attempts"""
+        if message.status not in ('failed', 'expired', 'cancelled'):
+            raise ValueError(f"Message is {message.status}")
+        
+        message.status = 'queued'
+        message.attempts = 0
+        message.error = None
+        message.next_attempt_at = datetime.utcnow()
+        message.expires_at = None
+        db.session.info['outbox_wake'] = True
+        db.session.commit()
+    
+    def cancel(self, message):
+        """Cancel a queued message"""
+        if message.status != 'queued':
+            raise ValueError(f"Message is {message.status}")
+        
+        message.status = 'cancelled'
+        db.session.commit()
+    
+    def start(self):
+        """Start the outbox thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='mqtt-outbox', daemon=True)
+        self._thread.start()
+        print(f"✓ MQTT outbox started (inflight window={self.inflight_window}, "
+              f"max attempts={self.max_attempts})")
+    
+    def stop(self, timeout=10):
+        """Stop the outbox thread (queued messages are sent on the next start)"""
+        if not self._thread:
+            return
+        
+        self._stop_event.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self._thread = None
+    
+    def stats(self):
+        """Get outbox counters"""
+        return {
+            'queued': self.queued,
+            'inflight': len(self._inflight),
+            'inflight_window': self.inflight_window,
+            'max_attempts': self.max_attempts,
+            'ack_timeout': self.ack_timeout,
+            'messages': dict(self.messages),
+            'errors': self.errors
+        }
+    
+    def status_counts(self):
+        """Count stored messages by status"""
+        counts = dict.fromkeys(OutboxMessage.STATUSES, 0)
+        for status, count in db.session.query(OutboxMessage.status, func.count()).group_by(OutboxMessage.status):
+            counts[status] = count
+        return counts
+    
+    def _run(self):
+        """Outbox loop: publish when woken by a commit or every tick"""
+        with self.app.app_context():
+            self._recover()
+            while not self._stop_event.is_set():
+                self._wake.wait(self.tick)
+                self._wake.clear()
+                if self._stop_event.is_set():
+                    break
+                try:
+                    self.step()
+                except Exception as e:
+                    self.errors += 1
+                    print(f"Error running MQTT outbox: {e}")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+    
+    def _recover(self):
+        """Queue messages left in flight by a previous process (their PUBACK can no longer be matched)"""
+        try:
+            recovered = OutboxMessage.query.filter_by(status='inflight').update(
+                {'status': 'queued', 'next_attempt_at': datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+            if recovered:
+                print(f"✓ MQTT outbox: {recovered} messages in flight at shutdown queued again")
+        except Exception as e:
+            print(f"Error recovering MQTT outbox: {e}")
+            db.session.rollback()
+    
+    def step(self):
+        """Apply acknowledgements, retry unacknowledged messages, expire stale ones and publish within the window"""
+        from app.services.mqtt_service import mqtt_service
+        now = datetime.utcnow()
+        self._apply_acks(now)
+        self._retry_unacknowledged(now)
+        
+        self.messages['expired'] += OutboxMessage.query.filter(
+            OutboxMessage.status == 'queued', OutboxMessage.expires_at < now
+        ).update({'status': 'expired', 'error': 'expired before delivery'}, synchronize_session=False)
+        
+        client = mqtt_service.client
+        budget = self.inflight_window - len(self._inflight)
+        if client is not None and client.is_connected() and budget > 0:
+            due = OutboxMessage.query.filter(
+                OutboxMessage.status == 'queued', OutboxMessage.next_attempt_at <= now
+            ).order_by(OutboxMessage.next_attempt_at, OutboxMessage.created_at).limit(budget).all()
+            for message in due:
+                message.attempts += 1
+                message.sent_at = now
+                info = client.publish(message.topic, message.payload, qos=message.qos,
+                                      properties=self._properties(message, mqtt_service.protocol))
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    # Connection lost meanwhile: the rest waits for the reconnection
+                    self._retry(message, now, mqtt.error_string(info.rc))
+                    break
+                message.status = 'inflight'
+                self._inflight[info.mid] = (message.id, time.monotonic())
+                self.messages['sent'] += 1
+            # PUBACKs that arrived before their mid was registered free the window right away
+            with self._lock:
+                if any(mid in self._inflight for mid in self._acks):
+                    self._wake.set()
+        
+        self.queued = OutboxMessage.query.filter_by(status='queued').count()
+        db.session.commit()
+        
+        if time.monotonic() - self._purged_at > 60:
+            self._purge(now)
+    
+    def _apply_acks(self, now):
+        """Mark acknowledged messages delivered"""
+        with self._lock:
+            mids, self._acks = self._acks, []
+        delivered = [{'_id': self._inflight.pop(mid)[0]} for mid in mids if mid in self._inflight]
+        if not delivered:
+            return
+        
+        table = OutboxMessage.__table__
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('_id'), table.c.status == 'inflight').values(
+                status='delivered', delivered_at=now, error=None),
+            delivered
+        )
+        self.messages['delivered'] += len(delivered)
+    
+    def _retry_unacknowledged(self, now):
+        """Retry messages the broker has not acknowledged within ack_timeout"""
+        horizon = time.monotonic() - self.ack_timeout
+        for mid, (message_id, sent) in list(self._inflight.items()):
+            if sent >= horizon:
+                continue
+            del self._inflight[mid]
+            message = db.session.get(OutboxMessage, message_id)
+            if message is not None and message.status == 'inflight':
+                self._retry(message, now, 'no PUBACK from the broker')
+    
+    def _retry(self, message, now, error):
+        """Schedule another attempt with exponential backoff, or fail the message"""
+        message.error = str(error)[:200]
+        if message.attempts >= message.max_attempts:
+            message.status = 'failed'
+            self.messages['failed'] += 1
+            return
+        
+        # Backoff doubles per attempt, jittered so a reconnection does not resend everything at once
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (message.attempts - 1))
+        message.status = 'queued'
+        message.next_attempt_at = now + timedelta(seconds=delay * random.uniform(0.5, 1))
+        self.messages['retried'] += 1
+    
+    def _properties(self, message, protocol):
+        """MQTT v5 publish properties of a message (None for v3.1.1)"""
+        if not message.properties or protocol != mqtt.MQTTv5:
+            return None
+        
+        properties = Properties(PacketTypes.PUBLISH)
+        if message.properties.get('response_topic'):
+            properties.ResponseTopic = message.properties['response_topic']
+        if message.properties.get('correlation_data'):
+            properties.CorrelationData = message.properties['correlation_data'].encode()
+        return properties
+    
+    def _purge(self, now):
+        """Delete finished messages older than the retention"""
+        self._purged_at = time.monotonic()
+        OutboxMessage.query.filter(
+            OutboxMessage.status.in_(FINISHED),
+            OutboxMessage.created_at < now - timedelta(seconds=self.retention)
+        ).delete(synchronize_session=False)
+        db.session.commit()
+
+# Global MQTT outbox instance
+outbox = Outbox()
+
+@event.listens_for(Session, 'after_commit')
+def _wake_outbox(session):
+    if session.info.pop('outbox_wake', False):
+        outbox.wake()
@@ -0,0 +1,219 @@
+"""
+Time partitioning of sensor samples
+Samples are partitioned by event time into periods of SENSOR_PARTITION_INTERVAL
+seconds (one day by default, 0 keeps the single sensor_samples table), so
+retention drops whole partitions instead of deleting rows one index entry at a
+time. On PostgreSQL sensor_samples is a natively range-partitioned table: the
+writer creates sensor_samples_pYYYYMMDD PARTITION OF sensor_samples for the
+periods of each batch and inserts through the parent, and the planner prunes
+partitions a query's time range excludes. On SQLite each period is its own
+sensor_samples_pYYYYMMDD table in the main database (same columns, primary key
+and indexes): the router sends each sample to its period's table and queries
+read the partitions their time range covers, newest first. Freed pages of a
+dropped partition are reused by the next ones.
+
+Partitions are created on demand in the writer's transaction. Duplicate
+suppression (the unique series_id, device_timestamp index) holds within a
+partition. On SQLite the unpartitioned sensor_samples table keeps the rows
+written before partitioning was enabled; it is read after the partitions and
+trimmed row by row. A PostgreSQL sensor_samples created unpartitioned cannot
+be converted in place and is used as a single table. Changing the interval
+applies to partitions created afterwards.
+"""
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import Column, Float, Index, Integer, MetaData, Table, exc, text
+from app.models.iot import EPOCH, SAMPLE_PARTITION_INTERVAL, EpochTime, SensorSample
+
+PREFIX = 'sensor_samples_p'
+RELOAD_INTERVAL = 60  # Seconds a writer trusts its list of partitions
+
+def micros(timestamp):
+    """A naive UTC datetime as EpochTime microseconds"""
+    return (timestamp - EPOCH) // timedelta(microseconds=1)
+
+class PartitionRouter:
+    def __init__(self):
+        self.interval = SAMPLE_PARTITION_INTERVAL
+        self._lock = threading.Lock()
+        self._mode = None
+        self._metadata = MetaData()
+        self._known = set()  # Partition names this writer has seen or created
+        self._loaded_at = 0
+        
+        # Counters
+        self.created = 0
+        self.dropped = 0
+        self.errors = 0
+    
+    def mode(self, connection):
+        """'native' (PostgreSQL partitions), 'tables' (SQLite table per partition) or None (one table)"""
+        if self._mode is None:
+            dialect_name = connection.dialect.name
+            if not self.interval or dialect_name not in ('sqlite', 'postgresql'):
+                self._mode = 'none'
+            elif dialect_name == 'sqlite':
+                self._mode = 'tables'
+            elif connection.execute(text(
+                "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+                "WHERE c.relname = 'sensor_samples'"
+            )).first():
+                self._mode = 'native'
+            else:
+                print("✗ sensor_samples is not partitioned: recreate it to enable SENSOR_PARTITION_INTERVAL")
+                self._mode = 'none'
+        return None if self._mode == 'none' else self._mode
+    
+    def start_of(self, timestamp):
+        """Start of the partition period holding a timestamp"""
+        seconds = (timestamp - EPOCH) // timedelta(seconds=1)
+        return EPOCH + timedelta(seconds=seconds - seconds % self.interval)
+    
+    def name(self, start):
+        """Partition table name of a period"""
+        return PREFIX + start.strftime('%Y%m%d' if self.interval % 86400 == 0 else '%Y%m%d%H%M')
+    
+    def partitions(self, connection):
+        """Existing partitions as [(start, end, name)], oldest first"""
+        if connection.dialect.name == 'sqlite':
+            names = connection.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE :prefix"
+            ), {'prefix': PREFIX + '%'}).scalars().all()
+        else:
+            names = connection.execute(text(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = 'sensor_samples'"
+            )).scalars().all()
+        
+        starts = []
+        for name in names:
+            suffix = name[len(PREFIX):]
+            try:
+                starts.append((datetime.strptime(suffix, '%Y%m%d' if len(suffix) == 8 else '%Y%m%d%H%M'), name))
+            except ValueError:
+                continue
+        starts.sort()
+        
+        with self._lock:
+            self._known = {name for _, name in starts}
+            self._loaded_at = time.monotonic()
+        # A partition ends where the next begins, or one interval after its start
+        return [
+            (start, min(starts[i + 1][0], start + timedelta(seconds=self.interval)) if i + 1 < len(starts)
+             else start + timedelta(seconds=self.interval), name)
+            for i, (start, name) in enumerate(starts)
+        ]
+    
+    def route(self, connection, samples):
+        """Group sensor_samples rows by the table they are inserted into, creating missing
+        partitions; returns [(table, rows)]"""
+        mode = self.mode(connection)
+        if not mode or not samples:
+            return [(SensorSample.__table__, samples)] if samples else []
+        
+        # Samples of a message share their timestamp
+        periods = {}
+        groups = {}
+        for row in samples:
+            timestamp = row['timestamp']
+            start = periods.get(timestamp)
+            if start is None:
+                start = periods[timestamp] = self.start_of(timestamp)
+            groups.setdefault(start, []).append(row)
+        self.ensure(connection, groups)
+        
+        if mode == 'native':
+            return [(SensorSample.__table__, samples)]
+        return [(self._table(self.name(start)), rows) for start, rows in groups.items()]
+    
+    def ensure(self, connection, starts):
+        """Create the partitions of periods that have none yet (in the connection's transaction)"""
+        if time.monotonic() - self._loaded_at > RELOAD_INTERVAL:
+            self.partitions(connection)
+        
+        for start in starts:
+            name = self.name(start)
+            if name in self._known:
+                continue
+            if self.mode(connection) == 'tables':
+                self._table(name).create(connection, checkfirst=True)
+            else:
+                end = start + timedelta(seconds=self.interval)
+                try:
+                    # A concurrent writer may create it first: only the savepoint is rolled back
+                    with connection.begin_nested():
+                        connection.exec_driver_sql(
+                            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF sensor_samples "
+                            f"FOR VALUES FROM ({micros(start)}) TO ({micros(end)})"
+                        )
+                        connection.exec_driver_sql(
+                            f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{name}_reading "
+                            f"ON {name} (series_id, device_timestamp)"
+                        )
+                except exc.DBAPIError as e:
+                    self.errors += 1
+                    print(f"Error creating sensor sample partition {name}: {e}")
+                    continue
+            with self._lock:
+                self._known.add(name)
+            self.created += 1
+            print(f"✓ Sensor sample partition {name} created")
+    
+    def tables(self, connection, start=None, end=None):
+        """Tables to query for samples between start and end, newest first"""
+        if self.mode(connection) != 'tables':
+            return [SensorSample.__table__]
+        
+        return [
+            self._table(name) for partition_start, partition_end, name in reversed(self.partitions(connection))
+            if (end is None or partition_start <= end) and (start is None or partition_end > start)
+        ] + [SensorSample.__table__]
+    
+    def drop_before(self, connection, cutoff):
+        """Drop the partitions holding only samples older than cutoff; returns their names"""
+        if not self.mode(connection):
+            return []
+        
+        dropped = [name for _, end, name in self.partitions(connection) if end <= cutoff]
+        for name in dropped:
+            connection.exec_driver_sql(f"DROP TABLE IF EXISTS {name}")
+            with self._lock:
+                self._known.discard(name)
+                table = self._metadata.tables.get(name)
+                if table is not None:
+                    self._metadata.remove(table)
+        self.dropped += len(dropped)
+        return dropped
+    
+    def stats(self):
+        """Get partitioning settings and counters"""
+        return {
+            'interval': self.interval,
+            'mode': self._mode,
+            'partitions': len(self._known),
+            'created': self.created,
+            'dropped': self.dropped,
+            'errors': self.errors
+        }
+    
+    def _table(self, name):
+        """The SQLite table of a partition"""
+        with self._lock:
+            table = self._metadata.tables.get(name)
+            if table is None:
+                table = Table(
+                    name, self._metadata,
+                    Column('series_id', Integer, primary_key=True),
+                    Column('timestamp', EpochTime, primary_key=True),
+                    Column('device_timestamp', EpochTime, primary_key=True),
+                    Column('raw_value', Integer),
+                    Column('converted_value', Float),
+                    Index(f'idx_{name}_timestamp', 'timestamp'),
+                    Index(f'uq_{name}_reading', 'series_id', 'device_timestamp', unique=True),
+                    sqlite_with_rowid=False
+                )
+            return table
+
+# Global partition router instance
+partition_router = PartitionRouter()
@@ -0,0 +1,429 @@
+"""
+Typed decoding of gateway MQTT payloads
+Decodes the documented apru40/gateway/{id}/data payload straight into typed
+structs (GatewayData -> NodeReport -> ChannelReading) and validates it in the
+same pass. Uses msgspec when installed, otherwise orjson or the stdlib json
+module followed by a hand-written validation pass. Malformed payloads are
+counted and returned as None instead of raising.
+
+Select a backend with PAYLOAD_DECODER=auto|msgspec|orjson|json (default: auto).
+
+Gateways may instead publish the compact binary encoding of the same payload
+on apru40/gateway/{id}/data/bin (layout below); encode_binary is the
+reference encoder, decode_gateway_data_bin decodes into the same structs.
+    
+    header   magic 'A4' | version u8 (1) | flags u8 (bit 0: body is zlib-compressed,
+             at most MAX_DECOMPRESSED bytes once inflated)
+    body     timestamp u32 (0 = none) | node count u16 | nodes...
+    node     node_id u16 | rssi i8 (-128 = none) | battery u16 mV (0xFFFF = none)
+             | qr_code length u8 + UTF-8 bytes (0 = none) | ADC count u8 | ADCs...
+    ADC      type code u8 (ADC_TYPE_CODES, 0xFF = inline: length u8 + UTF-8 name)
+             | channel count u8 | channels...
+    channel  channel u8 | field mask u8 (bit 0: raw, bit 1: value, bit 2: unit)
+             | raw i32 | value f32 (7 significant digits) | unit code u8 (UNIT_CODES, 0xFF = inline)
+
+All integers and floats are little-endian; absent fields are left out.
+"""
+import json
+import os
+import re
+import struct
+import threading
+import zlib
+from typing import Dict, List, Optional
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover - optional dependency
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+CHANNEL_KEY_PATTERN = r'^ch[0-9]+$'
+_channel_key_re = re.compile(CHANNEL_KEY_PATTERN)
+_channel_numbers = {}
+_CHANNEL_CACHE_SIZE = 1024
+
+def channel_number(channel_key):
+    """Get the channel number of a validated channel key ('ch3' -> 3), cached per key"""
+    try:
+        return _channel_numbers[channel_key]
+    except KeyError:
+        number = int(channel_key[2:])
+        if len(_channel_numbers) < _CHANNEL_CACHE_SIZE:
+            _channel_numbers[channel_key] = number
+        return number
+
+if msgspec is not None:
+    from typing import Annotated
+    
+    ChannelKey = Annotated[str, msgspec.Meta(pattern=CHANNEL_KEY_PATTERN)]
+    
+    class ChannelReading(msgspec.Struct):
+        raw: Optional[int] = None
+        value: Optional[float] = None
+        unit: Optional[str] = None
+    
+    class NodeReport(msgspec.Struct):
+        node_id: Optional[int] = None
+        sensors: Dict[str, Dict[ChannelKey, ChannelReading]] = {}
+        qr_code: Optional[str] = None
+        rssi: Optional[int] = None
+        battery: Optional[float] = None
+    
+    class GatewayData(msgspec.Struct):
+        nodes: List[NodeReport] = []
+        gateway_id: Optional[str] = None
+        timestamp: Optional[float] = None
+
+else:
+    class ChannelReading:
+        __slots__ = ('raw', 'value', 'unit')
+        
+        def __init__(self, raw=None, value=None, unit=None):
+            self.raw = raw
+            self.value = value
+            self.unit = unit
+    
+    class NodeReport:
+        __slots__ = ('node_id', 'sensors', 'qr_code', 'rssi', 'battery')
+        
+        def __init__(self, node_id=None, sensors=None, qr_code=None, rssi=None, battery=None):
+            self.node_id = node_id
+            self.sensors = sensors if sensors is not None else {}
+            self.qr_code = qr_code
+            self.rssi = rssi
+            self.battery = battery
+    
+    class GatewayData:
+        __slots__ = ('nodes', 'gateway_id', 'timestamp')
+        
+        def __init__(self, nodes=None, gateway_id=None, timestamp=None):
+            self.nodes = nodes if nodes is not None else []
+            self.gateway_id = gateway_id
+            self.timestamp = timestamp
+
+def to_builtins(value):
+    """Convert decoded structs back to the plain JSON shape of the payload"""
+    if msgspec is not None:
+        return msgspec.to_builtins(value)
+    if isinstance(value, list):
+        return [to_builtins(item) for item in value]
+    if isinstance(value, dict):
+        return {key: to_builtins(item) for key, item in value.items()}
+    if hasattr(value, '__slots__'):
+        return {name: to_builtins(getattr(value, name)) for name in value.__slots__}
+    return value
+
+# Types accepted for optional scalar fields (bool is not a number, as in msgspec)
+_NONE = type(None)
+_OPT_INT = {_NONE, int}
+_OPT_NUMBER = {_NONE, int, float}
+_OPT_STR = {_NONE, str}
+
+def _number(value):
+    return float(value) if type(value) is int else value
+
+def _check_channel_key(channel_key):
+    if channel_key not in _channel_numbers and not (
+        type(channel_key) is str and _channel_key_re.match(channel_key)
+    ):
+        raise ValueError(f"Invalid channel key: {channel_key}")
+
+def _build_reading(obj):
+    if type(obj) is not dict:
+        raise ValueError('Expected channel reading to be an object')
+    raw = obj.get('raw')
+    value = obj.get('value')
+    unit = obj.get('unit')
+    if type(raw) not in _OPT_INT or type(value) not in _OPT_NUMBER or type(unit) not in _OPT_STR:
+        raise ValueError(f"Invalid channel reading: {obj}")
+    return ChannelReading(raw, _number(value), unit)
+
+def _build_node(obj):
+    if type(obj) is not dict:
+        raise ValueError('Expected node to be an object')
+    node_id = obj.get('node_id')
+    qr_code = obj.get('qr_code')
+    rssi = obj.get('rssi')
+    battery = obj.get('battery')
+    if type(node_id) not in _OPT_INT or type(qr_code) not in _OPT_STR or \
+            type(rssi) not in _OPT_INT or type(battery) not in _OPT_NUMBER:
+        raise ValueError(f"Invalid node fields for node {node_id}")
+    sensors = obj.get('sensors', {})
+    if type(sensors) is not dict:
+        raise ValueError('Expected sensors to be an object')
+    
+    decoded_sensors = {}
+    for adc_type, channels in sensors.items():
+        if type(channels) is not dict:
+            raise ValueError(f"Expected sensors.{adc_type} to be an object")
+        decoded_channels = {}
+        for channel_key, reading in channels.items():
+            _check_channel_key(channel_key)
+            decoded_channels[channel_key] = _build_reading(reading)
+        decoded_sensors[adc_type] = decoded_channels
+    
+    return NodeReport(node_id, decoded_sensors, qr_code, rssi, _number(battery))
+
+def _build_gateway_data(obj):
+    if type(obj) is not dict:
+        raise ValueError('Expected payload to be an object')
+    nodes = obj.get('nodes', [])
+    if type(nodes) is not list:
+        raise ValueError('Expected nodes to be an array')
+    gateway_id = obj.get('gateway_id')
+    timestamp = obj.get('timestamp')
+    if type(gateway_id) not in _OPT_STR or type(timestamp) not in _OPT_NUMBER:
+        raise ValueError('Invalid gateway_id or timestamp')
+    return GatewayData([_build_node(node) for node in nodes], gateway_id, _number(timestamp))
+
+# Compact binary encoding (see module docstring)
+BINARY_MAGIC = b'A4'
+BINARY_VERSION = 1
+BINARY_FLAG_ZLIB = 0x01
+MAX_DECOMPRESSED = 1024 * 1024  # Bytes an untrusted zlib body may inflate to
+ADC_TYPE_CODES = ('ads7128', 'ads1119_1', 'ads1119_2')
+UNIT_CODES = ('mA', 'V', 'mV', 'uA', '°C', '%', 'bar', 'kPa')
+_INLINE_CODE = 0xFF
+_FIELD_RAW = 0x01
+_FIELD_VALUE = 0x02
+_FIELD_UNIT = 0x04
+_FIELD_ALL = _FIELD_RAW | _FIELD_VALUE | _FIELD_UNIT
+_NO_RSSI = -128
+_NO_BATTERY = 0xFFFF
+
+_HEADER = struct.Struct('<2sBB')
+_BODY = struct.Struct('<IH')
+_NODE = struct.Struct('<HbHB')
+_CHANNEL = struct.Struct('<BB')
+_RAW = struct.Struct('<i')
+_VALUE = struct.Struct('<f')
+_FULL_CHANNEL = struct.Struct('<BBifB')
+_CHANNEL_KEYS = tuple(f"ch{channel}" for channel in range(256))
+_ADC_TYPE_INDEX = {name: code for code, name in enumerate(ADC_TYPE_CODES)}
+_UNIT_INDEX = {name: code for code, name in enumerate(UNIT_CODES)}
+
+def _pack_name(body, name, index):
+    code = index.get(name)
+    if code is not None:
+        body.append(code)
+    else:
+        encoded = name.encode()
+        body.append(_INLINE_CODE)
+        body.append(len(encoded))
+        body += encoded
+
+def encode_binary(payload, compress=False):
+    """Reference encoder: JSON-shaped gateway data payload -> compact binary payload"""
+    nodes = payload.get('nodes', [])
+    body = bytearray(_BODY.pack(int(payload.get('timestamp') or 0), len(nodes)))
+    
+    for node in nodes:
+        rssi = node.get('rssi')
+        battery = node.get('battery')
+        qr_code = (node.get('qr_code') or '').encode()
+        sensors = node.get('sensors', {})
+        body += _NODE.pack(
+            node['node_id'],
+            _NO_RSSI if rssi is None else rssi,
+            _NO_BATTERY if battery is None else round(battery * 1000),
+            len(qr_code)
+        )
+        body += qr_code
+        body.append(len(sensors))
+        
+        for adc_type, channels in sensors.items():
+            _pack_name(body, adc_type, _ADC_TYPE_INDEX)
+            body.append(len(channels))
+            for channel_key, reading in channels.items():
+                raw = reading.get('raw')
+                value = reading.get('value')
+                unit = reading.get('unit')
+                mask = 0
+                if raw is not None:
+                    mask |= _FIELD_RAW
+                if value is not None:
+                    mask |= _FIELD_VALUE
+                if unit is not None:
+                    mask |= _FIELD_UNIT
+                body += _CHANNEL.pack(channel_number(channel_key), mask)
+                if raw is not None:
+                    body += _RAW.pack(raw)
+                if value is not None:
+                    body += _VALUE.pack(value)
+                if unit is not None:
+                    _pack_name(body, unit, _UNIT_INDEX)
+    
+    flags = 0
+    if compress:
+        body = zlib.compress(bytes(body))
+        flags |= BINARY_FLAG_ZLIB
+    return _HEADER.pack(BINARY_MAGIC, BINARY_VERSION, flags) + bytes(body)
+
+def _unpack_name(body, offset, codes):
+    code = body[offset]
+    if code != _INLINE_CODE:
+        return codes[code], offset + 1
+    length = body[offset + 1]
+    end = offset + 2 + length
+    if end > len(body):
+        raise ValueError('Truncated inline name')
+    return body[offset + 2:end].decode(), end
+
+def _decode_binary(raw):
+    """Decode a compact binary payload to GatewayData (raises on malformed input)"""
+    magic, version, flags = _HEADER.unpack_from(raw, 0)
+    if magic != BINARY_MAGIC:
+        raise ValueError(f"Bad magic {magic!r}")
+    if version != BINARY_VERSION:
+        raise ValueError(f"Unsupported binary payload version {version}")
+    body = raw[_HEADER.size:]
+    if flags & BINARY_FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(body, MAX_DECOMPRESSED)
+        if decompressor.unconsumed_tail:
+            raise ValueError(f"Compressed body inflates beyond {MAX_DECOMPRESSED} bytes")
+    
+    timestamp, node_count = _BODY.unpack_from(body, 0)
+    offset = _BODY.size
+    nodes = []
+    for _ in range(node_count):
+        node_id, rssi, battery, qr_length = _NODE.unpack_from(body, offset)
+        offset += _NODE.size
+        qr_code = body[offset:offset + qr_length].decode() if qr_length else None
+        offset += qr_length
+        adc_count = body[offset]
+        offset += 1
+        
+        sensors = {}
+        for _ in range(adc_count):
+            adc_type, offset = _unpack_name(body, offset, ADC_TYPE_CODES)
+            channel_count = body[offset]
+            offset += 1
+            channels = {}
+            for _ in range(channel_count):
+                channel, mask = _CHANNEL.unpack_from(body, offset)
+                if mask == _FIELD_ALL and body[offset + _FULL_CHANNEL.size - 1] != _INLINE_CODE:
+                    # Fast path: every field present, unit from the code table
+                    _, _, raw_value, value, unit_code = _FULL_CHANNEL.unpack_from(body, offset)
+                    offset += _FULL_CHANNEL.size
+                    channels[_CHANNEL_KEYS[channel]] = ChannelReading(
+                        raw_value, float('%.7g' % value), UNIT_CODES[unit_code]
+                    )
+                    continue
+                offset += _CHANNEL.size
+                raw_value = value = unit = None
+                if mask & _FIELD_RAW:
+                    raw_value, = _RAW.unpack_from(body, offset)
+                    offset += _RAW.size
+                if mask & _FIELD_VALUE:
+                    value, = _VALUE.unpack_from(body, offset)
+                    # Drop float32 noise (45.3 -> 45.29999923706055) so values match the JSON path
+                    value = float('%.7g' % value)
+                    offset += _VALUE.size
+                if mask & _FIELD_UNIT:
+                    unit, offset = _unpack_name(body, offset, UNIT_CODES)
+                channels[_CHANNEL_KEYS[channel]] = ChannelReading(raw_value, value, unit)
+            sensors[adc_type] = channels
+        
+        nodes.append(NodeReport(
+            node_id, sensors, qr_code,
+            None if rssi == _NO_RSSI else rssi,
+            None if battery == _NO_BATTERY else battery / 1000
+        ))
+    
+    if offset != len(body):
+        raise ValueError(f"{len(body) - offset} trailing bytes")
+    return GatewayData(nodes, None, float(timestamp) if timestamp else None)
+
+class PayloadDecoder:
+    def __init__(self, backend=None):
+        backend = backend or os.getenv('PAYLOAD_DECODER', 'auto')
+        if backend == 'auto':
+            backend = 'msgspec' if msgspec is not None else 'orjson' if orjson is not None else 'json'
+        if backend == 'msgspec' and msgspec is None or backend == 'orjson' and orjson is None:
+            print(f"✗ Payload decoder '{backend}' is not installed, using json")
+            backend = 'json'
+        self.backend = backend
+        
+        if backend == 'msgspec':
+            self._gateway_data_decoder = msgspec.json.Decoder(GatewayData)
+            self._json_decoder = msgspec.json.Decoder()
+            self._errors = (msgspec.DecodeError,)
+        elif backend == 'orjson':
+            self._errors = (orjson.JSONDecodeError, UnicodeDecodeError)
+        else:
+            self._errors = (json.JSONDecodeError, UnicodeDecodeError)
+        
+        # Counters
+        self._lock = threading.Lock()
+        self.decoded = 0
+        self.rejected = {}
+    
+    def decode_json(self, raw):
+        """Decode any JSON payload to builtins, or None if malformed"""
+        try:
+            if self.backend == 'msgspec':
+                value = self._json_decoder.decode(raw)
+            elif self.backend == 'orjson':
+                value = orjson.loads(raw)
+            else:
+                value = json.loads(raw)
+        except self._errors as e:
+            return self._reject('json', e)
+        self.decoded += 1
+        return value
+    
+    def decode_gateway_data(self, raw):
+        """Decode and validate a gateway data payload to GatewayData, or None if malformed"""
+        if self.backend == 'msgspec':
+            try:
+                value = self._gateway_data_decoder.decode(raw)
+            except msgspec.ValidationError as e:
+                return self._reject('schema', e)
+            except msgspec.DecodeError as e:
+                return self._reject('json', e)
+        else:
+            obj = self.decode_json(raw)
+            if obj is None:
+                return None
+            self.decoded -= 1
+            try:
+                value = _build_gateway_data(obj)
+            except ValueError as e:
+                return self._reject('schema', e)
+        self.decoded += 1
+        return value
+    
+    def decode_gateway_data_bin(self, raw):
+        """Decode a compact binary gateway data payload to GatewayData, or None if malformed"""
+        try:
+            value = _decode_binary(raw)
+        except (struct.error, zlib.error, IndexError, UnicodeDecodeError, ValueError) as e:
+            return self._reject('binary', e)
+        self.decoded += 1
+        return value
+    
+    def stats(self):
+        """Get decoder counters"""
+        return {
+            'backend': self.backend,
+            'decoded': self.decoded,
+            'rejected': dict(self.rejected),
+            'rejected_total': sum(self.rejected.values())
+        }
+    
+    def _reject(self, reason, error):
+        with self._lock:
+            first = reason not in self.rejected
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        if first:
+            print(f"Rejected malformed MQTT payload ({reason}): {error}")
+        return None
+
+# Global payload decoder instance
+payload_decoder = PayloadDecoder()
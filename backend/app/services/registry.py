@@ -0,0 +1,136 @@
+"""
+In-process identity cache for the ingest path
+Maps gateway string ids to Gateway primary keys and (gateway PK, node_id) to
+Node primary keys so a gateway message costs no SELECTs once warmed up.
+Unknown gateways/nodes are cached too (negative caching) and every entry
+expires after REGISTRY_TTL seconds; the REST handlers that create, update,
+delete or reassign gateways/nodes invalidate the affected entries. With
+INGEST_MODE=workers the API process forwards its invalidations to the ingest
+worker processes over MQTT (see MQTTService.publish_registry_invalidation).
+"""
+import os
+import threading
+import time
+from app import db
+from app.models.iot import Gateway, Node
+
+class DeviceRegistry:
+    def __init__(self):
+        self.ttl = float(os.getenv('REGISTRY_TTL', 60))
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._gateways = {}  # gateway_id -> (gateway PK or None, expires_at)
+        self._nodes = {}     # gateway PK -> ({node_id: node PK}, expires_at)
+        self._reported_unknown = set()
+        # Called with each invalidation as a dict (forwarded to ingest workers), None: local only
+        self.listener = None
+        
+        # Counters
+        self.hits = 0
+        self.misses = 0
+    
+    def resolve_gateway(self, gateway_identifier):
+        """Get the Gateway PK for a gateway string id, or None if unknown"""
+        entry = self._gateways.get(gateway_identifier)
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+        
+        self.misses += 1
+        generation = self._generation
+        gateway_pk = db.session.query(Gateway.id).filter_by(gateway_id=gateway_identifier).scalar()
+        with self._lock:
+            if generation == self._generation:
+                self._gateways[gateway_identifier] = (gateway_pk, time.monotonic() + self.ttl)
+        return gateway_pk
+    
+    def resolve_node(self, gateway_pk, node_identifier):
+        """Get the Node PK for a node_id on a gateway, or None if unknown"""
+        try:
+            node_identifier = int(node_identifier)
+        except (TypeError, ValueError):
+            return None
+        
+        entry = self._nodes.get(gateway_pk)
+        if entry and entry[1] > time.monotonic():
+            self.hits += 1
+            node_pk = entry[0].get(node_identifier)
+        else:
+            # Load every node of the gateway in one query; absent node_ids are negative entries
+            self.misses += 1
+            generation = self._generation
+            node_map = dict(
+                db.session.query(Node.node_id, Node.id).filter_by(gateway_id=gateway_pk).all()
+            )
+            with self._lock:
+                if generation == self._generation:
+                    self._nodes[gateway_pk] = (node_map, time.monotonic() + self.ttl)
+            node_pk = node_map.get(node_identifier)
+        
+        return node_pk
+    
+    def invalidate_gateway(self, gateway_identifier=None, gateway_pk=None):
+        """Drop cached entries for a gateway (by string id and/or PK)"""
+        invalidation = {'gateway_id': gateway_identifier, 'gateway_pk': gateway_pk}
+        self._invalidate(invalidation)
+        self._notify(invalidation)
+    
+    def invalidate_nodes(self, *gateway_pks):
+        """Drop the cached node maps of one or more gateways"""
+        invalidation = {'gateway_pks': list(gateway_pks)}
+        self._invalidate(invalidation)
+        self._notify(invalidation)
+    
+    def clear(self):
+        """Drop every cached entry"""
+        invalidation = {'clear': True}
+        self._invalidate(invalidation)
+        self._notify(invalidation)
+    
+    def apply(self, invalidation):
+        """Apply an invalidation published by another process (not forwarded again)"""
+        self._invalidate(invalidation)
+    
+    def stats(self):
+        """Get cache counters"""
+        return {
+            'gateways': len(self._gateways),
+            'node_maps': len(self._nodes),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+    
+    def _invalidate(self, invalidation):
+        """Drop the entries an invalidation names: every entry, node maps or one gateway"""
+        with self._lock:
+            self._generation += 1
+            if invalidation.get('clear'):
+                self._gateways.clear()
+                self._nodes.clear()
+            elif 'gateway_pks' in invalidation:
+                for gateway_pk in invalidation['gateway_pks']:
+                    self._nodes.pop(gateway_pk, None)
+            else:
+                if invalidation.get('gateway_id') is not None:
+                    self._gateways.pop(invalidation['gateway_id'], None)
+                if invalidation.get('gateway_pk') is not None:
+                    self._nodes.pop(invalidation['gateway_pk'], None)
+            self._reported_unknown.clear()
+    
+    def _notify(self, invalidation):
+        """Hand an invalidation to the listener"""
+        listener = self.listener
+        if listener is not None:
+            try:
+                listener(invalidation)
+            except Exception as e:
+                print(f"Error forwarding device registry invalidation: {e}")
+    
+    def report_unknown(self, message):
+        """Print an unknown device once per cache generation instead of every message"""
+        if message not in self._reported_unknown:
+            self._reported_unknown.add(message)
+            print(message)
+
+# Global device registry instance
+device_registry = DeviceRegistry()
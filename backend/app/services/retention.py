@@ -0,0 +1,311 @@
+"""
+Sensor data retention
+Samples and QR codes older than their site's retention are deleted in chunks
+instead of one transaction: the oldest RETENTION_CHUNK_SIZE rows are found
+through the timestamp index, deleted and committed, and the engine sleeps
+RETENTION_CHUNK_SLEEP_MS before the next chunk, so the ingest writer gets the
+database between chunks. Before each chunk the engine also waits (at most
+RETENTION_MAX_YIELD seconds) while this process's writer is catching up or its
+data queue holds RETENTION_YIELD_DEPTH messages or more.
+
+A site keeps its data for the days of its retention_policies row, other sites
+for SENSOR_RETENTION_DAYS. With time partitions (see partitions.py) the
+partitions older than the longest retention are dropped whole first; rows are
+only deleted one by one for sites with a shorter retention and in the
+unpartitioned table. Progress (rows deleted, rows/s) is printed and emitted as
+retention:progress events every RETENTION_PROGRESS_INTERVAL seconds.
+
+Retention is tiered: the days above apply to raw samples, the 1m/15m/1h rollups
+(see rollups.py) are kept for ROLLUP_1M/15M/1H_RETENTION_DAYS. Raw samples are
+deleted in whole hours, and compacted first: the hours whose rollups hold fewer
+values than the samples about to go (written with rollups off) are rebuilt from
+them, RETENTION_COMPACT_CHUNK series hours per commit. Expired rollups are then
+deleted in chunks like the samples.
+"""
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import and_, select
+from app import db
+from app.models.iot import Gateway, Node, NodeQrCode, RetentionPolicy, SensorSample, SensorSeries
+from app.services.catchup import catchup
+from app.services.partitions import partition_router
+from app.services.rollups import HOUR, RESOLUTIONS, bucket_start, rollup_store
+from app.services.websocket import emit_event
+
+class RetentionEngine:
+    def __init__(self, app=None):
+        self.app = app
+        self.default_days = int(os.getenv('SENSOR_RETENTION_DAYS', 7))
+        self.chunk_size = int(os.getenv('RETENTION_CHUNK_SIZE', 5000))
+        self.chunk_sleep = int(os.getenv('RETENTION_CHUNK_SLEEP_MS', 200)) / 1000.0
+        self.compact_chunk = max(int(os.getenv('RETENTION_COMPACT_CHUNK', 100)), 1)  # Series hours
+        self.yield_depth = int(os.getenv('RETENTION_YIELD_DEPTH', 500))
+        self.max_yield = float(os.getenv('RETENTION_MAX_YIELD', 30))
+        self.progress_interval = float(os.getenv('RETENTION_PROGRESS_INTERVAL', 5))
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._started = 0
+        self._reported_at = 0
+        self.running = False
+        self.progress = None  # Current run
+        self.last = None      # Last finished run
+        
+        # Counters
+        self.runs = 0
+        self.rows_deleted = dict({'samples': 0, 'qr_codes': 0},
+                                 **{f'rollups_{resolution}': 0 for resolution in RESOLUTIONS})
+        self.partitions_dropped = 0
+        self.yields = 0
+    
+    def start(self, days=None, reason='manual'):
+        """Run retention in a background thread; False if a run is in progress"""
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+        
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, args=(days, reason), name='sensor-retention',
+                                        daemon=True)
+        self._thread.start()
+        return True
+    
+    def run(self, days=None, reason='scheduled'):
+        """Run retention in the calling thread; returns the run summary (None if a run is in progress)"""
+        with self._lock:
+            if self.running:
+                return None
+            self.running = True
+        
+        self._stop_event.clear()
+        return self._run(days, reason)
+    
+    def stop(self, timeout=10):
+        """Stop a running deletion after its current chunk"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+    
+    def policies(self):
+        """Sites with their own retention: {site_id: days}"""
+        return dict(db.session.query(RetentionPolicy.site_id, RetentionPolicy.days))
+    
+    def cutoff(self, days, now=None):
+        """Time raw samples are kept from for a retention: whole hours, so compaction never rebuilds a
+        rollup from part of its samples"""
+        return bucket_start((now or datetime.utcnow()) - timedelta(days=days), HOUR)
+    
+    def raw_boundary(self, site_ids=None, now=None):
+        """Time every one of the sites (every site if None) still has its raw samples from"""
+        policies = self.policies()
+        if site_ids is None:
+            days = min([self.default_days] + list(policies.values()))
+        else:
+            days = min(policies.get(site_id, self.default_days) for site_id in site_ids)
+        return self.cutoff(days, now)
+    
+    def stats(self):
+        """Get settings, the current run and counters"""
+        return {
+            'default_days': self.default_days,
+            'rollup_days': dict(rollup_store.retention),
+            'chunk_size': self.chunk_size,
+            'chunk_sleep_ms': int(self.chunk_sleep * 1000),
+            'running': self.running,
+            'progress': dict(self.progress) if self.running and self.progress else None,
+            'last': self.last,
+            'runs': self.runs,
+            'rows_deleted': dict(self.rows_deleted),
+            'partitions_dropped': self.partitions_dropped,
+            'yields': self.yields
+        }
+    
+    def _run(self, days, reason):
+        """Drop expired partitions, then delete expired rows per retention group"""
+        try:
+            with self.app.app_context():
+                try:
+                    return self._delete(days, reason)
+                except Exception as e:
+                    print(f"Error running sensor data retention: {e}")
+                    db.session.rollback()
+                    if self.progress:
+                        self.progress['error'] = str(e)
+                        self._finish()
+                finally:
+                    db.session.remove()
+        finally:
+            self.running = False
+    
+    def _delete(self, days, reason):
+        now = datetime.utcnow()
+        groups = self._groups(days)
+        self.progress = {
+            'reason': reason,
+            'started_at': now.isoformat(),
+            'groups': [{'days': group_days, 'sites': sites} for group_days, sites, _ in groups],
+            'table': None,
+            'rows_deleted': 0,
+            'chunks': 0,
+            'hours_compacted': 0,
+            'partitions_dropped': [],
+            'rows_per_second': 0,
+            'seconds': 0,
+            'error': None
+        }
+        self._started = time.monotonic()
+        self._reported_at = self._started
+        self.runs += 1
+        print(f"✓ Sensor data retention started ({reason}: "
+              f"{', '.join(f'{group_days} days' for group_days, _, _ in groups)})")
+        
+        # Partitions older than the longest retention hold no row any site keeps: they are rolled up,
+        # then dropped
+        connection = db.session.connection()
+        partitioned = partition_router.mode(connection)
+        horizon = min(self.cutoff(group_days, now) for group_days, _, _ in groups)
+        expired = {name for _, end, name in partition_router.partitions(connection)
+                   if end <= horizon} if partitioned else set()
+        if partitioned == 'native' and expired:
+            self._compact(SensorSample.__table__, None, horizon)
+        elif expired:
+            for table in partition_router.tables(connection, end=horizon):
+                if table.name in expired:
+                    self._compact(table, None, horizon)
+        # An interrupted compaction keeps its partitions
+        dropped = [] if self._stop_event.is_set() else partition_router.drop_before(db.session.connection(), horizon)
+        db.session.commit()
+        self.progress['partitions_dropped'] = dropped
+        self.partitions_dropped += len(dropped)
+        
+        for group_days, _, condition in groups:
+            cutoff = self.cutoff(group_days, now)
+            if partitioned and cutoff <= horizon:
+                # Rows of the longest retention go with their partition
+                tables = [SensorSample.__table__] if partitioned == 'tables' else []
+            else:
+                tables = partition_router.tables(db.session.connection(), end=cutoff)
+            
+            series = select(SensorSeries.id).join(Node, SensorSeries.node_id == Node.id).join(
+                Gateway, Node.gateway_id == Gateway.id).where(condition) if condition is not None else None
+            for table in tables:
+                self._compact(table, series, cutoff)
+                self._delete_chunks(table, table.c.series_id, series, cutoff, 'samples')
+            
+            nodes = select(Node.id).join(Gateway, Node.gateway_id == Gateway.id).where(
+                condition) if condition is not None else None
+            self._delete_chunks(NodeQrCode.__table__, NodeQrCode.__table__.c.node_id, nodes, cutoff, 'qr_codes')
+            if self._stop_event.is_set():
+                break
+        
+        # Rollup tiers outlive the raw samples, each for its own days
+        for resolution, (_, model) in RESOLUTIONS.items():
+            boundary = rollup_store.boundary(resolution, now)
+            if boundary is not None and not self._stop_event.is_set():
+                table = model.__table__
+                self._delete_chunks(table, None, None, boundary, f'rollups_{resolution}', table.c.bucket)
+        
+        return self._finish()
+    
+    def _groups(self, days):
+        """[(days, site ids or None for every other site, site condition)], one per distinct retention"""
+        if days is not None:
+            return [(days, None, None)]
+        
+        sites = {}
+        for site_id, site_days in self.policies().items():
+            sites.setdefault(site_days, []).append(site_id)
+        groups = [(site_days, site_ids, Gateway.site_id.in_(site_ids)) for site_days, site_ids in sites.items()]
+        others = Gateway.site_id.notin_([site_id for site_ids in sites.values() for site_id in site_ids])
+        groups.append((self.default_days, None, others if sites else None))
+        return sorted(groups, key=lambda group: group[0], reverse=True)
+    
+    def _compact(self, table, scope, cutoff):
+        """Roll a table's samples older than cutoff (of the series in scope) up before they are deleted,
+        rebuilding the hours their rollups miss in chunks"""
+        self.progress['table'] = table.name
+        stale = rollup_store.stale(db.session.connection(), table, scope, cutoff)
+        db.session.commit()
+        for i in range(0, len(stale), self.compact_chunk):
+            if self._stop_event.is_set():
+                break
+            self._yield_to_writer()
+            keys = stale[i:i + self.compact_chunk]
+            rollup_store.rebuild(db.session.connection(), table, keys)
+            db.session.commit()
+            self.progress['hours_compacted'] += len(keys)
+            self._report()
+            self._stop_event.wait(self.chunk_sleep)
+    
+    def _delete_chunks(self, table, column, scope, cutoff, kind, time_column=None):
+        """Delete a table's rows older than cutoff (whose column is in scope), oldest first, in chunks"""
+        time_column = table.c.timestamp if time_column is None else time_column
+        condition = time_column < cutoff
+        if scope is not None:
+            condition = and_(condition, column.in_(scope))
+        self.progress['table'] = table.name
+        
+        while not self._stop_event.is_set():
+            self._yield_to_writer()
+            # The timestamp of the chunk_size-th oldest row bounds the chunk
+            boundary = db.session.execute(
+                select(time_column).where(condition).order_by(time_column)
+                .offset(self.chunk_size - 1).limit(1)
+            ).scalar()
+            chunk = condition if boundary is None else and_(condition, time_column <= boundary)
+            deleted = db.session.execute(table.delete().where(chunk)).rowcount
+            db.session.commit()
+            
+            self.rows_deleted[kind] += deleted
+            self.progress['rows_deleted'] += deleted
+            self.progress['chunks'] += 1
+            self._report()
+            if boundary is None:
+                break
+            self._stop_event.wait(self.chunk_sleep)
+    
+    def _yield_to_writer(self):
+        """Wait while this process's ingest writer has a backlog"""
+        from app.services.mqtt_service import mqtt_service
+        data_queue = mqtt_service.data_writer().queue
+        deadline = time.monotonic() + self.max_yield
+        if not (catchup.active or data_queue.qsize() >= self.yield_depth):
+            return
+        
+        self.yields += 1
+        while ((catchup.active or data_queue.qsize() >= self.yield_depth)
+               and time.monotonic() < deadline and not self._stop_event.is_set()):
+            self._stop_event.wait(0.5)
+    
+    def _report(self, force=False):
+        """Update rows/s; print and emit progress every progress_interval"""
+        now = time.monotonic()
+        elapsed = now - self._started
+        self.progress['seconds'] = round(elapsed, 3)
+        self.progress['rows_per_second'] = round(self.progress['rows_deleted'] / elapsed) if elapsed else 0
+        if not force and now - self._reported_at < self.progress_interval:
+            return
+        
+        self._reported_at = now
+        print(f"  Retention: {self.progress['rows_deleted']} rows deleted "
+              f"({self.progress['rows_per_second']} rows/s, {self.progress['table']})")
+        emit_event('retention:progress', dict(self.progress, status='running'))
+    
+    def _finish(self):
+        """Record and announce the finished run"""
+        self._report(force=True)
+        status = 'failed' if self.progress['error'] else (
+            'stopped' if self._stop_event.is_set() else 'finished')
+        self.last = dict(self.progress, status=status, finished_at=datetime.utcnow().isoformat())
+        print(f"✓ Sensor data retention {status}: {self.last['rows_deleted']} rows deleted, "
+              f"{len(self.last['partitions_dropped'])} partitions dropped in {self.last['seconds']:.1f}s "
+              f"({self.last['rows_per_second']} rows/s)")
+        emit_event('retention:progress', self.last)
+        return self.last
+
+# Global retention engine instance
+retention_engine = RetentionEngine()
@@ -0,0 +1,237 @@
+"""
+Multi-resolution sensor rollups
+Every sample the writer inserts is merged into 1-minute, 15-minute and 1-hour
+rollups of its series (sensor_rollups_1m/15m/1h): count, min, max and sum of
+the converted values, and the first and last value with their times. A batch
+is aggregated in memory per (series, bucket), then merged with one upsert per
+resolution in the writer's transaction: counts and sums add up, min/max and the
+first/last times are compared with the stored bucket. A late sample therefore
+lands in its own (older) bucket and only replaces first/last when it is earlier
+or later than them. Samples are taken from the insert's RETURNING rows, so
+duplicates skipped by the unique index are never counted. Rollups need
+INSERT ... ON CONFLICT (SQLite, PostgreSQL); SENSOR_ROLLUPS=0 turns them off.
+
+/sensor-data/history serves rollups when asked for a resolution, or picks one
+from the time range and the point budget (see choose), and continues with them
+past the raw retention. Rollups outlive the raw samples: each resolution is
+kept for its ROLLUP_*_RETENTION_DAYS, and before retention deletes samples it
+rebuilds the hours whose rollups miss some of them (see stale and rebuild).
+"""
+import os
+from datetime import datetime, timedelta
+from sqlalchemy import BigInteger, and_, case, func, select, tuple_, type_coerce
+from sqlalchemy.dialects import postgresql, sqlite
+from app.models.iot import EPOCH, SensorRollup1m, SensorRollup15m, SensorRollup1h
+
+# Resolution -> (bucket seconds, model), finest first
+RESOLUTIONS = {
+    '1m': (60, SensorRollup1m),
+    '15m': (900, SensorRollup15m),
+    '1h': (3600, SensorRollup1h)
+}
+HOUR = 3600  # Seconds of the coarsest bucket: compaction and raw retention work in whole hours
+
+def bucket_start(timestamp, seconds):
+    """Start of the bucket of a timestamp"""
+    offset = (timestamp - EPOCH) // timedelta(microseconds=1)
+    return EPOCH + timedelta(microseconds=offset - offset % (seconds * 1000000))
+
+def merge(rollup, other):
+    """Merge a partial rollup into another, in place"""
+    rollup[0] += other[0]
+    if other[1] < rollup[1]:
+        rollup[1] = other[1]
+    if other[2] > rollup[2]:
+        rollup[2] = other[2]
+    rollup[3] += other[3]
+    if other[5] < rollup[5]:
+        rollup[4], rollup[5] = other[4], other[5]
+    if other[7] >= rollup[7]:
+        rollup[6], rollup[7] = other[6], other[7]
+
+class RollupStore:
+    def __init__(self):
+        self.enabled = bool(int(os.getenv('SENSOR_ROLLUPS', 1)))
+        # Days each resolution is kept (0: forever)
+        self.retention = {
+            '1m': int(os.getenv('ROLLUP_1M_RETENTION_DAYS', 30)),
+            '15m': int(os.getenv('ROLLUP_15M_RETENTION_DAYS', 365)),
+            '1h': int(os.getenv('ROLLUP_1H_RETENTION_DAYS', 1825))
+        }
+        
+        # Counters
+        self.samples = 0
+        self.batches = 0
+        self.rows_upserted = dict.fromkeys(RESOLUTIONS, 0)
+        self.hours_compacted = 0
+    
+    def supported(self, dialect_name):
+        """Whether rollups are maintained on a database"""
+        return self.enabled and dialect_name in ('sqlite', 'postgresql')
+    
+    def aggregate(self, samples):
+        """Partial rollups of (series_id, timestamp, value) samples:
+        {resolution: {(series_id, bucket): [count, min, max, sum, first, first_at, last, last_at]}}"""
+        resolutions = iter(RESOLUTIONS.items())
+        resolution, (seconds, _) = next(resolutions)
+        finest = {}
+        buckets = {}  # Samples of a message share their timestamp
+        for series_id, timestamp, value in samples:
+            if value is None:
+                continue
+            bucket = buckets.get(timestamp)
+            if bucket is None:
+                bucket = buckets[timestamp] = bucket_start(timestamp, seconds)
+            rollup = finest.get((series_id, bucket))
+            if rollup is None:
+                finest[(series_id, bucket)] = [1, value, value, value, value, timestamp, value, timestamp]
+            else:
+                merge(rollup, [1, value, value, value, value, timestamp, value, timestamp])
+        
+        # Coarser buckets are unions of the finest ones
+        partials = {resolution: finest}
+        for resolution, (seconds, _) in resolutions:
+            partial = partials[resolution] = {}
+            starts = {bucket: bucket_start(bucket, seconds) for bucket in set(buckets.values())}
+            for (series_id, bucket), rollup in finest.items():
+                key = (series_id, starts[bucket])
+                if key in partial:
+                    merge(partial[key], rollup)
+                else:
+                    partial[key] = list(rollup)
+        return partials
+    
+    def apply(self, connection, samples):
+        """Merge inserted (series_id, timestamp, value) samples into every resolution (the caller commits)"""
+        if not samples or not self.supported(connection.dialect.name):
+            return
+        
+        for resolution, partial in self.aggregate(samples).items():
+            if not partial:
+                continue
+            # Key order keeps concurrent writers from locking the same buckets in opposite orders
+            rows = [self._row(key, rollup) for key, rollup in sorted(partial.items())]
+            connection.execute(self._upsert(RESOLUTIONS[resolution][1].__table__, connection.dialect.name), rows)
+            self.rows_upserted[resolution] += len(rows)
+        self.samples += len(samples)
+        self.batches += 1
+    
+    def choose(self, start, end, series, points):
+        """Finest resolution giving at most `points` rows for `series` series between start and end
+        (the coarsest when none does)"""
+        for resolution, (seconds, _) in RESOLUTIONS.items():
+            # Buckets the range touches, partial ones at both ends included
+            buckets = max((bucket_start(end, seconds) - bucket_start(start, seconds)).total_seconds(), 0) // seconds + 1
+            if max(series, 1) * buckets <= points:
+                return resolution
+        return resolution
+    
+    def boundary(self, resolution, now=None):
+        """Oldest bucket a resolution keeps (None: kept forever)"""
+        days = self.retention[resolution]
+        if not days:
+            return None
+        return bucket_start((now or datetime.utcnow()) - timedelta(days=days), HOUR)
+    
+    def stale(self, connection, table, scope, cutoff):
+        """(series_id, hour) of the samples of a table older than cutoff (of the series in scope, a select
+        of ids) whose 1h rollup holds fewer values than the samples (written with rollups off, or missed),
+        in time order; hours are EpochTime microseconds"""
+        if not self.supported(connection.dialect.name):
+            return []
+        
+        condition = table.c.timestamp < cutoff
+        if scope is not None:
+            condition = and_(condition, table.c.series_id.in_(scope))
+        hour = self._hour(table)
+        samples = select(
+            table.c.series_id, hour.label('hour'), func.count(table.c.converted_value).label('values')
+        ).where(condition).group_by(table.c.series_id, hour).subquery()
+        rollup = SensorRollup1h.__table__
+        return connection.execute(select(samples.c.series_id, samples.c.hour).outerjoin(
+            rollup, and_(rollup.c.series_id == samples.c.series_id,
+                         type_coerce(rollup.c.bucket, BigInteger) == samples.c.hour)
+        ).where(samples.c['values'] > func.coalesce(rollup.c['count'], 0)).order_by(
+            samples.c.hour, samples.c.series_id
+        )).all()
+    
+    def rebuild(self, connection, table, keys):
+        """Recompute the rollups of (series_id, hour) keys in time order from the samples of a table,
+        replacing the stored buckets of every resolution still kept (the caller commits)"""
+        if not keys:
+            return
+        
+        # The time range keeps the read on the hours of the keys
+        hour = self._hour(table)
+        rows = connection.execute(select(table.c.series_id, table.c.timestamp, table.c.converted_value).where(
+            table.c.timestamp >= EPOCH + timedelta(microseconds=keys[0][1]),
+            table.c.timestamp < EPOCH + timedelta(microseconds=keys[-1][1], seconds=HOUR),
+            tuple_(table.c.series_id, hour).in_([tuple(key) for key in keys])
+        )).all()
+        
+        now = datetime.utcnow()
+        for resolution, partial in self.aggregate(rows).items():
+            boundary = self.boundary(resolution, now)
+            rebuilt = [self._row(key, rollup) for key, rollup in sorted(partial.items())
+                       if boundary is None or key[1] >= boundary]
+            if rebuilt:
+                connection.execute(self._upsert(RESOLUTIONS[resolution][1].__table__, connection.dialect.name,
+                                                replace=True), rebuilt)
+        self.hours_compacted += len(keys)
+    
+    def stats(self):
+        """Get rollup settings and counters"""
+        return {
+            'enabled': self.enabled,
+            'resolutions': list(RESOLUTIONS),
+            'retention_days': dict(self.retention),
+            'samples': self.samples,
+            'batches': self.batches,
+            'rows_upserted': dict(self.rows_upserted),
+            'hours_compacted': self.hours_compacted
+        }
+    
+    def _hour(self, table):
+        """A sample table's timestamp truncated to the hour, in EpochTime microseconds"""
+        micros = type_coerce(table.c.timestamp, BigInteger)
+        return micros - micros % (HOUR * 1000000)
+    
+    def _row(self, key, rollup):
+        """An upsert row of a partial rollup"""
+        series_id, bucket = key
+        return {'series_id': series_id, 'bucket': bucket, 'count': rollup[0], 'min': rollup[1], 'max': rollup[2],
+                'sum': rollup[3], 'first': rollup[4], 'first_at': rollup[5], 'last': rollup[6],
+                'last_at': rollup[7]}
+    
+    def _upsert(self, table, dialect_name, replace=False):
+        """INSERT of partial rollups merging into existing buckets (or replacing them)"""
+        if dialect_name == 'sqlite':
+            statement = sqlite.insert(table)
+            least, greatest = func.min, func.max
+        else:
+            statement = postgresql.insert(table)
+            least, greatest = func.least, func.greatest
+        
+        stored, new = table.c, statement.excluded
+        if replace:
+            return statement.on_conflict_do_update(
+                index_elements=[stored.series_id, stored.bucket],
+                set_={column: new[column] for column in
+                      ('count', 'min', 'max', 'sum', 'first', 'first_at', 'last', 'last_at')}
+            )
+        return statement.on_conflict_do_update(
+            index_elements=[stored.series_id, stored.bucket],
+            set_={
+                'count': stored['count'] + new['count'],
+                'min': least(stored.min, new.min),
+                'max': greatest(stored.max, new.max),
+                'sum': stored.sum + new.sum,
+                'first': case((new.first_at < stored.first_at, new.first), else_=stored.first),
+                'first_at': least(stored.first_at, new.first_at),
+                'last': case((new.last_at >= stored.last_at, new.last), else_=stored.last),
+                'last_at': greatest(stored.last_at, new.last_at)
+            }
+        )
+
+# Global rollup store instance
+rollup_store = RollupStore()
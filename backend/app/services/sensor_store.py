@@ -0,0 +1,287 @@
+"""
+Sensor sample storage
+A reading is stored as a narrow sensor_samples row (series_id, timestamp,
+device_timestamp, raw_value, converted_value). The node, ADC, channel and unit
+it belongs to are stored once in the sensor_series dictionary, and the QR code
+a node reported with a message once per message in node_qr_codes. The writers
+resolve series ids through an in-process cache (one SELECT per node, one INSERT
+for the new series of a message) and hand prepared batches to SensorStore.write.
+Sample and QR code times are stored as integer microseconds (EpochTime). The
+/sensor-data and node endpoints read through SensorStore.samples, which joins
+the series and QR codes back into the original sensor data fields. Samples are
+partitioned by event time (app/services/partitions.py): writes, reads and
+retention go through the partition router. Inserted samples are merged into
+the 1m/15m/1h rollups (app/services/rollups.py) in the same transaction.
+"""
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import and_, func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from app import db
+from app.models.iot import Gateway, Node, NodeQrCode, SensorSample, SensorSeries
+from app.services.dedup import duplicate_filter
+from app.services.partitions import partition_router
+from app.services.rollups import RESOLUTIONS, rollup_store
+
+def insert_ignore(table, dialect_name):
+    """Bulk INSERT that skips rows a unique index already holds"""
+    if dialect_name == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect_name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect_name in ('mysql', 'mariadb'):
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
+
+def count_inserted(rows, rowcount):
+    """Rows actually inserted by an insert_ignore; the rest were storage-level duplicates"""
+    if rowcount is None or rowcount < 0:
+        return rows
+    duplicate_filter.record_storage_duplicates(rows - rowcount)
+    return rowcount
+
+def sample_dict(row):
+    """A joined sample row in the sensor data format of the API"""
+    return {
+        'id': f"{row.series_id}:{row.timestamp.isoformat()}:{row.device_timestamp.isoformat()}",
+        'series_id': row.series_id,
+        'node_id': row.node_id,
+        'timestamp': row.timestamp.isoformat(),
+        'device_timestamp': row.device_timestamp.isoformat(),
+        'adc_type': row.adc_type,
+        'channel': row.channel,
+        'raw_value': row.raw_value,
+        'converted_value': row.converted_value,
+        'unit': row.unit or None,
+        'qr_code': row.qr_code
+    }
+
+def rollup_dict(row, resolution):
+    """A joined rollup row in the sensor data format of the API (converted_value is the mean)"""
+    mean = row.sum / row.count if row.count and row.sum is not None else None
+    return {
+        'id': f"{row.series_id}:{resolution}:{row.bucket.isoformat()}",
+        'series_id': row.series_id,
+        'node_id': row.node_id,
+        'timestamp': row.bucket.isoformat(),
+        'resolution': resolution,
+        'adc_type': row.adc_type,
+        'channel': row.channel,
+        'unit': row.unit or None,
+        'count': row.count,
+        'min': row.min,
+        'max': row.max,
+        'sum': row.sum,
+        'avg': mean,
+        'first': row.first,
+        'last': row.last,
+        'converted_value': mean
+    }
+
+def filter_series(query, node_id=None, gateway_id=None, site_id=None, adc_type=None, channel=None):
+    """Restrict a query joined to sensor_series to the series of a node, gateway, site, ADC or channel"""
+    if node_id:
+        query = query.where(SensorSeries.node_id == node_id)
+    if gateway_id or site_id:
+        query = query.join(Node, SensorSeries.node_id == Node.id)
+        if gateway_id:
+            query = query.where(Node.gateway_id == gateway_id)
+        if site_id:
+            query = query.join(Gateway, Node.gateway_id == Gateway.id).where(Gateway.site_id == site_id)
+    if adc_type:
+        query = query.where(SensorSeries.adc_type == adc_type)
+    if channel is not None:
+        query = query.where(SensorSeries.channel == channel)
+    return query
+
+class SampleBatch:
+    """Rows prepared from a batch of gateway messages"""
+    
+    def __init__(self):
+        self.samples = []   # sensor_samples rows
+        self.qr_codes = []  # node_qr_codes rows
+        self.keys = set()   # Duplicate filter keys (node PK, device timestamp) of the samples
+    
+    def __len__(self):
+        return len(self.samples)
+    
+    def extend(self, other):
+        """Add the rows of another batch"""
+        self.samples.extend(other.samples)
+        self.qr_codes.extend(other.qr_codes)
+        self.keys.update(other.keys)
+
+class SensorStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}  # node PK -> {(adc_type, channel, unit): series id}
+        
+        # Counters
+        self.series_created = 0
+        self.misses = 0
+    
+    def series_ids(self, node_pk, keys):
+        """Get the series ids of a node's (adc_type, channel, unit) keys, creating new series"""
+        keys = [(adc_type, channel, unit or '') for adc_type, channel, unit in keys]
+        series = self._series.get(node_pk)
+        if series is None:
+            series = self._load(node_pk)
+        missing = {key for key in keys if key not in series}
+        if missing:
+            series = self._create(node_pk, missing)
+        return [series[key] for key in keys]
+    
+    def series_id(self, node_pk, adc_type, channel, unit):
+        """Get the series id of one of a node's ADC channels in a unit"""
+        return self.series_ids(node_pk, [(adc_type, channel, unit)])[0]
+    
+    def write(self, connection, batch):
+        """Insert a SampleBatch on a connection (the caller commits); returns the samples inserted"""
+        dialect_name = connection.dialect.name
+        rollups = rollup_store.supported(dialect_name)
+        inserted = 0
+        new_samples = []
+        for table, rows in partition_router.route(connection, batch.samples):
+            statement = insert_ignore(table, dialect_name)
+            if rollups:
+                # Only the rows actually inserted (not duplicates) are rolled up
+                returned = connection.execute(
+                    statement.returning(table.c.series_id, table.c.timestamp, table.c.converted_value), rows
+                ).all()
+                new_samples.extend(returned)
+                inserted += count_inserted(len(rows), len(returned))
+            else:
+                inserted += count_inserted(len(rows), connection.execute(statement, rows).rowcount)
+        rollup_store.apply(connection, new_samples)
+        if batch.qr_codes:
+            connection.execute(insert_ignore(NodeQrCode.__table__, dialect_name), batch.qr_codes)
+        return inserted
+    
+    def samples(self, node_id=None, gateway_id=None, site_id=None, adc_type=None, channel=None,
+                start=None, end=None, limit=None):
+        """Samples joined back to their series and QR codes, newest first, as sensor data dicts"""
+        connection = db.session.connection()
+        samples = []
+        # Partitions do not overlap: reading them newest first stops once the limit is reached
+        for table in partition_router.tables(connection, start, end):
+            query = self._sample_query(table, node_id, gateway_id, site_id, adc_type, channel, start, end)
+            if limit:
+                query = query.limit(limit - len(samples))
+            samples.extend(sample_dict(row) for row in connection.execute(query))
+            if limit and len(samples) >= limit:
+                break
+        return samples
+    
+    def rollups(self, resolution, node_id=None, gateway_id=None, site_id=None, adc_type=None, channel=None,
+                start=None, end=None, limit=None):
+        """Rollups of a resolution joined back to their series, newest bucket first, as sensor data dicts"""
+        seconds, model = RESOLUTIONS[resolution]
+        table = model.__table__
+        query = filter_series(select(
+            table, SensorSeries.node_id, SensorSeries.adc_type, SensorSeries.channel, SensorSeries.unit
+        ).join_from(table, SensorSeries, table.c.series_id == SensorSeries.id),
+            node_id, gateway_id, site_id, adc_type, channel)
+        if start:
+            # The bucket holding start
+            query = query.where(table.c.bucket > start - timedelta(seconds=seconds))
+        if end:
+            query = query.where(table.c.bucket <= end)
+        
+        query = query.order_by(table.c.bucket.desc())
+        if limit:
+            query = query.limit(limit)
+        return [rollup_dict(row, resolution) for row in db.session.execute(query)]
+    
+    def series_count(self, node_id=None, gateway_id=None, site_id=None, adc_type=None, channel=None):
+        """Number of series matching the sample filters"""
+        return db.session.execute(filter_series(
+            select(func.count(SensorSeries.id)), node_id, gateway_id, site_id, adc_type, channel
+        )).scalar()
+    
+    def qr_codes(self, node_id, limit=100):
+        """QR codes a node reported, newest first, as (qr_code, timestamp)"""
+        return db.session.query(NodeQrCode.qr_code, NodeQrCode.timestamp).filter(
+            NodeQrCode.node_id == node_id
+        ).order_by(NodeQrCode.timestamp.desc()).limit(limit).all()
+    
+    def delete_before(self, cutoff):
+        """Drop the partitions older than cutoff and delete older unpartitioned samples and QR codes;
+        returns (samples deleted, partitions dropped)"""
+        connection = db.session.connection()
+        dropped = partition_router.drop_before(connection, cutoff)
+        deleted = 0
+        if partition_router.mode(connection) != 'native':
+            table = SensorSample.__table__
+            deleted = connection.execute(table.delete().where(table.c.timestamp < cutoff)).rowcount
+        NodeQrCode.query.filter(NodeQrCode.timestamp < cutoff).delete(synchronize_session=False)
+        db.session.commit()
+        return deleted, dropped
+    
+    def count(self):
+        """Number of stored samples, every partition included"""
+        connection = db.session.connection()
+        return sum(connection.execute(select(func.count()).select_from(table)).scalar()
+                   for table in partition_router.tables(connection))
+    
+    def stats(self):
+        """Get series cache counters"""
+        return {
+            'nodes': len(self._series),
+            'series': sum(len(series) for series in list(self._series.values())),
+            'series_created': self.series_created,
+            'misses': self.misses
+        }
+    
+    def clear(self):
+        """Drop every cached series id (after a rollback, which may have undone new series)"""
+        with self._lock:
+            self._series.clear()
+    
+    def _load(self, node_pk):
+        """Load every series of a node in one query"""
+        self.misses += 1
+        series = {
+            (adc_type, channel, unit): series_id
+            for series_id, adc_type, channel, unit in db.session.query(
+                SensorSeries.id, SensorSeries.adc_type, SensorSeries.channel, SensorSeries.unit
+            ).filter(SensorSeries.node_id == node_pk)
+        }
+        with self._lock:
+            return self._series.setdefault(node_pk, series)
+    
+    def _create(self, node_pk, keys):
+        """Register new series of a node (another writer may have created some first) in the
+        caller's transaction and reload the node's series"""
+        now = datetime.utcnow()
+        db.session.execute(insert_ignore(SensorSeries.__table__, db.engine.dialect.name), [
+            {'node_id': node_pk, 'adc_type': adc_type, 'channel': channel, 'unit': unit, 'created_at': now}
+            for adc_type, channel, unit in sorted(keys)
+        ])
+        db.session.flush()
+        self.series_created += len(keys)
+        with self._lock:
+            self._series.pop(node_pk, None)
+        return self._load(node_pk)
+    
+    def _sample_query(self, table, node_id, gateway_id, site_id, adc_type, channel, start, end):
+        """Query one sample table joined to the series and QR codes, newest first"""
+        query = select(
+            table.c.series_id, table.c.timestamp, table.c.device_timestamp, table.c.raw_value,
+            table.c.converted_value, SensorSeries.node_id, SensorSeries.adc_type, SensorSeries.channel,
+            SensorSeries.unit, NodeQrCode.qr_code
+        ).join_from(
+            table, SensorSeries, table.c.series_id == SensorSeries.id
+        ).outerjoin(
+            NodeQrCode, and_(NodeQrCode.node_id == SensorSeries.node_id, NodeQrCode.timestamp == table.c.timestamp,
+                             NodeQrCode.device_timestamp == table.c.device_timestamp)
+        )
+        
+        query = filter_series(query, node_id, gateway_id, site_id, adc_type, channel)
+        if start:
+            query = query.where(table.c.timestamp >= start)
+        if end:
+            query = query.where(table.c.timestamp <= end)
+        return query.order_by(table.c.timestamp.desc())
+    
+# Global sensor store instance
+sensor_store = SensorStore()
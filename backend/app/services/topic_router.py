@@ -0,0 +1,134 @@
+"""
+MQTT topic router
+Patterns are MQTT topic filters whose wildcard levels may be named:
+'{name}' matches one level like '+', '{name#}' matches the remaining levels
+like '#'. Patterns are compiled into a trie; a topic is matched once, with
+literal levels preferred over '+' and '+' over '#', and the result (handler
+and captured parameters) is cached per topic.
+    
+    router.add('apru40/gateway/{gateway_id}/data', handle_data)
+    router.route('apru40/gateway/GW001/data')  # -> (handle_data, {'gateway_id': 'GW001'})
+"""
+
+class _TrieNode:
+    __slots__ = ('children', 'plus', 'route', 'hash_route')
+    
+    def __init__(self):
+        self.children = {}     # literal level -> node
+        self.plus = None       # node for a single-level wildcard
+        self.route = None      # (handler, wildcard names) ending exactly here
+        self.hash_route = None  # (handler, wildcard names, tail name) for '#' here
+
+def _parse_level(level):
+    """Get (kind, capture name) of a pattern level; kind is 'literal', 'plus' or 'hash'"""
+    if level == '+':
+        return 'plus', None
+    if level == '#':
+        return 'hash', None
+    if level.startswith('{') and level.endswith('}'):
+        name = level[1:-1]
+        if name.endswith('#'):
+            return 'hash', name[:-1]
+        return 'plus', name
+    if '+' in level or '#' in level or '{' in level or '}' in level:
+        raise ValueError(f"Invalid topic pattern level: {level}")
+    return 'literal', None
+
+def to_filter(pattern):
+    """Convert a router pattern to the MQTT subscription filter it needs"""
+    levels = []
+    for level in pattern.split('/'):
+        kind, _ = _parse_level(level)
+        levels.append({'plus': '+', 'hash': '#'}.get(kind, level))
+    return '/'.join(levels)
+
+class TopicRouter:
+    def __init__(self, cache_size=10000):
+        self.cache_size = cache_size
+        self.routes = []
+        self._root = _TrieNode()
+        self._cache = {}
+    
+    def add(self, pattern, handler):
+        """Register a handler for a topic pattern"""
+        node = self._root
+        names = []
+        levels = pattern.split('/')
+        
+        for index, level in enumerate(levels):
+            kind, name = _parse_level(level)
+            if kind == 'hash':
+                if index != len(levels) - 1:
+                    raise ValueError(f"'#' must be the last level of a topic pattern: {pattern}")
+                node.hash_route = (handler, tuple(names), name)
+                break
+            if kind == 'plus':
+                if node.plus is None:
+                    node.plus = _TrieNode()
+                node = node.plus
+                names.append(name)
+            else:
+                node = node.children.setdefault(level, _TrieNode())
+        else:
+            node.route = (handler, tuple(names))
+        
+        self.routes.append((pattern, handler))
+        self._cache.clear()
+    
+    def filters(self):
+        """Get the MQTT subscription filters of all registered patterns"""
+        return [to_filter(pattern) for pattern, _ in self.routes]
+    
+    def route(self, topic):
+        """Get (handler, params) for a topic, or None if no pattern matches"""
+        try:
+            return self._cache[topic]
+        except KeyError:
+            pass
+        
+        result = self._match(self._root, topic.split('/'), 0, [])
+        if self.cache_size:
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[topic] = result
+        return result
+    
+    def _match(self, node, levels, index, values):
+        """Depth-first trie walk: literal, then '+', then '#' at each level"""
+        if index == len(levels):
+            if node.route:
+                handler, names = node.route
+                return handler, self._params(names, values)
+            if node.hash_route:
+                # 'a/#' also matches 'a'
+                return self._hash_result(node.hash_route, values, '')
+            return None
+        
+        child = node.children.get(levels[index])
+        if child is not None:
+            result = self._match(child, levels, index + 1, values)
+            if result:
+                return result
+        
+        if node.plus is not None:
+            values.append(levels[index])
+            result = self._match(node.plus, levels, index + 1, values)
+            if result:
+                return result
+            values.pop()
+        
+        if node.hash_route:
+            return self._hash_result(node.hash_route, values, '/'.join(levels[index:]))
+        
+        return None
+    
+    def _hash_result(self, hash_route, values, tail):
+        handler, names, tail_name = hash_route
+        params = self._params(names, values)
+        if tail_name:
+            params[tail_name] = tail
+        return handler, params
+    
+    @staticmethod
+    def _params(names, values):
+        return {name: value for name, value in zip(names, values) if name}
@@ -3,9 +3,14 @@ WebSocket event handlers for real-time communication
 """
 from flask_socketio import emit, join_room, leave_room
 from app import socketio
+from app.services.metrics import metrics
 import random
+import time
 from datetime import datetime
 
+SOCKETIO_EMITS = metrics.counter('apru40_socketio_emits_total', 'Socket.IO events emitted to clients', ['event'])
+SOCKETIO_EMIT_SECONDS = metrics.histogram('apru40_socketio_emit_seconds', 'Socket.IO emit duration', ['event'])
+
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
@@ -44,9 +49,16 @@ def handle_update_request(data):
     })
 
 # Helper functions to emit events (called from other parts of the app)
+def emit_event(event, data, namespace='/'):
+    """Emit an event to all clients, counting and timing it"""
+    started = time.perf_counter()
+    socketio.emit(event, data, namespace=namespace)
+    SOCKETIO_EMIT_SECONDS.observe(time.perf_counter() - started, event)
+    SOCKETIO_EMITS.inc(event)
+
 def emit_device_status_change(device_id, status):
     """Emit device status change event"""
-    socketio.emit('device:status_change', {
+    emit_event('device:status_change', {
         'device_id': device_id,
         'status': status,
         'timestamp': datetime.utcnow().isoformat()
@@ -54,7 +66,7 @@ def emit_device_status_change(device_id, status):
 
 def emit_new_alert(alert):
     """Emit new alert event"""
-    socketio.emit('alert:new', {
+    emit_event('alert:new', {
         'id': alert.id,
         'device_id': alert.device_id,
         'alert_type': alert.alert_type,
@@ -65,7 +77,7 @@ def emit_new_alert(alert):
 
 def emit_sensor_data(device_id, sensor_data):
     """Emit sensor data update"""
-    socketio.emit('device:sensor_data', {
+    emit_event('device:sensor_data', {
         'device_id': device_id,
         'data': sensor_data,
         'timestamp': datetime.utcnow().isoformat()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Alert storm benchmark
+Publishes a burst of alerts from misbehaving gateways through the in-process
+broker into MQTTService's alert lane and the alert pipeline, and compares it
+with the naive path (one ORM insert, commit and alert:new emit per alert) on a
+scratch SQLite database (or BENCH_DATABASE_URL). Reports alerts handled per
+second, rows created, repeats folded into open alerts and alert:new events
+emitted vs throttled.
+
+Usage: bench_alerts.py [--alerts 20000] [--gateways 5] [--nodes 30] [--types 4]
+"""
+import argparse
+import json
+import time
+
+# Sets DATABASE_URL/APRU40_ROLE/MQTT_TRANSPORT=inproc before the app is imported
+from bench_ingest import seed
+from app import app, db
+from app.models.iot import Gateway, Node, NodeAlert
+from app.services.alert_pipeline import alert_pipeline
+from app.services.inproc_broker import InProcessClient, inproc_broker
+from app.services.mqtt_service import mqtt_service
+from app.services.websocket import emit_event
+
+ALERT_TYPES = ['tamper', 'bt_unauthorized', 'battery_low', 'sensor_fault', 'watchdog', 'overtemp']
+
+def build_alerts(count, gateway_count, node_count, type_count):
+    """(topic, payload) pairs cycling over gateways, nodes and alert types"""
+    alerts = []
+    for i in range(count):
+        gateway_identifier = f"GW{i % gateway_count:03d}"
+        alert_type = ALERT_TYPES[i % type_count]
+        alerts.append((f"apru40/gateway/{gateway_identifier}/alert/{alert_type}", json.dumps({
+            'type': alert_type,
+            'priority': 'high',
+            'device_type': 'node',
+            'device_id': i % node_count + 1,
+            'description': f"{alert_type} storm",
+            'timestamp': int(time.time())
+        }).encode()))
+    return alerts
+
+def run_naive(alerts):
+    """One NodeAlert insert, commit and emit per alert"""
+    nodes = {(gateway_identifier, node_number): (gateway_pk, node_pk)
+             for gateway_identifier, gateway_pk, node_number, node_pk in db.session.query(
+                 Gateway.gateway_id, Gateway.id, Node.node_id, Node.id).join(Node).all()}
+    start = time.perf_counter()
+    for topic, raw in alerts:
+        payload = json.loads(raw)
+        gateway_pk, node_pk = nodes[(topic.split('/')[2], payload['device_id'])]
+        alert = NodeAlert(gateway_id=gateway_pk, node_id=node_pk, alert_type=payload['type'],
+                          severity=payload['priority'], message=payload['description'], details=payload)
+        db.session.add(alert)
+        db.session.commit()
+        emit_event('alert:new', {'id': alert.id, 'alert_type': alert.alert_type})
+    return time.perf_counter() - start
+
+def run_pipeline(alerts):
+    """Publish through the in-process broker to the alert lane and pipeline"""
+    mqtt_service.role = 'web'
+    mqtt_service.ingest_mode = 'workers'  # subscribe to alerts only
+    mqtt_service.alert_lane.queue.block_timeout = None
+    alert_pipeline.app = app
+    mqtt_service.app = app
+    mqtt_service.start_lanes()
+    alert_pipeline.start()
+    mqtt_service.connect()
+    
+    publisher = InProcessClient(inproc_broker, client_id='bench-publisher')
+    publisher.connect()
+    start = time.perf_counter()
+    for topic, raw in alerts:
+        publisher.publish(topic, raw)
+    mqtt_service.stop_lanes()
+    alert_pipeline.stop(timeout=None)
+    elapsed = time.perf_counter() - start
+    publisher.disconnect()
+    mqtt_service.disconnect()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark alert storm handling')
+    parser.add_argument('--alerts', type=int, default=20000, help='alerts in the storm')
+    parser.add_argument('--gateways', type=int, default=5)
+    parser.add_argument('--nodes', type=int, default=30, help='nodes per gateway')
+    parser.add_argument('--types', type=int, default=4, help=f'alert types (max {len(ALERT_TYPES)})')
+    parser.add_argument('--naive-alerts', type=int, default=2000, help='alerts for the naive run')
+    args = parser.parse_args()
+    
+    with app.app_context():
+        seed(args.gateways, args.nodes)
+        alerts = build_alerts(args.alerts, args.gateways, args.nodes, min(args.types, len(ALERT_TYPES)))
+        naive_count = min(args.naive_alerts, len(alerts))
+        naive_seconds = run_naive(alerts[:naive_count])
+        db.session.query(NodeAlert).delete()
+        db.session.commit()
+        db.session.remove()
+    
+    pipeline_seconds = run_pipeline(alerts)
+    
+    with app.app_context():
+        rows, occurrences = db.session.query(db.func.count(NodeAlert.id), db.func.sum(NodeAlert.occurrences)).one()
+    stats = alert_pipeline.stats()
+    lane = mqtt_service.alert_lane.stats()
+    print(f"{args.alerts} alerts from {args.gateways} gateways x {args.nodes} nodes x {args.types} types")
+    print(f"  naive   : {naive_count / naive_seconds:10.0f} alerts/s ({naive_count} rows, one commit + emit each)")
+    print(f"  pipeline: {args.alerts / pipeline_seconds:10.0f} alerts/s, {rows} rows holding {occurrences} occurrences, "
+          f"{stats['events_emitted']} alert:new emitted, {stats['events_throttled']} throttled, "
+          f"{stats['alerts_dropped']} dropped, lane max depth {lane['max_depth']}")
+
+if __name__ == '__main__':
+    main()
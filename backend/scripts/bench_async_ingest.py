@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Threaded vs asyncio ingest engine benchmark
+Publishes gateway data messages at a fixed rate (default 10k msgs/s) through
+the in-process broker into each engine in turn - the threaded MQTTService +
+SensorSampleWriter and AsyncIngestEngine - on a scratch SQLite database (or
+BENCH_DATABASE_URL; use PostgreSQL to see concurrent async writers) and
+reports the rate sustained, time to commit everything, CPU time and the
+receive-to-commit latency. Needs aiosqlite (or asyncpg) for the async engine.
+
+Usage: bench_async_ingest.py [--rate 10000] [--duration 5] [--gateways 100] [--nodes 1]
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+
+# Sets DATABASE_URL/APRU40_ROLE/MQTT_TRANSPORT=inproc before the app is imported
+from bench_ingest import ADC_CHANNELS, build_payload, seed
+from app import app, db
+from app.services.dedup import duplicate_filter
+from app.services.ingest import INGEST_LATENCY_SECONDS
+from app.services.inproc_broker import InProcessClient, inproc_broker
+from app.services.metrics import LATENCY_BUCKETS
+from app.services.mqtt_service import mqtt_service
+from app.services.sensor_store import sensor_store
+
+def latency_percentile(engine, fraction):
+    """Upper bucket bound below which `fraction` of the engine's messages were committed"""
+    series = INGEST_LATENCY_SECONDS.collect().get((engine,))
+    if not series:
+        return '-'
+    cumulative, _, count = series
+    for bound, bucket_count in zip(LATENCY_BUCKETS + (float('inf'),), cumulative):
+        if bucket_count >= count * fraction:
+            return f"<={bound * 1000:g}ms"
+
+def publish_paced(messages, rate):
+    """Publish at `rate` messages per second; returns the seconds publishing took"""
+    publisher = InProcessClient(inproc_broker, client_id='bench-publisher')
+    publisher.connect()
+    start = time.perf_counter()
+    for index, (topic, payload) in enumerate(messages):
+        ahead = start + index / rate - time.perf_counter()
+        if ahead > 0.001:
+            time.sleep(ahead)
+        publisher.publish(topic, payload)
+    elapsed = time.perf_counter() - start
+    publisher.disconnect()
+    return elapsed
+
+def run(engine, messages, rate, batch_size):
+    """Feed every message to one engine; returns (publish seconds, total seconds, CPU seconds, writer stats)"""
+    with app.app_context():
+        sensor_store.delete_before(datetime.max)
+        db.session.remove()
+    # Every engine gets the same messages
+    duplicate_filter.reset()
+    
+    mqtt_service.ingest_engine = engine
+    writer = mqtt_service.data_writer()
+    writer.stop()
+    writer.app = app
+    writer.batch_size = batch_size
+    writer.emit_enabled = False
+    # Measure how far behind an engine falls rather than what it drops
+    writer.queue.maxsize = max(writer.queue.maxsize, len(messages))
+    
+    mqtt_service.connect()
+    writer.start()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    publish_seconds = publish_paced(messages, rate)
+    writer.stop(timeout=None)
+    total_seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    mqtt_service.disconnect()
+    return publish_seconds, total_seconds, cpu_seconds, dict(writer.stats(), max_depth=writer.queue.max_depth)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the threaded and asyncio ingest engines')
+    parser.add_argument('--rate', type=float, default=10000, help='published messages per second')
+    parser.add_argument('--duration', type=float, default=5, help='seconds of publishing per engine')
+    parser.add_argument('--gateways', type=int, default=100)
+    parser.add_argument('--nodes', type=int, default=1, help='nodes per gateway message')
+    parser.add_argument('--batch-size', type=int, default=200, help='writer batch size (messages)')
+    args = parser.parse_args()
+    
+    with app.app_context():
+        seed(args.gateways, args.nodes)
+    count = int(args.rate * args.duration)
+    messages = [
+        (f"apru40/gateway/GW{i % args.gateways:03d}/data",
+         json.dumps(build_payload(f"GW{i % args.gateways:03d}", args.nodes, i)).encode())
+        for i in range(count)
+    ]
+    rows = count * args.nodes * sum(ADC_CHANNELS.values())
+    print(f"{count} messages ({rows} rows) at {args.rate:.0f} msgs/s, {args.gateways} gateways")
+    
+    for engine in ('threaded', 'asyncio'):
+        publish_seconds, total_seconds, cpu_seconds, stats = run(engine, messages, args.rate, args.batch_size)
+        print(f"  {engine:8}: published {count / publish_seconds:8.0f} msgs/s, "
+              f"{stats['rows_written']} rows committed in {total_seconds:6.2f}s "
+              f"({stats['rows_written'] / total_seconds:8.0f} rows/s), CPU {cpu_seconds:6.2f}s, "
+              f"latency p50 {latency_percentile(engine, 0.5)} p99 {latency_percentile(engine, 0.99)}, "
+              f"max queue {stats['max_depth']}")
+
+if __name__ == '__main__':
+    main()
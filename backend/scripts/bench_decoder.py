@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Payload decoding micro-benchmark
+Compares the legacy path (json.loads + dict .get() walk of the nodes/sensors
+tree, as handle_sensor_data did) with PayloadDecoder on every installed
+backend (stdlib json, orjson, msgspec), each followed by the row-building
+walk of ingest.prepare_rows, and the compact binary encoding
+(apru40/gateway/{id}/data/bin, plain and zlib) in size and decode rate.
+
+Usage: bench_decoder.py [--nodes 30] [--iterations 2000]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import time
+
+# Load the decoder module on its own: importing the app package would create the app
+_spec = importlib.util.spec_from_file_location(
+    'payload_decoder',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'services', 'payload_decoder.py')
+)
+payload_decoder = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(payload_decoder)
+
+ADC_CHANNELS = {'ads7128': 8, 'ads1119_1': 4, 'ads1119_2': 4}
+
+def build_raw_payload(node_count, seq):
+    """Build an encoded apru40/gateway/{id}/data payload"""
+    nodes = []
+    for n in range(1, node_count + 1):
+        sensors = {}
+        for adc_type, channels in ADC_CHANNELS.items():
+            sensors[adc_type] = {
+                f"ch{c}": {'raw': (seq + c) % 4096, 'value': ((seq + c) % 4096) * 0.00488, 'unit': 'mA'}
+                for c in range(channels)
+            }
+        nodes.append({'node_id': n, 'sensors': sensors, 'rssi': -45, 'battery': 3.7, 'qr_code': ''})
+    return json.dumps({'gateway_id': 'GW001', 'timestamp': 1700000000 + seq, 'nodes': nodes}).encode()
+
+def legacy_rows(raw):
+    """Pre-decoder path: json.loads then .get() on every level"""
+    payload = json.loads(raw.decode())
+    rows = []
+    for node_data in payload.get('nodes', []):
+        node_identifier = node_data.get('node_id')
+        if node_identifier is None:
+            continue
+        for adc_type, channels in node_data.get('sensors', {}).items():
+            for channel_key, channel_data in channels.items():
+                rows.append((
+                    node_identifier, adc_type, int(channel_key.replace('ch', '')),
+                    channel_data.get('raw'), channel_data.get('value'), channel_data.get('unit')
+                ))
+    return rows
+
+def decoder_rows(decode):
+    """Typed path: decode to GatewayData then attribute access"""
+    channel_number = payload_decoder.channel_number
+    
+    def rows_for(raw):
+        payload = decode(raw)
+        rows = []
+        for node_data in payload.nodes:
+            if node_data.node_id is None:
+                continue
+            for adc_type, channels in node_data.sensors.items():
+                for channel_key, reading in channels.items():
+                    rows.append((
+                        node_data.node_id, adc_type, channel_number(channel_key),
+                        reading.raw, reading.value, reading.unit
+                    ))
+        return rows
+    return rows_for
+
+def measure(label, func, payloads, iterations, baseline=None):
+    count = len(payloads)
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(payloads[i % count])
+    elapsed = time.perf_counter() - start
+    rate = iterations / elapsed
+    speedup = f"  {rate / baseline:4.1f}x" if baseline else ''
+    print(f"  {label:<22} {rate:10.0f} msgs/s{speedup}")
+    return rate
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gateway payload decoding')
+    parser.add_argument('--nodes', type=int, default=30, help='nodes per gateway message')
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+    
+    payloads = [build_raw_payload(args.nodes, seq) for seq in range(50)]
+    rows = len(legacy_rows(payloads[0]))
+    print(f"{args.nodes} nodes/message ({rows} rows, {len(payloads[0])} bytes), {args.iterations} iterations")
+    
+    baseline = measure('legacy json+get', legacy_rows, payloads, args.iterations)
+    for backend in ('json', 'orjson', 'msgspec'):
+        if backend == 'orjson' and payload_decoder.orjson is None or backend == 'msgspec' and payload_decoder.msgspec is None:
+            print(f"  {backend:<22} not installed")
+            continue
+        decoder = payload_decoder.PayloadDecoder(backend)
+        measure(f"decoder ({backend})", decoder_rows(decoder.decode_gateway_data), payloads, args.iterations, baseline)
+    
+    # Binary encoding of the same payloads
+    decoder = payload_decoder.PayloadDecoder()
+    for compress in (False, True):
+        label = 'binary+zlib' if compress else 'binary'
+        encoded = [payload_decoder.encode_binary(json.loads(raw), compress) for raw in payloads]
+        print(f"  {label:<22} {len(encoded[0]):10d} bytes  ({len(encoded[0]) / len(payloads[0]):.0%} of JSON)")
+        measure(f"decoder ({label})", decoder_rows(decoder.decode_gateway_data_bin), encoded, args.iterations, baseline)
+    
+    # Rejection path: malformed JSON and schema violations are counted, never raised
+    decoder = payload_decoder.PayloadDecoder()
+    for raw in (b'{"nodes": [', b'{"nodes": {}}', b'{"nodes": [{"node_id": 1, "sensors": {"ads7128": {"x0": {}}}}]}'):
+        decoder.decode_gateway_data(raw)
+    print(f"  rejected: {decoder.stats()['rejected']}")
+
+if __name__ == '__main__':
+    main()
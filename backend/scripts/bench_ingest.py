@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Sensor data ingest benchmark
+Compares the legacy per-message ORM path (one SensorSample object per channel,
+one commit per message) with the batched SensorDataWriter (Core executemany,
+one commit per batch) on a scratch SQLite database (or BENCH_DATABASE_URL),
+then runs the whole MQTT pipeline (routing, decoding, writer) fed through the
+in-process broker.
+
+Usage: bench_ingest.py [--messages 2000] [--gateways 40] [--nodes 30] [--batch-size 200]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# Run against a scratch database (or BENCH_DATABASE_URL) without MQTT or scheduler
+_tmpdir = tempfile.mkdtemp(prefix='apru40-bench-')
+os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}")
+os.environ['APRU40_ROLE'] = 'ingest-worker'
+os.environ['MQTT_TRANSPORT'] = 'inproc'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app, db  # noqa: E402
+from app.models.iot import Site, Gateway, Node, SensorSample  # noqa: E402
+from app.services.dedup import duplicate_filter  # noqa: E402
+from app.services.ingest import SensorDataWriter, sensor_writer  # noqa: E402
+from app.services.inproc_broker import InProcessClient, inproc_broker  # noqa: E402
+from app.services.mqtt_service import mqtt_service  # noqa: E402
+from app.services.payload_decoder import payload_decoder  # noqa: E402
+from app.services.sensor_store import sensor_store  # noqa: E402
+
+ADC_CHANNELS = {'ads7128': 8, 'ads1119_1': 4, 'ads1119_2': 4}
+
+def seed(gateway_count, node_count):
+    """Create one site with gateway_count gateways of node_count nodes each"""
+    site = Site(name='Bench site')
+    db.session.add(site)
+    db.session.flush()
+    for g in range(gateway_count):
+        gateway = Gateway(gateway_id=f"GW{g:03d}", name=f"Gateway {g}", site_id=site.id)
+        db.session.add(gateway)
+        db.session.flush()
+        for n in range(1, node_count + 1):
+            db.session.add(Node(node_id=n, name=f"Node {g}-{n}", gateway_id=gateway.id))
+    db.session.commit()
+
+def build_payload(gateway_identifier, node_count, seq):
+    """Build a documented apru40/gateway/{id}/data payload"""
+    nodes = []
+    for n in range(1, node_count + 1):
+        sensors = {}
+        for adc_type, channels in ADC_CHANNELS.items():
+            sensors[adc_type] = {
+                f"ch{c}": {'raw': (seq + c) % 4096, 'value': ((seq + c) % 4096) * 0.00488, 'unit': 'mA'}
+                for c in range(channels)
+            }
+        nodes.append({'node_id': n, 'sensors': sensors, 'rssi': -45, 'battery': 3.7})
+    # Distinct device timestamps, or the duplicate filter would drop repeated messages
+    return {'gateway_id': gateway_identifier, 'timestamp': round(time.time() - seq / 1000, 3), 'nodes': nodes}
+
+def legacy_write(gateway_identifier, payload):
+    """Pre-batching handle_sensor_data: ORM objects and one commit per message"""
+    gateway = Gateway.query.filter_by(gateway_id=gateway_identifier).first()
+    gateway.last_seen = datetime.utcnow()
+    gateway.status = 'online'
+    for node_data in payload.get('nodes', []):
+        node = Node.query.filter_by(gateway_id=gateway.id, node_id=node_data['node_id']).first()
+        node.status = 'online'
+        node.last_seen = datetime.utcnow()
+        node.rssi = node_data.get('rssi')
+        node.battery_level = node_data.get('battery')
+        for adc_type, channels in node_data.get('sensors', {}).items():
+            for channel_key, channel_data in channels.items():
+                db.session.add(SensorSample(
+                    series_id=sensor_store.series_id(node.id, adc_type, int(channel_key.replace('ch', '')),
+                                                     channel_data.get('unit')),
+                    timestamp=datetime.utcnow(),
+                    raw_value=channel_data.get('raw'),
+                    converted_value=channel_data.get('value')
+                ))
+    db.session.commit()
+
+def run_legacy(messages):
+    start = time.perf_counter()
+    for gateway_identifier, payload in messages:
+        legacy_write(gateway_identifier, payload)
+    return time.perf_counter() - start
+
+def run_batched(messages, batch_size):
+    duplicate_filter.reset()
+    writer = SensorDataWriter(app)
+    writer.batch_size = batch_size
+    writer.emit_enabled = False
+    # Producer outruns the writer here: wait for room instead of dropping
+    writer.queue.policy = 'block'
+    writer.queue.block_timeout = None
+    # The MQTT thread decodes before submitting; decode outside the timed section
+    decoded = [
+        (gateway_identifier, payload_decoder.decode_gateway_data(json.dumps(payload).encode()))
+        for gateway_identifier, payload in messages
+    ]
+    start = time.perf_counter()
+    writer.start()
+    for gateway_identifier, payload in decoded:
+        writer.submit(gateway_identifier, payload)
+    writer.stop(timeout=None)
+    return time.perf_counter() - start
+
+def run_pipeline(messages, batch_size):
+    """Publish raw JSON through the in-process broker to MQTTService and the global writer"""
+    duplicate_filter.reset()
+    sensor_writer.stop()
+    sensor_writer.batch_size = batch_size
+    sensor_writer.emit_enabled = False
+    sensor_writer.queue.policy = 'block'
+    sensor_writer.queue.block_timeout = None
+    raw = [(f"apru40/gateway/{gateway_identifier}/data", json.dumps(payload).encode())
+           for gateway_identifier, payload in messages]
+    
+    mqtt_service.connect()
+    publisher = InProcessClient(inproc_broker, client_id='bench-publisher')
+    publisher.connect()
+    start = time.perf_counter()
+    sensor_writer.start()
+    for topic, payload in raw:
+        publisher.publish(topic, payload, qos=1)
+    sensor_writer.stop(timeout=None)
+    elapsed = time.perf_counter() - start
+    publisher.disconnect()
+    mqtt_service.disconnect()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sensor data ingest')
+    parser.add_argument('--messages', type=int, default=2000, help='gateway messages per run')
+    parser.add_argument('--gateways', type=int, default=40)
+    parser.add_argument('--nodes', type=int, default=30, help='nodes per gateway message')
+    parser.add_argument('--batch-size', type=int, default=200, help='writer batch size (messages)')
+    args = parser.parse_args()
+    
+    with app.app_context():
+        seed(args.gateways, args.nodes)
+        messages = [
+            (f"GW{i % args.gateways:03d}", build_payload(f"GW{i % args.gateways:03d}", args.nodes, i))
+            for i in range(args.messages)
+        ]
+        rows = args.messages * args.nodes * sum(ADC_CHANNELS.values())
+        
+        legacy_seconds = run_legacy(messages)
+        sensor_store.delete_before(datetime.max)
+        db.session.remove()
+    
+    batched_seconds = run_batched(messages, args.batch_size)
+    
+    with app.app_context():
+        written = sensor_store.count()
+        sensor_store.delete_before(datetime.max)
+        db.session.remove()
+    
+    pipeline_seconds = run_pipeline(messages, args.batch_size)
+    
+    with app.app_context():
+        piped = sensor_store.count()
+    
+    print(f"{args.messages} messages, {rows} rows ({written} written by batched run, {piped} by pipeline run)")
+    print(f"  legacy  : {legacy_seconds:8.2f}s  {rows / legacy_seconds:10.0f} rows/s")
+    print(f"  batched : {batched_seconds:8.2f}s  {rows / batched_seconds:10.0f} rows/s")
+    print(f"  pipeline: {pipeline_seconds:8.2f}s  {rows / pipeline_seconds:10.0f} rows/s (MQTT routing + decode + writer)")
+    print(f"  speedup: {legacy_seconds / batched_seconds:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Command RPC fan-out benchmark
+Sends one command to a fleet of gateways (default 1000) through the in-process
+broker; a simulated fleet replies to every request after --rtt milliseconds.
+Compares the pipelined batch (every request queued in the outbox before any
+reply is awaited) with sending to one gateway at a time and waiting for its
+reply.
+
+Usage: bench_rpc.py [--gateways 1000] [--rtt 50] [--sequential 20]
+"""
+import argparse
+import heapq
+import json
+import threading
+import time
+
+# Sets DATABASE_URL/APRU40_ROLE/MQTT_TRANSPORT=inproc before the app is imported
+from bench_ingest import seed
+from app import app
+from app.models.iot import Gateway
+from app.services.command_rpc import command_rpc
+from app.services.inproc_broker import InProcessClient, inproc_broker
+from app.services.mqtt_service import mqtt_service
+from app.services.outbox import outbox
+
+class SimulatedFleet:
+    """Replies to apru40/+/cmd requests on their reply_to topic after a fixed delay"""
+    
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.client = InProcessClient(inproc_broker, client_id='bench-fleet')
+        self.client.on_message = self.on_message
+        self._due = []
+        self._condition = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+    
+    def start(self):
+        self.client.connect()
+        self.client.subscribe('apru40/+/cmd')
+        self._thread.start()
+    
+    def stop(self):
+        with self._condition:
+            self._stop = True
+            self._condition.notify()
+        self._thread.join()
+        self.client.disconnect()
+    
+    def on_message(self, client, userdata, msg):
+        request = json.loads(msg.payload)
+        with self._condition:
+            heapq.heappush(self._due, (time.monotonic() + self.rtt, request['correlation_id'], request['reply_to']))
+            self._condition.notify()
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stop and (not self._due or self._due[0][0] > time.monotonic()):
+                    self._condition.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                if self._stop:
+                    return
+                _, correlation_id, reply_to = heapq.heappop(self._due)
+            self.client.publish(reply_to, json.dumps({'correlation_id': correlation_id, 'success': True,
+                                                      'result': {'uptime': 1234}}))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark command fan-out')
+    parser.add_argument('--gateways', type=int, default=1000)
+    parser.add_argument('--rtt', type=float, default=50, help='simulated gateway reply delay (ms)')
+    parser.add_argument('--sequential', type=int, default=20, help='gateways for the one-at-a-time run')
+    args = parser.parse_args()
+    
+    with app.app_context():
+        seed(args.gateways, 0)
+        gateways = Gateway.query.all()
+    
+    mqtt_service.role = 'web'
+    mqtt_service.ingest_mode = 'workers'  # subscribe to replies, not to ingest topics
+    mqtt_service.app = app
+    mqtt_service.connect()
+    # Requests are published by the outbox (started by the web process only)
+    outbox.app = app
+    outbox.start()
+    fleet = SimulatedFleet(args.rtt / 1000.0)
+    fleet.start()
+    
+    with app.app_context():
+        start = time.perf_counter()
+        batch = command_rpc.send(gateways, 'get_status', timeout=30)
+        command_rpc.wait(batch, 30)
+        pipelined = time.perf_counter() - start
+        counts = batch.to_dict(include_results=False)['counts']
+        
+        sequential_gateways = gateways[:args.sequential]
+        start = time.perf_counter()
+        for gateway in sequential_gateways:
+            command_rpc.wait(command_rpc.send([gateway], 'get_status', timeout=30), 30)
+        sequential = time.perf_counter() - start
+    
+    fleet.stop()
+    outbox.stop()
+    mqtt_service.disconnect()
+    print(f"get_status to {args.gateways} gateways, {args.rtt:g}ms reply delay")
+    print(f"  pipelined : {pipelined * 1000:8.0f} ms ({counts['ok']} ok, {counts['timeout']} timed out)")
+    print(f"  sequential: {sequential * 1000 / len(sequential_gateways) * args.gateways:8.0f} ms "
+          f"(extrapolated from {len(sequential_gateways)} gateways)")
+
+if __name__ == '__main__':
+    main()
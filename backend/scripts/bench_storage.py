@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Sensor storage benchmark
+Writes the same seeded readings (gateways x nodes x 16 ADC channels per message,
+a QR code on some node reports) to the legacy wide sensor_data layout (UUID
+primary key, node_id/adc_type/unit/qr_code per row, three indexes) and to the
+series dictionary + narrow sensor_samples layout, one bulk insert and commit per
+writer batch, on a scratch SQLite database (or BENCH_DATABASE_URL). Reports
+insert rates, the space taken by each layout's tables and indexes (SQLite
+dbstat, PostgreSQL pg_total_relation_size, time partitions included) and the
+time retention takes to remove the oldest day: a row DELETE on the legacy table,
+dropping partitions on the narrow one. Messages are spread over --days days.
+
+Usage: bench_storage.py [--messages 500] [--gateways 10] [--nodes 30] [--batch-size 200] [--days 1]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+# Run against a scratch database (or BENCH_DATABASE_URL) without MQTT or scheduler
+_tmpdir = tempfile.mkdtemp(prefix='apru40-bench-')
+os.environ['DATABASE_URL'] = os.getenv('BENCH_DATABASE_URL', f"sqlite:///{os.path.join(_tmpdir, 'bench.db')}")
+os.environ['APRU40_ROLE'] = 'ingest-worker'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, MetaData, String, Table, text  # noqa: E402
+from app import app, db  # noqa: E402
+from app.models.iot import Site, Gateway, Node  # noqa: E402
+from app.services.partitions import partition_router  # noqa: E402
+from app.services.sensor_store import SampleBatch, insert_ignore, sensor_store  # noqa: E402
+
+ADC_CHANNELS = {'ads7128': 8, 'ads1119_1': 4, 'ads1119_2': 4}
+
+# The sensor_data table as it was before the series dictionary
+legacy_metadata = MetaData()
+legacy_sensor_data = Table(
+    'sensor_data', legacy_metadata,
+    Column('id', String(36), primary_key=True),
+    Column('node_id', String(36), nullable=False),
+    Column('timestamp', DateTime, nullable=False, index=True),
+    Column('device_timestamp', DateTime),
+    Column('adc_type', String(20), nullable=False),
+    Column('channel', Integer, nullable=False),
+    Column('raw_value', Integer),
+    Column('converted_value', Float),
+    Column('unit', String(10)),
+    Column('qr_code', String(64)),
+    Index('idx_sensor_data_node_timestamp', 'node_id', 'timestamp'),
+    Index('idx_sensor_data_timestamp', 'timestamp'),
+    Index('uq_sensor_data_reading', 'node_id', 'device_timestamp', 'adc_type', 'channel', unique=True)
+)
+
+def seed(gateway_count, node_count):
+    """Create one site with gateway_count gateways of node_count nodes; returns node PKs per gateway"""
+    site = Site(name='Bench site')
+    db.session.add(site)
+    db.session.flush()
+    nodes = []
+    for g in range(gateway_count):
+        gateway = Gateway(gateway_id=f"GW{g:03d}", name=f"Gateway {g}", site_id=site.id)
+        db.session.add(gateway)
+        db.session.flush()
+        gateway_nodes = []
+        for n in range(1, node_count + 1):
+            node = Node(node_id=n, name=f"Node {g}-{n}", gateway_id=gateway.id)
+            db.session.add(node)
+            gateway_nodes.append(node)
+        db.session.flush()
+        nodes.append([node.id for node in gateway_nodes])
+    db.session.commit()
+    return nodes
+
+def build_messages(nodes, message_count, days):
+    """Node reports per gateway message: [(node PK, timestamp, qr_code, [(adc_type, channel, raw, value, unit)])]"""
+    start = datetime.utcnow() - timedelta(days=days)
+    step = max(1, days * 86400 // message_count) if days > 1 else 1
+    messages = []
+    for i in range(message_count):
+        timestamp = start + timedelta(seconds=i * step)
+        reports = []
+        for n, node_pk in enumerate(nodes[i % len(nodes)]):
+            qr_code = f"QR-{i:06d}-{n:02d}" if (i + n) % 20 == 0 else None
+            readings = [
+                (adc_type, channel, (i + channel) % 4096, ((i + channel) % 4096) * 0.00488, 'mA')
+                for adc_type, channels in ADC_CHANNELS.items()
+                for channel in range(channels)
+            ]
+            reports.append((node_pk, timestamp, qr_code, readings))
+        messages.append(reports)
+    return messages
+
+def run_legacy(messages, batch_size):
+    """One wide row per reading, one executemany and commit per batch"""
+    statement = insert_ignore(legacy_sensor_data, db.engine.dialect.name)
+    started = time.perf_counter()
+    for offset in range(0, len(messages), batch_size):
+        rows = [
+            {'id': str(uuid.uuid4()), 'node_id': node_pk, 'timestamp': timestamp, 'device_timestamp': timestamp,
+             'adc_type': adc_type, 'channel': channel, 'raw_value': raw, 'converted_value': value, 'unit': unit,
+             'qr_code': qr_code}
+            for reports in messages[offset:offset + batch_size]
+            for node_pk, timestamp, qr_code, readings in reports
+            for adc_type, channel, raw, value, unit in readings
+        ]
+        db.session.execute(statement, rows)
+        db.session.commit()
+    return time.perf_counter() - started
+
+def run_narrow(messages, batch_size):
+    """Series ids from the cache, one SampleBatch written and committed per batch (as the writer does)"""
+    started = time.perf_counter()
+    for offset in range(0, len(messages), batch_size):
+        batch = SampleBatch()
+        for reports in messages[offset:offset + batch_size]:
+            for node_pk, timestamp, qr_code, readings in reports:
+                series_ids = sensor_store.series_ids(
+                    node_pk, [(adc_type, channel, unit) for adc_type, channel, _, _, unit in readings]
+                )
+                batch.samples.extend(
+                    {'series_id': series_id, 'timestamp': timestamp, 'device_timestamp': timestamp,
+                     'raw_value': raw, 'converted_value': value}
+                    for series_id, (_, _, raw, value, _) in zip(series_ids, readings)
+                )
+                if qr_code:
+                    batch.qr_codes.append({'node_id': node_pk, 'timestamp': timestamp, 'device_timestamp': timestamp,
+                                           'qr_code': qr_code})
+        sensor_store.write(db.session.connection(), batch)
+        db.session.commit()
+    return time.perf_counter() - started
+
+def table_sizes(tables):
+    """Bytes used by each table, its indexes and time partitions included"""
+    dialect_name = db.engine.dialect.name
+    sizes = {}
+    for table in tables:
+        if dialect_name == 'sqlite':
+            sizes[table] = db.session.execute(text(
+                "SELECT coalesce(sum(pgsize), 0) FROM dbstat WHERE name IN "
+                "(SELECT name FROM sqlite_master WHERE tbl_name = :table OR tbl_name LIKE :table || '_p%')"
+            ), {'table': table}).scalar()
+        elif dialect_name == 'postgresql':
+            sizes[table] = db.session.execute(text(
+                "SELECT pg_total_relation_size(:table) + coalesce(sum(pg_total_relation_size(inhrelid)), 0) "
+                "FROM pg_inherits WHERE inhparent = CAST(:table AS regclass)"
+            ), {'table': table}).scalar()
+        else:
+            sizes[table] = None
+    return sizes
+
+def run_retention(cutoff):
+    """Remove the samples older than cutoff from each layout; returns (legacy seconds, rows, narrow seconds,
+    partitions dropped)"""
+    started = time.perf_counter()
+    rows = db.session.execute(legacy_sensor_data.delete().where(legacy_sensor_data.c.timestamp < cutoff)).rowcount
+    db.session.commit()
+    legacy_seconds = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    _, dropped = sensor_store.delete_before(cutoff)
+    return legacy_seconds, rows, time.perf_counter() - started, len(dropped)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark legacy vs narrow sensor storage')
+    parser.add_argument('--messages', type=int, default=500, help='gateway messages')
+    parser.add_argument('--gateways', type=int, default=10)
+    parser.add_argument('--nodes', type=int, default=30, help='nodes per gateway message')
+    parser.add_argument('--batch-size', type=int, default=200, help='writer batch size (messages)')
+    parser.add_argument('--days', type=int, default=1, help='days the messages are spread over')
+    args = parser.parse_args()
+    
+    with app.app_context():
+        legacy_metadata.create_all(db.engine)
+        nodes = seed(args.gateways, args.nodes)
+        messages = build_messages(nodes, args.messages, args.days)
+        readings = sum(len(readings) for reports in messages for _, _, _, readings in reports)
+        
+        legacy_seconds = run_legacy(messages, args.batch_size)
+        narrow_seconds = run_narrow(messages, args.batch_size)
+        
+        legacy = table_sizes(['sensor_data'])
+        narrow = table_sizes(['sensor_series', 'sensor_samples', 'node_qr_codes'])
+        dialect_name = db.engine.dialect.name
+        
+        # Retention of the oldest day
+        cutoff = messages[0][0][1] + timedelta(days=1)
+        legacy_retention, retention_rows, narrow_retention, dropped = run_retention(cutoff)
+    
+    print(f"{args.messages} messages, {readings} readings, {sensor_store.series_created} series ({dialect_name})")
+    print(f"  legacy : {legacy_seconds:8.2f}s  {readings / legacy_seconds:10.0f} rows/s")
+    print(f"  narrow : {narrow_seconds:8.2f}s  {readings / narrow_seconds:10.0f} rows/s")
+    if None not in legacy.values() and None not in narrow.values():
+        legacy_bytes = sum(legacy.values())
+        narrow_bytes = sum(narrow.values())
+        print(f"  legacy : {legacy_bytes / 1e6:8.1f} MB  {legacy_bytes / readings:6.1f} bytes/reading")
+        print(f"  narrow : {narrow_bytes / 1e6:8.1f} MB  {narrow_bytes / readings:6.1f} bytes/reading "
+              f"({', '.join(f'{table} {size / 1e6:.1f} MB' for table, size in narrow.items())})")
+        print(f"  storage: {legacy_bytes / narrow_bytes:.1f}x smaller")
+    print(f"  retention, legacy : {legacy_retention * 1000:8.1f} ms  ({retention_rows} rows deleted)")
+    print(f"  retention, narrow : {narrow_retention * 1000:8.1f} ms  ({dropped} partitions dropped, "
+          f"interval {partition_router.interval}s)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Topic router micro-benchmark
+Compares the legacy substring dispatch + topic re-split of on_message with
+TopicRouter (trie walk, and trie walk behind the per-topic cache) on a
+realistic mix of gateway data/status/alert topics.
+
+Usage: bench_topic_router.py [--gateways 40] [--iterations 1000000]
+"""
+import argparse
+import importlib.util
+import os
+import time
+
+# Load the router module on its own: importing the app package would create the app
+_spec = importlib.util.spec_from_file_location(
+    'topic_router',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app', 'services', 'topic_router.py')
+)
+topic_router = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(topic_router)
+
+PATTERNS = [
+    ('apru40/gateway/{gateway_id}/data', 'data'),
+    ('apru40/{gateway_id}/data', 'data'),
+    ('apru40/gateway/{gateway_id}/status', 'status'),
+    ('apru40/{gateway_id}/status', 'status'),
+    ('apru40/gateway/{gateway_id}/alert/{alert_path#}', 'alert'),
+    ('apru40/{gateway_id}/alert/{alert_path#}', 'alert'),
+    ('apru40/backend/ingest/{worker_id}/stats', 'stats'),
+]
+
+def legacy_dispatch(topic):
+    """Pre-router on_message dispatch and handler topic parsing"""
+    if '/data' in topic:
+        kind = 'data'
+    elif '/status' in topic:
+        kind = 'status'
+    elif '/alert' in topic:
+        kind = 'alert'
+    else:
+        return None
+    parts = topic.split('/')
+    if len(parts) >= 3 and parts[1] == 'gateway':
+        return kind, parts[2]
+    return kind, None
+
+def build_topics(gateway_count):
+    topics = []
+    for g in range(gateway_count):
+        # Data dominates the mix
+        topics += [f"apru40/gateway/GW{g:03d}/data"] * 8
+        topics.append(f"apru40/gateway/GW{g:03d}/status")
+        topics.append(f"apru40/gateway/GW{g:03d}/alert/tamper")
+    return topics
+
+def measure(label, func, topics, iterations):
+    count = len(topics)
+    start = time.perf_counter()
+    for i in range(iterations):
+        func(topics[i % count])
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<22} {iterations / elapsed / 1e6:6.2f} M matches/s")
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MQTT topic dispatch')
+    parser.add_argument('--gateways', type=int, default=40)
+    parser.add_argument('--iterations', type=int, default=1000000)
+    args = parser.parse_args()
+    
+    cached = topic_router.TopicRouter()
+    uncached = topic_router.TopicRouter(cache_size=0)
+    for pattern, kind in PATTERNS:
+        cached.add(pattern, kind)
+        uncached.add(pattern, kind)
+    
+    topics = build_topics(args.gateways)
+    print(f"{len(topics)} distinct-topic mix, {args.iterations} iterations")
+    measure('legacy substring', legacy_dispatch, topics, args.iterations)
+    measure('router (trie walk)', uncached.route, topics, args.iterations)
+    measure('router (cached)', cached.route, topics, args.iterations)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Ingest worker scaling benchmark
+Publishes gateway data messages to a local mosquitto and measures how fast
+1..N ingest worker processes (worker.py) persist them. Needs a broker with
+shared subscription support (mosquitto >= 1.6) reachable with the MQTT_*
+settings, and a server database (BENCH_DATABASE_URL=postgresql://...) for
+meaningful scaling: SQLite serialises all writers on one file lock.
+
+Usage: bench_workers.py [--max-workers 4] [--messages 2000] [--gateways 40] [--nodes 30]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import CallbackAPIVersion
+
+# Sets DATABASE_URL/APRU40_ROLE for this process and the workers it starts
+from bench_ingest import ADC_CHANNELS, build_payload, seed
+from app import app, db
+from app.services.sensor_store import sensor_store
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def publish_all(messages):
+    """Publish every message with QoS 1 and wait until the broker acknowledged them"""
+    client = mqtt.Client(callback_api_version=CallbackAPIVersion.VERSION2, protocol=mqtt.MQTTv5)
+    if os.getenv('MQTT_USERNAME') and os.getenv('MQTT_PASSWORD'):
+        client.username_pw_set(os.getenv('MQTT_USERNAME'), os.getenv('MQTT_PASSWORD'))
+    client.max_inflight_messages_set(1000)
+    client.connect(os.getenv('MQTT_BROKER', 'localhost'), int(os.getenv('MQTT_PORT', 1883)))
+    client.loop_start()
+    
+    infos = [
+        client.publish(f"apru40/gateway/{gateway_identifier}/data", json.dumps(payload), qos=1)
+        for gateway_identifier, payload in messages
+    ]
+    for info in infos:
+        info.wait_for_publish()
+    
+    client.loop_stop()
+    client.disconnect()
+
+def wait_for_rows(expected, timeout):
+    """Poll the database until expected rows are stored; return the row count"""
+    deadline = time.monotonic() + timeout
+    count = 0
+    while time.monotonic() < deadline:
+        with app.app_context():
+            count = sensor_store.count()
+            db.session.remove()
+        if count >= expected:
+            break
+        time.sleep(0.2)
+    return count
+
+def run(worker_count, messages, expected_rows, warmup, timeout):
+    """Start worker_count workers, publish messages and time ingestion"""
+    with app.app_context():
+        sensor_store.delete_before(datetime.max)
+        db.session.remove()
+    
+    env = dict(os.environ, INGEST_WORKER_STATS_INTERVAL='1')
+    workers = subprocess.Popen(
+        [sys.executable, 'worker.py', '--workers', str(worker_count)],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL
+    )
+    try:
+        time.sleep(warmup)  # let every worker connect and subscribe
+        start = time.perf_counter()
+        publish_all(messages)
+        stored = wait_for_rows(expected_rows, timeout)
+        elapsed = time.perf_counter() - start
+    finally:
+        workers.terminate()
+        workers.wait()
+    
+    return elapsed, stored
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ingest worker scaling against a local broker')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--gateways', type=int, default=40)
+    parser.add_argument('--nodes', type=int, default=30)
+    parser.add_argument('--warmup', type=float, default=5.0, help='seconds to wait for workers to subscribe')
+    parser.add_argument('--timeout', type=float, default=300.0)
+    args = parser.parse_args()
+    
+    with app.app_context():
+        seed(args.gateways, args.nodes)
+    messages = [
+        (f"GW{i % args.gateways:03d}", build_payload(f"GW{i % args.gateways:03d}", args.nodes, i))
+        for i in range(args.messages)
+    ]
+    expected_rows = args.messages * args.nodes * sum(ADC_CHANNELS.values())
+    
+    print(f"{args.messages} messages, {expected_rows} rows per run")
+    baseline = None
+    for worker_count in range(1, args.max_workers + 1):
+        elapsed, stored = run(worker_count, messages, expected_rows, args.warmup, args.timeout)
+        rate = stored / elapsed
+        baseline = baseline or rate
+        note = '' if stored >= expected_rows else f"  (timeout: {stored}/{expected_rows} rows)"
+        print(f"  {worker_count:2d} workers: {elapsed:8.2f}s  {rate:10.0f} rows/s  {rate / baseline:5.2f}x{note}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Migrate legacy sensor_data rows to sensor_series / sensor_samples
+Copies the wide sensor_data table (one row per reading with node_id, adc_type,
+channel, unit and qr_code) of the configured database (DATABASE_URL) into the
+series dictionary, the narrow sample table and node_qr_codes, in keyset-ordered
+chunks with one commit each. Rows already copied are skipped, so an interrupted
+migration can simply be run again. With --drop the legacy table is dropped once
+every legacy row is found in sensor_samples (series, timestamp and device
+timestamp); it is kept, and the script fails, if any is missing.
+
+Usage: migrate_sensor_series.py [--batch-size 10000] [--drop]
+"""
+import argparse
+import os
+import sys
+import time
+
+os.environ.setdefault('APRU40_ROLE', 'ingest-worker')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import MetaData, Table, func, inspect, null, select, tuple_  # noqa: E402
+from app import app, db  # noqa: E402
+from app.services.partitions import partition_router  # noqa: E402
+from app.services.sensor_store import SampleBatch, sensor_store  # noqa: E402
+
+def copy_chunk(rows):
+    """Copy legacy rows; returns the samples inserted"""
+    # New series are created per node, once per chunk
+    keys = {}
+    for row in rows:
+        keys.setdefault(row.node_id, set()).add((row.adc_type, row.channel, row.unit or ''))
+    series = {}
+    for node_pk, node_keys in keys.items():
+        node_keys = list(node_keys)
+        series.update(((node_pk,) + key, series_id)
+                      for key, series_id in zip(node_keys, sensor_store.series_ids(node_pk, node_keys)))
+    
+    batch = SampleBatch()
+    for row in rows:
+        # Rows without a device timestamp are stored under their event time, as the writers do
+        device_timestamp = row.device_timestamp or row.timestamp
+        batch.samples.append({
+            'series_id': series[(row.node_id, row.adc_type, row.channel, row.unit or '')],
+            'timestamp': row.timestamp,
+            'device_timestamp': device_timestamp,
+            'raw_value': row.raw_value,
+            'converted_value': row.converted_value
+        })
+        if row.qr_code:
+            batch.qr_codes.append({'node_id': row.node_id, 'timestamp': row.timestamp,
+                                   'device_timestamp': device_timestamp, 'qr_code': row.qr_code})
+    inserted = sensor_store.write(db.session.connection(), batch)
+    db.session.commit()
+    return inserted
+
+def missing_rows(rows):
+    """Count the legacy rows of a chunk whose sample is not stored"""
+    keys = [
+        (sensor_store.series_id(row.node_id, row.adc_type, row.channel, row.unit),
+         row.timestamp, row.device_timestamp or row.timestamp)
+        for row in rows
+    ]
+    start = min(key[1] for key in keys)
+    end = max(key[1] for key in keys)
+    
+    connection = db.session.connection()
+    found = set()
+    for table in partition_router.tables(connection, start, end):
+        found.update(tuple(sample) for sample in connection.execute(
+            select(table.c.series_id, table.c.timestamp, table.c.device_timestamp).where(
+                table.c.series_id.in_({key[0] for key in keys}), table.c.timestamp.between(start, end)
+            )
+        ))
+    db.session.commit()
+    return sum(1 for key in keys if key not in found)
+
+def legacy_chunks(batch_size):
+    """Yield the legacy rows in keyset-ordered chunks, with the total row count first"""
+    legacy = Table('sensor_data', MetaData(), autoload_with=db.engine)
+    # Databases older than duplicate suppression have no device_timestamp column
+    device_timestamp = legacy.c.device_timestamp if 'device_timestamp' in legacy.c else null()
+    columns = [legacy.c.id, legacy.c.node_id, legacy.c.timestamp, device_timestamp.label('device_timestamp'),
+               legacy.c.adc_type, legacy.c.channel, legacy.c.raw_value, legacy.c.converted_value,
+               legacy.c.unit, legacy.c.qr_code]
+    yield db.session.execute(select(func.count()).select_from(legacy)).scalar()
+    
+    last = None
+    while True:
+        query = select(*columns).order_by(legacy.c.timestamp, legacy.c.id).limit(batch_size)
+        if last is not None:
+            query = query.where(tuple_(legacy.c.timestamp, legacy.c.id) > last)
+        rows = db.session.execute(query).all()
+        if not rows:
+            break
+        last = (rows[-1].timestamp, rows[-1].id)
+        yield rows
+
+def migrate(batch_size):
+    """Copy every legacy row; returns (rows read, samples inserted)"""
+    chunks = legacy_chunks(batch_size)
+    total = next(chunks)
+    print(f"Migrating {total} sensor_data rows in chunks of {batch_size}...")
+    
+    read = inserted = 0
+    started = time.perf_counter()
+    for rows in chunks:
+        inserted += copy_chunk(rows)
+        read += len(rows)
+        elapsed = time.perf_counter() - started
+        print(f"  {read}/{total} rows ({read / elapsed:.0f} rows/s)")
+    
+    return read, inserted
+
+def verify(batch_size):
+    """Look every legacy row up in the sample tables; returns the rows missing"""
+    chunks = legacy_chunks(batch_size)
+    total = next(chunks)
+    print(f"Verifying {total} sensor_data rows...")
+    return sum(missing_rows(rows) for rows in chunks)
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate sensor_data to sensor_series/sensor_samples')
+    parser.add_argument('--batch-size', type=int, default=10000, help='legacy rows per chunk')
+    parser.add_argument('--drop', action='store_true', help='drop sensor_data once every row is copied')
+    args = parser.parse_args()
+    
+    with app.app_context():
+        if not inspect(db.engine).has_table('sensor_data'):
+            print("No sensor_data table: nothing to migrate")
+            return
+        
+        started = time.perf_counter()
+        read, inserted = migrate(args.batch_size)
+        print(f"✓ {read} rows read, {inserted} samples inserted ({read - inserted} already present) "
+              f"in {time.perf_counter() - started:.1f}s, {sensor_store.series_created} series created")
+        
+        if args.drop:
+            missing = verify(args.batch_size)
+            if missing:
+                print(f"✗ {missing} sensor_data rows have no sample (duplicates of another row or not "
+                      f"copied): sensor_data kept")
+                sys.exit(1)
+            Table('sensor_data', MetaData(), autoload_with=db.engine).drop(db.engine)
+            print("✓ sensor_data dropped")
+
+if __name__ == '__main__':
+    main()
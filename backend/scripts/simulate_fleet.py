@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+"""
+Synthetic gateway fleet simulator and ingest load generator
+Simulates N gateways with up to --max-nodes nodes each, every gateway on its
+own MQTT connection, publishing the documented data (JSON or binary), status
+and alert payloads at configurable rates with jitter, occasional QR code scans
+and reconnect storms (a fraction of the fleet dropping and reconnecting at
+once). It reports what the backend actually does with that load:
+    
+    - end-to-end latency (publish -> 'sensor_data' WebSocket event), matched
+      on a sequence number carried in node 1's ads7128 ch0 raw value; the
+      event is emitted after the rows are committed
+    - committed sensor_samples rows per second, read from the backend database,
+      against the rows published
+
+Run the backend (or worker.py) against the same broker and database first.
+--provision creates the simulated site, gateways and nodes through the REST
+API, otherwise their data is discarded as unknown. WebSocket observation
+needs the python-socketio client extras (pip install "python-socketio[client]").
+
+Usage: simulate_fleet.py [--gateways 10] [--max-nodes 30] [--data-interval 5]
+                         [--duration 60] [--provision] [--binary]
+"""
+import argparse
+import heapq
+import importlib.util
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import paho.mqtt.client as mqtt
+from paho.mqtt.client import CallbackAPIVersion
+from sqlalchemy import create_engine, text
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _load(name):
+    """Load a service module on its own: importing the app package would create the app"""
+    path = os.path.join(BACKEND_DIR, 'app', 'services', f'{name}.py')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+payload_decoder = _load('payload_decoder')
+
+ADC_CHANNELS = {'ads7128': 8, 'ads1119_1': 4, 'ads1119_2': 4}
+ROWS_PER_NODE = sum(ADC_CHANNELS.values())
+ALERT_TYPES = [
+    ('tamper', 'critical', 'Tamper detected, NVS erased'),
+    ('bt_unauthorized', 'high', 'Unauthorized Bluetooth connection attempt'),
+    ('battery_low', 'medium', 'Battery below 3.4V'),
+    ('sensor_fault', 'medium', 'ADC channel out of range'),
+]
+LATENCY_WINDOW = 60  # seconds a published marker waits for its WebSocket event
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def format_ms(seconds):
+    return '-' if seconds is None else f"{seconds * 1000:.0f}ms"
+
+class SimulatedNode:
+    def __init__(self, node_id, rng):
+        self.node_id = node_id
+        self.battery = rng.uniform(3.6, 4.2)
+        self.rssi = rng.randint(-85, -35)
+        self.levels = {(adc_type, c): rng.randint(800, 3200)
+                       for adc_type, channels in ADC_CHANNELS.items() for c in range(channels)}
+    
+    def report(self, rng, qr_code=None):
+        """Build this node's entry of a data payload, drifting its readings a little"""
+        sensors = {}
+        for adc_type, channels in ADC_CHANNELS.items():
+            readings = {}
+            for c in range(channels):
+                raw = self.levels[adc_type, c] = max(0, min(4095, self.levels[adc_type, c] + rng.randint(-20, 20)))
+                if adc_type == 'ads7128':
+                    readings[f"ch{c}"] = {'raw': raw, 'value': round(raw * 0.00488 + 4.0, 3), 'unit': 'mA'}
+                else:
+                    readings[f"ch{c}"] = {'raw': raw, 'value': round(raw * 0.000805, 4), 'unit': 'V'}
+            sensors[adc_type] = readings
+        
+        self.battery = max(3.3, self.battery - rng.uniform(0, 0.0005))
+        self.rssi = max(-100, min(-30, self.rssi + rng.randint(-2, 2)))
+        report = {'node_id': self.node_id, 'sensors': sensors, 'rssi': self.rssi, 'battery': round(self.battery, 3)}
+        if qr_code:
+            report['qr_code'] = qr_code
+        return report
+
+class SimulatedGateway:
+    def __init__(self, gateway_id, node_count, args, rng):
+        self.gateway_id = gateway_id
+        self.args = args
+        self.rng = rng
+        self.nodes = [SimulatedNode(n, rng) for n in range(1, node_count + 1)]
+        self.seq = 0
+        self.connected = threading.Event()
+        self.client = mqtt.Client(
+            callback_api_version=CallbackAPIVersion.VERSION2,
+            client_id=f"sim-{gateway_id}-{os.getpid()}"
+        )
+        if args.username and args.password:
+            self.client.username_pw_set(args.username, args.password)
+        self.client.will_set(self.topic('status'), json.dumps({'status': 'offline'}), qos=1)
+        self.client.max_queued_messages_set(1000)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+    
+    def topic(self, suffix):
+        return f"apru40/gateway/{self.gateway_id}/{suffix}"
+    
+    def connect(self):
+        """Connect and start the network loop (non-blocking)"""
+        self.client.connect_async(self.args.broker, self.args.port, keepalive=30)
+        self.client.loop_start()
+    
+    def reconnect(self):
+        """Drop the connection and reconnect right away, as a gateway rebooting"""
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.connected.clear()
+        self.connect()
+    
+    def close(self):
+        self.publish(self.topic('status'), {'status': 'offline', 'timestamp': int(time.time())})
+        self.client.disconnect()
+        self.client.loop_stop()
+    
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code.is_failure:
+            print(f"✗ {self.gateway_id} connection refused: {reason_code}")
+            return
+        self.connected.set()
+        self.publish(self.topic('status'), {'status': 'online', 'timestamp': int(time.time())})
+    
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        self.connected.clear()
+    
+    def publish(self, topic, payload, raw=False):
+        """Publish if connected; False if the message was skipped"""
+        if not self.connected.is_set():
+            return False
+        body = payload if raw else json.dumps(payload)
+        return self.client.publish(topic, body, qos=self.args.qos).rc == mqtt.MQTT_ERR_SUCCESS
+    
+    def publish_data(self):
+        """Publish one data message; returns (sequence number, rows) or None if skipped"""
+        self.seq += 1
+        nodes = []
+        for node in self.nodes:
+            qr_code = None
+            if self.args.qr_rate and self.rng.random() < self.args.qr_rate:
+                qr_code = f"PROD{self.rng.randint(10000, 99999)}"
+            nodes.append(node.report(self.rng, qr_code))
+        # Latency marker: the backend stores and emits raw values unchanged
+        nodes[0]['sensors']['ads7128']['ch0']['raw'] = self.seq
+        payload = {'gateway_id': self.gateway_id, 'timestamp': int(time.time()), 'nodes': nodes}
+        
+        if self.args.binary:
+            sent = self.publish(self.topic('data/bin'),
+                                payload_decoder.encode_binary(payload, compress=self.args.compress), raw=True)
+        else:
+            sent = self.publish(self.topic('data'), payload)
+        return (self.seq, len(nodes) * ROWS_PER_NODE) if sent else None
+    
+    def publish_status(self):
+        return self.publish(self.topic('status'), {'status': 'online', 'timestamp': int(time.time())})
+    
+    def publish_alert(self):
+        alert_type, priority, description = self.rng.choice(ALERT_TYPES)
+        node = self.rng.choice(self.nodes)
+        return self.publish(self.topic(f'alert/{alert_type}'), {
+            'type': alert_type,
+            'priority': priority,
+            'device_type': 'node',
+            'device_id': node.node_id,
+            'description': description,
+            'timestamp': int(time.time())
+        })
+
+class Observer:
+    """Watches the backend's output: WebSocket events and committed database rows"""
+    
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.pending = {}       # (gateway_id, seq) -> publish time
+        self.latencies = []
+        self.window = []        # latencies since the last report
+        self.events = 0
+        self.expired = 0
+        self.websocket = None
+        self.engine = None
+        self.baseline_rows = 0
+    
+    def start(self):
+        if self.args.database_url:
+            try:
+                self.engine = create_engine(self.args.database_url)
+                self.baseline_rows = self.count_rows()
+                print(f"✓ Database: {self.baseline_rows} sensor_samples rows before the run")
+            except Exception as e:
+                self.engine = None
+                print(f"✗ Database observation disabled: {e}")
+        
+        if not self.args.no_websocket:
+            try:
+                import socketio
+                self.websocket = socketio.Client(reconnection=True)
+                self.websocket.on('sensor_data', self.on_sensor_data)
+                self.websocket.connect(self.args.api, wait_timeout=5)
+                print(f"✓ WebSocket connected to {self.args.api}")
+            except Exception as e:
+                self.websocket = None
+                print(f"✗ WebSocket observation disabled: {e}")
+    
+    def stop(self):
+        if self.websocket:
+            self.websocket.disconnect()
+        if self.engine:
+            self.engine.dispose()
+    
+    def count_rows(self):
+        with self.engine.connect() as connection:
+            tables = ['sensor_samples']
+            if connection.dialect.name == 'sqlite':
+                # One table per time partition (PostgreSQL counts its partitions through the parent)
+                tables += connection.execute(text(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'sensor_samples_p%'"
+                )).scalars().all()
+            return sum(connection.execute(text(f'SELECT count(*) FROM {table}')).scalar() for table in tables)
+    
+    def committed_rows(self):
+        """sensor_samples rows committed since the run started, or None without a database"""
+        if not self.engine:
+            return None
+        try:
+            return self.count_rows() - self.baseline_rows
+        except Exception as e:
+            print(f"✗ Row count failed: {e}")
+            return None
+    
+    def sent(self, gateway_id, seq, at):
+        with self.lock:
+            self.pending[gateway_id, seq] = at
+    
+    def on_sensor_data(self, data):
+        received = time.time()
+        try:
+            seq = data['nodes'][0]['sensors']['ads7128']['ch0']['raw']
+            key = (data['gateway_id'], seq)
+        except (KeyError, IndexError, TypeError):
+            return
+        with self.lock:
+            self.events += 1
+            sent_at = self.pending.pop(key, None)
+            if sent_at is not None:
+                self.latencies.append(received - sent_at)
+                self.window.append(received - sent_at)
+    
+    def take_window(self):
+        """Get the latencies since the last call, expiring markers never seen"""
+        cutoff = time.time() - LATENCY_WINDOW
+        with self.lock:
+            window, self.window = self.window, []
+            expired = [key for key, sent_at in self.pending.items() if sent_at < cutoff]
+            for key in expired:
+                del self.pending[key]
+            self.expired += len(expired)
+        return window
+
+class FleetSimulator:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.gateways = []
+        for g in range(args.gateways):
+            node_count = self.rng.randint(args.min_nodes or args.max_nodes, args.max_nodes)
+            self.gateways.append(SimulatedGateway(f"{args.prefix}{g:03d}", node_count, args,
+                                                  random.Random(self.rng.random())))
+        self.observer = Observer(args)
+        self.counts = {'data': 0, 'status': 0, 'alert': 0, 'skipped': 0, 'rows': 0, 'storms': 0}
+    
+    def jittered(self, interval):
+        return interval * (1 + self.rng.uniform(-self.args.jitter, self.args.jitter))
+    
+    def schedule(self):
+        """Initial event heap, spread over one interval so gateways do not publish in lockstep"""
+        events = []
+        for index in range(len(self.gateways)):
+            events.append((self.rng.uniform(0, self.args.data_interval), 'data', index))
+            events.append((self.rng.uniform(0, self.args.status_interval), 'status', index))
+            if self.args.alert_rate:
+                events.append((self.rng.expovariate(self.args.alert_rate / 3600.0), 'alert', index))
+        if self.args.storm_interval:
+            events.append((self.args.storm_interval, 'storm', None))
+        heapq.heapify(events)
+        return events
+    
+    def fire(self, kind, index):
+        """Publish one scheduled message and return when the next one of this kind is due"""
+        if kind == 'storm':
+            self.storm()
+            return self.args.storm_interval
+        
+        gateway = self.gateways[index]
+        if kind == 'data':
+            sent_at = time.time()
+            result = gateway.publish_data()
+            if result:
+                seq, rows = result
+                self.observer.sent(gateway.gateway_id, seq, sent_at)
+                self.counts['rows'] += rows
+            delay = self.jittered(self.args.data_interval)
+        elif kind == 'status':
+            result = gateway.publish_status()
+            delay = self.jittered(self.args.status_interval)
+        else:
+            result = gateway.publish_alert()
+            delay = self.rng.expovariate(self.args.alert_rate / 3600.0)
+        self.counts[kind if result else 'skipped'] += 1
+        return delay
+    
+    def storm(self):
+        """Disconnect a fraction of the fleet and reconnect it all at once"""
+        victims = self.rng.sample(self.gateways, max(1, int(len(self.gateways) * self.args.storm_fraction)))
+        self.counts['storms'] += 1
+        print(f"  reconnect storm: {len(victims)} gateways")
+        threads = [threading.Thread(target=gateway.reconnect, daemon=True) for gateway in victims]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    
+    def connect(self):
+        for gateway in self.gateways:
+            gateway.connect()
+        deadline = time.monotonic() + 10
+        for gateway in self.gateways:
+            gateway.connected.wait(max(0, deadline - time.monotonic()))
+        connected = sum(gateway.connected.is_set() for gateway in self.gateways)
+        nodes = sum(len(gateway.nodes) for gateway in self.gateways)
+        print(f"✓ {connected}/{len(self.gateways)} gateways ({nodes} nodes) connected to "
+              f"{self.args.broker}:{self.args.port}")
+    
+    def report(self, elapsed, last):
+        """Print one progress line; returns the values the next line is relative to"""
+        committed = self.observer.committed_rows()
+        window = self.observer.take_window()
+        interval = elapsed - last['elapsed']
+        line = (f"  {elapsed:6.0f}s  data {(self.counts['data'] - last['data']) / interval:7.1f}/s  "
+                f"rows {(self.counts['rows'] - last['rows']) / interval:8.0f}/s published")
+        if committed is not None:
+            line += (f"  {(committed - last['committed']) / interval:8.0f}/s committed"
+                     f"  backlog {self.counts['rows'] - committed}")
+        if self.observer.websocket:
+            line += (f"  latency p50 {format_ms(percentile(window, 0.5))}"
+                     f" p95 {format_ms(percentile(window, 0.95))}")
+        print(line)
+        return {'elapsed': elapsed, 'data': self.counts['data'], 'rows': self.counts['rows'],
+                'committed': committed or 0}
+    
+    def run(self):
+        self.observer.start()
+        self.connect()
+        events = self.schedule()
+        start = time.monotonic()
+        next_report = self.args.report_interval
+        last = {'elapsed': 0.0, 'data': 0, 'rows': 0, 'committed': 0}
+        
+        try:
+            while True:
+                elapsed = time.monotonic() - start
+                if elapsed >= self.args.duration:
+                    break
+                if elapsed >= next_report:
+                    last = self.report(elapsed, last)
+                    next_report += self.args.report_interval
+                    continue
+                
+                due, kind, index = events[0]
+                if due > elapsed:
+                    time.sleep(min(due, next_report, self.args.duration) - elapsed)
+                    continue
+                heapq.heapreplace(events, (due + self.fire(kind, index), kind, index))
+        except KeyboardInterrupt:
+            print("  interrupted")
+        
+        published_for = time.monotonic() - start
+        for gateway in self.gateways:
+            gateway.close()
+        self.summary(published_for)
+        self.observer.stop()
+    
+    def summary(self, published_for):
+        """Wait for the backend to catch up, then print totals"""
+        committed = self.observer.committed_rows()
+        deadline = time.monotonic() + self.args.drain_timeout
+        drain_start = time.monotonic()
+        while committed is not None and committed < self.counts['rows'] and time.monotonic() < deadline:
+            time.sleep(0.5)
+            committed = self.observer.committed_rows()
+        if self.observer.websocket:
+            time.sleep(min(1.0, max(0.0, deadline - time.monotonic())))
+        self.observer.take_window()
+        
+        counts = self.counts
+        print(f"\n{len(self.gateways)} gateways, {published_for:.0f}s: {counts['data']} data, "
+              f"{counts['status']} status, {counts['alert']} alert messages "
+              f"({counts['skipped']} skipped while disconnected, {counts['storms']} reconnect storms)")
+        print(f"  published : {counts['rows']} rows ({counts['rows'] / published_for:.0f} rows/s)")
+        if committed is not None:
+            drained = time.monotonic() - drain_start
+            print(f"  committed : {committed} rows ({committed / (published_for + drained):.0f} rows/s, "
+                  f"{committed / counts['rows'] if counts['rows'] else 0:.1%} of published, "
+                  f"{drained:.1f}s to drain)")
+        
+        if self.observer.websocket:
+            latencies = self.observer.latencies
+            print(f"  websocket : {self.observer.events} sensor_data events, {len(latencies)} matched, "
+                  f"{self.observer.expired + len(self.observer.pending)} never seen")
+            print(f"  latency   : p50 {format_ms(percentile(latencies, 0.5))}  "
+                  f"p95 {format_ms(percentile(latencies, 0.95))}  "
+                  f"p99 {format_ms(percentile(latencies, 0.99))}  "
+                  f"max {format_ms(max(latencies) if latencies else None)}")
+        
+        queues = api_request(self.args, 'GET', '/api/v1/ingest/queues') if self.args.token else None
+        if queues:
+            print(f"  backend   : {queues['dropped_total']} dropped, {queues['delayed_total']} delayed, "
+                  f"{queues['blocked_total']} blocked ({queues['role']})")
+
+def api_request(args, method, path, body=None):
+    """Call the backend REST API; None (with a message) if it fails"""
+    headers = {'Content-Type': 'application/json'}
+    if args.token:
+        headers['Authorization'] = f"Bearer {args.token}"
+    request = urllib.request.Request(
+        args.api.rstrip('/') + path, method=method, headers=headers,
+        data=json.dumps(body).encode() if body is not None else None
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return json.loads(response.read() or b'null')
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        print(f"✗ {method} {path} failed: {e}")
+        return None
+
+def login(args):
+    """Log in to the backend API; the token is kept on args"""
+    response = api_request(args, 'POST', '/api/v1/auth/login',
+                           {'username': args.api_user, 'password': args.api_password})
+    args.token = (response or {}).get('token')
+    return args.token is not None
+
+def provision(args, gateways):
+    """Create the simulated site, gateways and nodes that do not exist yet"""
+    existing = {gateway['gateway_id']: gateway
+                for gateway in (api_request(args, 'GET', '/api/v1/iot/gateways/') or {}).get('gateways', [])}
+    site = None
+    created_gateways = created_nodes = 0
+    for simulated in gateways:
+        gateway = existing.get(simulated.gateway_id)
+        if gateway is None:
+            if site is None:
+                site = api_request(args, 'POST', '/api/v1/sites', {'name': f"Simulated fleet {args.prefix}"})
+                if not site:
+                    raise SystemExit("✗ Could not create the simulated site")
+                site = site.get('site', site)
+            gateway = api_request(args, 'POST', '/api/v1/iot/gateways/', {
+                'name': f"Simulated {simulated.gateway_id}",
+                'gateway_id': simulated.gateway_id,
+                'site_id': site['id'],
+                'max_nodes': args.max_nodes
+            })
+            if not gateway:
+                continue
+            gateway = gateway.get('gateway', gateway)
+            created_gateways += 1
+        
+        known = {node['node_id'] for node in
+                 (api_request(args, 'GET', f"/api/v1/iot/gateways/{gateway['id']}/nodes") or {}).get('nodes', [])}
+        for node in simulated.nodes:
+            if node.node_id not in known:
+                if api_request(args, 'POST', '/api/v1/iot/nodes/', {
+                    'name': f"{simulated.gateway_id}-Node-{node.node_id}",
+                    'gateway_id': gateway['id'],
+                    'node_id': node.node_id
+                }):
+                    created_nodes += 1
+    print(f"✓ Provisioned {created_gateways} gateways and {created_nodes} nodes")
+
+def database_url(url):
+    """Resolve a relative SQLite path the way Flask-SQLAlchemy does (in backend/instance)"""
+    prefix = 'sqlite:///'
+    if url and url.startswith(prefix) and not url.startswith(prefix + '/') and url != prefix + ':memory:':
+        return prefix + os.path.join(BACKEND_DIR, 'instance', url[len(prefix):])
+    return url
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate a gateway fleet publishing to the MQTT broker')
+    parser.add_argument('--broker', default=os.getenv('MQTT_BROKER', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('MQTT_PORT', 1883)))
+    parser.add_argument('--username', default=os.getenv('MQTT_USERNAME'))
+    parser.add_argument('--password', default=os.getenv('MQTT_PASSWORD'))
+    parser.add_argument('--qos', type=int, choices=(0, 1), default=0)
+    parser.add_argument('--gateways', type=int, default=10)
+    parser.add_argument('--max-nodes', type=int, default=30, help='nodes per gateway (maximum)')
+    parser.add_argument('--min-nodes', type=int, default=None,
+                        help='draw each gateway\'s node count from [min, max] (default: always max)')
+    parser.add_argument('--prefix', default='SIM', help='gateway_id prefix')
+    parser.add_argument('--data-interval', type=float, default=5.0, help='seconds between data messages')
+    parser.add_argument('--status-interval', type=float, default=30.0, help='seconds between status messages')
+    parser.add_argument('--alert-rate', type=float, default=1.0, help='alerts per gateway per hour')
+    parser.add_argument('--jitter', type=float, default=0.1, help='relative jitter of the intervals')
+    parser.add_argument('--qr-rate', type=float, default=0.01, help='probability a node report carries a QR scan')
+    parser.add_argument('--storm-interval', type=float, default=0, help='seconds between reconnect storms (0: none)')
+    parser.add_argument('--storm-fraction', type=float, default=0.5, help='fraction of gateways in a storm')
+    parser.add_argument('--binary', action='store_true', help='publish data/bin instead of JSON data')
+    parser.add_argument('--compress', action='store_true', help='zlib-compress binary payloads')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds to publish')
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help='seconds to wait for the backend to commit everything afterwards')
+    parser.add_argument('--report-interval', type=float, default=5.0)
+    parser.add_argument('--seed', type=int, default=None, help='random seed for a reproducible fleet')
+    parser.add_argument('--api', default='http://localhost:5000', help='backend URL (REST and WebSocket)')
+    parser.add_argument('--api-user', default='admin')
+    parser.add_argument('--api-password', default='admin123')
+    parser.add_argument('--provision', action='store_true', help='create missing gateways/nodes via the API')
+    parser.add_argument('--database-url', default=os.getenv('DATABASE_URL', 'sqlite:///apru40.db'),
+                        help='backend database to count committed rows in (empty: disabled)')
+    parser.add_argument('--no-websocket', action='store_true', help='do not measure latency via WebSocket')
+    args = parser.parse_args()
+    args.database_url = database_url(args.database_url)
+    args.token = None
+    
+    simulator = FleetSimulator(args)
+    if not login(args) and args.provision:
+        raise SystemExit("✗ Provisioning needs a backend login (--api, --api-user, --api-password)")
+    if args.provision:
+        provision(args, simulator.gateways)
+    simulator.run()
+
+if __name__ == '__main__':
+    main()
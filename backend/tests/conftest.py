@@ -0,0 +1,65 @@
+"""
+Test fixtures: the application on a temporary SQLite database with MQTT on the
+in-process broker, so gateway messages go through the real routing, decoding,
+batched writer and storage. The application is created once at import (app =
+create_app()): the environment is set before it is imported.
+"""
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+os.environ['DATABASE_URL'] = f"sqlite:///{tempfile.mkdtemp(prefix='apru40-tests-')}/apru40.db"
+os.environ['MQTT_TRANSPORT'] = 'inproc'
+os.environ.pop('MQTT_CLIENT_ID', None)
+os.environ.setdefault('INGEST_FLUSH_INTERVAL_MS', '20')
+# Skew estimates apply from the first message instead of after a minute of traffic
+os.environ.setdefault('CLOCK_SKEW_MIN_SPAN', '0')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+from app import app, db  # noqa: E402
+from app.models.iot import Gateway, Node, Site  # noqa: E402
+from app.services.inproc_broker import InProcessClient, inproc_broker  # noqa: E402
+
+def wait_for(condition, timeout=5):
+    """Poll condition until it returns a truthy value; returns it (falsy on timeout)"""
+    deadline = time.monotonic() + timeout
+    while True:
+        result = condition()
+        if result or time.monotonic() > deadline:
+            return result
+        time.sleep(0.02)
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+@pytest.fixture(scope='session')
+def auth_headers():
+    response = app.test_client().post('/api/v1/auth/login', json={'username': 'admin', 'password': 'admin123'})
+    return {'Authorization': f"Bearer {response.get_json()['token']}"}
+
+@pytest.fixture
+def device():
+    """A site with one gateway (unique gateway_id) and its node 1"""
+    with app.app_context():
+        site = Site(name='Test site')
+        db.session.add(site)
+        db.session.flush()
+        gateway = Gateway(gateway_id=f"GW{uuid.uuid4().hex[:8]}", name='Test gateway', site_id=site.id)
+        db.session.add(gateway)
+        db.session.flush()
+        node = Node(node_id=1, name='Test node', gateway_id=gateway.id)
+        db.session.add(node)
+        db.session.commit()
+        return {'site_id': site.id, 'gateway_id': gateway.gateway_id, 'gateway_pk': gateway.id, 'node_pk': node.id}
+
+@pytest.fixture
+def gateway_client(device):
+    """An in-process MQTT client publishing as the device's gateway"""
+    client = InProcessClient(inproc_broker, client_id=device['gateway_id'])
+    client.connect()
+    yield client
+    client.disconnect()
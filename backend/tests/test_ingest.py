@@ -0,0 +1,153 @@
+"""
+Ingest round trip through the in-process broker: gateway data messages (JSON
+and binary) are routed, decoded, deduplicated, stamped with their event time
+and written, then read back through the /sensor-data API.
+"""
+import json
+import time
+from datetime import datetime, timedelta
+import pytest
+from conftest import wait_for
+from app import app, db
+from app.services.payload_decoder import encode_binary
+from app.services.sensor_store import SampleBatch, sensor_store
+
+def data_payload(timestamp, raw=100, qr_code=None):
+    """A gateway data payload: node 1 with two ADS7128 channels"""
+    node = {
+        'node_id': 1,
+        'rssi': -60,
+        'battery': 3.7,
+        'sensors': {'ads7128': {
+            'ch0': {'raw': raw, 'value': raw / 10, 'unit': 'mA'},
+            'ch1': {'raw': raw + 1, 'value': 2.5, 'unit': 'V'}
+        }}
+    }
+    if qr_code:
+        node['qr_code'] = qr_code
+    return {'timestamp': timestamp, 'nodes': [node]}
+
+def publish(gateway_client, device, payload, binary=False):
+    if binary:
+        gateway_client.publish(f"apru40/gateway/{device['gateway_id']}/data/bin", encode_binary(payload), qos=1)
+    else:
+        gateway_client.publish(f"apru40/gateway/{device['gateway_id']}/data", json.dumps(payload), qos=1)
+
+def history(client, auth_headers, device, **params):
+    """The device's samples, newest first"""
+    params = dict(node_id=device['node_pk'], limit=1000, **params)
+    response = client.get('/api/v1/sensor-data/history', headers=auth_headers, query_string=params)
+    assert response.status_code == 200
+    return response.get_json()['data']
+
+def wait_for_samples(client, auth_headers, device, count):
+    """Wait until the device has count samples; returns them"""
+    samples = []
+    
+    def stored():
+        samples[:] = history(client, auth_headers, device)
+        return len(samples) >= count
+    
+    wait_for(stored)
+    return samples
+
+def ingest_stats(client, auth_headers):
+    return client.get('/api/v1/ingest/stats', headers=auth_headers).get_json()
+
+def device_time(timestamp):
+    return datetime.utcfromtimestamp(timestamp).isoformat()
+
+def test_json_round_trip(client, auth_headers, device, gateway_client):
+    timestamp = int(time.time())
+    publish(gateway_client, device, data_payload(timestamp, raw=100, qr_code='PROD12345'))
+    
+    samples = wait_for_samples(client, auth_headers, device, 2)
+    assert len(samples) == 2
+    by_channel = {sample['channel']: sample for sample in samples}
+    assert by_channel[0]['raw_value'] == 100
+    assert by_channel[0]['converted_value'] == 10.0
+    assert by_channel[0]['unit'] == 'mA'
+    assert by_channel[1]['unit'] == 'V'
+    for sample in samples:
+        assert sample['adc_type'] == 'ads7128'
+        assert sample['qr_code'] == 'PROD12345'
+        assert sample['device_timestamp'] == device_time(timestamp)
+        assert sample['timestamp'] == device_time(timestamp)
+
+def test_binary_round_trip(client, auth_headers, device, gateway_client):
+    timestamp = int(time.time())
+    publish(gateway_client, device, data_payload(timestamp, raw=123), binary=True)
+    
+    samples = wait_for_samples(client, auth_headers, device, 2)
+    by_channel = {sample['channel']: sample for sample in samples}
+    assert by_channel[0]['raw_value'] == 123
+    # value travels as a float32
+    assert by_channel[0]['converted_value'] == pytest.approx(12.3)
+    assert by_channel[1]['unit'] == 'V'
+    assert all(sample['device_timestamp'] == device_time(timestamp) for sample in samples)
+
+def test_duplicates_are_stored_once(client, auth_headers, device, gateway_client):
+    timestamp = int(time.time()) - 5
+    suppressed = ingest_stats(client, auth_headers)['dedup']
+    
+    # QoS 1 redelivery, and the same reading resent in the binary encoding
+    publish(gateway_client, device, data_payload(timestamp))
+    publish(gateway_client, device, data_payload(timestamp))
+    publish(gateway_client, device, data_payload(timestamp), binary=True)
+    # Written after the duplicates: once it is stored, they have been handled
+    publish(gateway_client, device, data_payload(timestamp + 1, raw=200))
+    
+    samples = wait_for_samples(client, auth_headers, device, 4)
+    assert len(samples) == 4
+    assert sorted(sample['raw_value'] for sample in samples) == [100, 101, 200, 201]
+    dedup = ingest_stats(client, auth_headers)['dedup']
+    assert (dedup['suppressed_cache'] + dedup['suppressed_storage']
+            - suppressed['suppressed_cache'] - suppressed['suppressed_storage']) == 2
+
+def test_late_data(client, auth_headers, device, gateway_client):
+    now = int(time.time())
+    before = ingest_stats(client, auth_headers)['event_time']
+    
+    # Live traffic first: the gateway clock is right
+    publish(gateway_client, device, data_payload(now, raw=1))
+    wait_for_samples(client, auth_headers, device, 2)
+    # Buffered during an outage: kept at its event time and counted as late
+    publish(gateway_client, device, data_payload(now - 120, raw=2))
+    # Older than INGEST_LATE_WINDOW: rejected
+    publish(gateway_client, device, data_payload(now - 2 * 86400, raw=3))
+    publish(gateway_client, device, data_payload(now + 1, raw=4))
+    
+    samples = wait_for_samples(client, auth_headers, device, 6)
+    assert len(samples) == 6
+    assert sorted(sample['raw_value'] for sample in samples if sample['channel'] == 0) == [1, 2, 4]
+    late = [sample for sample in samples if sample['channel'] == 0 and sample['raw_value'] == 2]
+    assert late[0]['timestamp'] == device_time(now - 120)
+    after = ingest_stats(client, auth_headers)['event_time']
+    assert after['late_accepted'] - before['late_accepted'] == 1
+    assert after['late_rejected'] - before['late_rejected'] == 1
+
+def test_skewed_gateway_clock_is_corrected(client, auth_headers, device, gateway_client):
+    # The gateway clock is ten minutes behind
+    timestamp = int(time.time()) - 600
+    publish(gateway_client, device, data_payload(timestamp))
+    
+    samples = wait_for_samples(client, auth_headers, device, 2)
+    for sample in samples:
+        assert sample['device_timestamp'] == device_time(timestamp)
+        event_time = datetime.fromisoformat(sample['timestamp'])
+        assert abs(event_time - datetime.utcnow()) < timedelta(seconds=30)
+
+def test_readings_sharing_an_event_time_are_kept(device):
+    # A changed skew estimate can map two readings of a series to the same event time
+    event_time = datetime.utcnow().replace(microsecond=0)
+    with app.app_context():
+        series_id = sensor_store.series_id(device['node_pk'], 'ads7128', 0, 'mA')
+        batch = SampleBatch()
+        for device_timestamp in (event_time, event_time - timedelta(seconds=5), event_time):
+            batch.samples.append({'series_id': series_id, 'timestamp': event_time,
+                                  'device_timestamp': device_timestamp, 'raw_value': 1, 'converted_value': 0.1})
+        inserted = sensor_store.write(db.session.connection(), batch)
+        db.session.commit()
+    
+    # Only the repeated (series, device timestamp) is a duplicate
+    assert inserted == 2
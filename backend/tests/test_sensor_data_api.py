@@ -0,0 +1,87 @@
+"""
+/sensor-data history and CSV export date filters: naive dates are UTC, dates
+with an offset are converted to UTC.
+"""
+import csv
+import io
+from datetime import datetime, timedelta
+import pytest
+from app import app, db
+from app.services.sensor_store import SampleBatch, sensor_store
+
+@pytest.fixture
+def samples(device):
+    """Three samples of the device's ch0 one hour apart, the last one two hours ago; returns their times"""
+    base = datetime.utcnow().replace(minute=10, second=0, microsecond=0) - timedelta(hours=4)
+    times = [base, base + timedelta(hours=1), base + timedelta(hours=2)]
+    with app.app_context():
+        series_id = sensor_store.series_id(device['node_pk'], 'ads7128', 0, 'mA')
+        batch = SampleBatch()
+        for i, timestamp in enumerate(times):
+            batch.samples.append({'series_id': series_id, 'timestamp': timestamp, 'device_timestamp': timestamp,
+                                  'raw_value': i, 'converted_value': i / 10})
+        sensor_store.write(db.session.connection(), batch)
+        db.session.commit()
+    return times
+
+def get_history(client, auth_headers, device, **params):
+    return client.get('/api/v1/sensor-data/history', headers=auth_headers,
+                      query_string=dict(node_id=device['node_pk'], **params))
+
+def get_export(client, auth_headers, device, **params):
+    return client.get('/api/v1/sensor-data/export', headers=auth_headers,
+                      query_string=dict(node_id=device['node_pk'], **params))
+
+def export_rows(response):
+    """The data rows of a CSV export"""
+    return list(csv.reader(io.StringIO(response.get_data(as_text=True))))[1:]
+
+def test_history_date_range(client, auth_headers, device, samples):
+    response = get_history(client, auth_headers, device, start_date=samples[1].isoformat(),
+                           end_date=samples[2].isoformat())
+    
+    assert response.status_code == 200
+    data = response.get_json()['data']
+    assert [sample['timestamp'] for sample in data] == [samples[2].isoformat(), samples[1].isoformat()]
+
+def test_history_dates_with_offset(client, auth_headers, device, samples):
+    # The same range in UTC+02:00
+    start = (samples[1] + timedelta(hours=2)).isoformat() + '+02:00'
+    end = (samples[2] + timedelta(hours=2)).isoformat() + '+02:00'
+    
+    for resolution in ('raw', 'auto'):
+        response = get_history(client, auth_headers, device, start_date=start, end_date=end, resolution=resolution)
+        assert response.status_code == 200
+        data = response.get_json()['data']
+        assert [sample['raw_value'] for sample in data] == [2, 1]
+
+def test_history_rollups_with_offset(client, auth_headers, device, samples):
+    start = samples[0].replace(minute=0).isoformat() + '+00:00'
+    response = get_history(client, auth_headers, device, start_date=start, resolution='1h')
+    
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['resolution'] == '1h'
+    assert [bucket['count'] for bucket in body['data']] == [1, 1, 1]
+
+def test_history_invalid_date(client, auth_headers, device):
+    response = get_history(client, auth_headers, device, start_date='yesterday')
+    
+    assert response.status_code == 400
+
+def test_export_date_range(client, auth_headers, device, samples):
+    response = get_export(client, auth_headers, device, start_date=samples[1].isoformat())
+    
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    rows = export_rows(response)
+    assert [row[0] for row in rows] == [samples[2].isoformat(), samples[1].isoformat()]
+    assert rows[0][2:4] == ['ads7128', '0']
+
+def test_export_dates_with_offset(client, auth_headers, device, samples):
+    start = samples[0].isoformat() + '+00:00'
+    end = (samples[1] - timedelta(hours=1)).isoformat() + '-01:00'
+    response = get_export(client, auth_headers, device, start_date=start, end_date=end)
+    
+    assert response.status_code == 200
+    assert [row[4] for row in export_rows(response)] == ['1', '0']
@@ -0,0 +1,54 @@
+"""
+Ingest worker entry point
+Runs N ingest processes sharing the gateway data/status topics through an
+MQTT v5 shared subscription. Start the API with INGEST_MODE=workers so the
+web process leaves these topics to the workers.
+
+Usage: python worker.py --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+
+def _worker_main(index):
+    """Process target: import the app as an ingest worker and run it"""
+    from app.services.ingest_worker import run_worker
+    run_worker(index)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run APRU40 MQTT ingest workers')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('INGEST_WORKERS', os.cpu_count() or 1)),
+                        help='number of worker processes (default: INGEST_WORKERS or CPU count)')
+    args = parser.parse_args()
+    
+    # Importing the app as the supervisor creates the tables once, before the workers would race
+    # to do it, and starts none of the ingest services (heartbeats, writer, liveness, lanes)
+    os.environ['APRU40_ROLE'] = 'supervisor'
+    import app  # noqa: F401
+    
+    # Inherited by the spawned children before they import the app
+    os.environ['APRU40_ROLE'] = 'ingest-worker'
+    
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=_worker_main, args=(index,), name=f"ingest-worker-{index}")
+        for index in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    print(f"✓ Started {len(processes)} ingest workers")
+    
+    def shutdown(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    
+    for process in processes:
+        process.join()
+
+if __name__ == '__main__':
+    main()